@@ -10,7 +10,16 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 
-from MuonLab_controller import list_devices, MuonLab_experiment
+from MuonLab_controller import list_devices
+from MuonLab_engine import MuonLab_engine_experiment
+from MuonLab_histogram import MuonLab_histogram
+from MuonLab_fit import MuonLab_lifetime_fit
+from MuonLab_decoder import WAVEFORM_LENGTH
+from MuonLab_live_plot import (
+    MuonLab_live_histogram,
+    MuonLab_live_waveform,
+    update_lifetime_plot,
+)
 
 
 class user_interface(QMainWindow):
@@ -36,6 +45,17 @@ class user_interface(QMainWindow):
         self.experiment = None
         self.filename = None
 
+        # histograms of lifetimes and delta times, updated with the events
+        # measured since the previous update
+        self.histogram_LFT = MuonLab_histogram(step=10, minimum=0, maximum=655350)
+        self.histogram_DT = MuonLab_histogram(
+            step=0.5, minimum=-32767.5, maximum=32767.5
+        )
+        self.events_added_LFT = 0
+        self.events_added_DT = 0
+        # lifetime fitted to the lifetime histogram, updated with it
+        self.fit_LFT = MuonLab_lifetime_fit()
+
         ##### MAIN LAYOUT #####
         # initiating central widget
         central_widget = QWidget()
@@ -542,8 +562,18 @@ class user_interface(QMainWindow):
             event_row_LFT.layout().addWidget(event_counter_frame_LFT)
             event_row_LFT.layout().addWidget(reset_event_frame_LFT)
 
+            # fitted lifetime
+            fit_frame_LFT = QFrame()
+            fit_frame_LFT.setLayout(QVBoxLayout())
+            self.fit_display_LFT = QLineEdit()
+            self.fit_display_LFT.setReadOnly(True)
+
+            fit_frame_LFT.layout().addWidget(QLabel("Fitted lifetime"))
+            fit_frame_LFT.layout().addWidget(self.fit_display_LFT)
+
             left_frame_LFT.layout().addWidget(frame_settings_LFT)
             left_frame_LFT.layout().addWidget(event_row_LFT)
+            left_frame_LFT.layout().addWidget(fit_frame_LFT)
 
             # display/plotting widget
             plot_frame_LFT = QFrame()
@@ -553,15 +583,14 @@ class user_interface(QMainWindow):
             plot_frame_LFT.setFrameShape(QFrame.Shape.Panel)
             self.figure_LFT = plt.figure()
             self.display_LFT = FigureCanvas(self.figure_LFT)
-            # empty initial plot
-            ax_LFT = self.figure_LFT.add_subplot(111)
-            ax_LFT.hist([])
-            ax_LFT.set_xlim(left=0)
-            ax_LFT.set_ylim(bottom=0)
-            ax_LFT.set_xlabel("Lifetime (ns)")
-            ax_LFT.set_ylabel("Counts")
-            ax_LFT.grid()
-            self.display_LFT.draw()
+            # empty initial plot, axes and histogram are reused for every update
+            self.live_plot_LFT = MuonLab_live_histogram(
+                self.figure_LFT,
+                self.display_LFT,
+                xlabel="Lifetime (ns)",
+                color=[230 / 255, 25 / 255, 61 / 255],
+                left=0,
+            )
 
             plot_frame_LFT.layout().addWidget(self.display_LFT)
 
@@ -655,14 +684,13 @@ class user_interface(QMainWindow):
             plot_frame_DT.setFrameShape(QFrame.Shape.Panel)
             self.figure_DT = plt.figure()
             self.display_DT = FigureCanvas(self.figure_DT)
-            # empty initial plot
-            ax_DT = self.figure_DT.add_subplot(111)
-            ax_DT.hist([])
-            ax_DT.set_ylim(bottom=0)
-            ax_DT.set_xlabel("Delta time (ns)")
-            ax_DT.set_ylabel("Counts")
-            ax_DT.grid()
-            self.display_DT.draw()
+            # empty initial plot, axes and histogram are reused for every update
+            self.live_plot_DT = MuonLab_live_histogram(
+                self.figure_DT,
+                self.display_DT,
+                xlabel="Delta time (ns)",
+                color=[230 / 255, 25 / 255, 61 / 255],
+            )
 
             plot_frame_DT.layout().addWidget(self.display_DT)
 
@@ -737,7 +765,7 @@ class user_interface(QMainWindow):
             time_disp_frame_WF = QFrame()
             time_disp_frame_WF.setLayout(QVBoxLayout())
             self.time_slider_WF = QSlider(Qt.Orientation.Horizontal)
-            self.time_slider_WF.setRange(14, 99)
+            self.time_slider_WF.setRange(14, WAVEFORM_LENGTH - 1)
             self.time_slider_WF.setValue(50)
             self.time_slider_WF.setTickPosition(QSlider.TickPosition.TicksBelow)
             time_disp_frame_WF.layout().addWidget(QLabel("Time displayed (ns)"))
@@ -759,16 +787,13 @@ class user_interface(QMainWindow):
             plot_frame_WF.setFrameShape(QFrame.Shape.Panel)
             self.figure_WF = plt.figure()
             self.display_WF = FigureCanvas(self.figure_WF)
-            # empty initial plot
-            ax_WF = self.figure_WF.add_subplot(111)
-            ax_WF.set_facecolor((0, 0, 0))
-            ax_WF.plot([0], [0])
-            ax_WF.set_xlim(left=0)
-            ax_WF.set_ylim(300, 0)
-            ax_WF.set_xlabel("Time (ns)")
-            ax_WF.set_ylabel("Amplitude (mV)")
-            ax_WF.grid()
-            self.display_WF.draw()
+            # empty initial plot, axes and lines are reused for every update
+            self.live_plot_WF = MuonLab_live_waveform(
+                self.figure_WF,
+                self.display_WF,
+                color=[230 / 255, 25 / 255, 61 / 255],
+                threshold_color=[150 / 255, 25 / 255, 61 / 255],
+            )
 
             plot_frame_WF.layout().addWidget(self.display_WF)
 
@@ -1074,13 +1099,26 @@ class user_interface(QMainWindow):
             except:
                 pass
 
-            # close connection if a connection is already established
-            self.experiment.device.close()
+            # the measuring loop reads the events of the engine until it
+            # stops, the engine can only be closed afterwards
+            self.main_thread.join()
+
+            # close connection if a connection is already established, and
+            # remove the files holding its events
+            self.experiment.close()
 
         # initialise MuonLab III if right port is chosen and
         # initialise threading
         try:
-            self.experiment = MuonLab_experiment(port=self.device)
+            # the port is read in a separate process, plotting can not delay it
+            self.experiment = MuonLab_engine_experiment(port=self.device)
+
+            # histograms start empty for a new device
+            self.histogram_LFT.clear()
+            self.histogram_DT.clear()
+            self.fit_LFT.reset()
+            self.events_added_LFT = 0
+            self.events_added_DT = 0
 
             self.status_indicator.setText("CONNECTED")
             self.left_voltage.setText("300.0")
@@ -1173,9 +1211,11 @@ class user_interface(QMainWindow):
         """
 
         if self.experiment != None:
-            filename, _ = QFileDialog.getSaveFileName(filter="CSV files (*.csv)")
+            filename, _ = QFileDialog.getSaveFileName(
+                filter="CSV files (*.csv);;MuonLab runs (*.muonlab)"
+            )
             self.experiment.filename = filename
-            self.experiment.save_data()
+            self.experiment.export_data()
 
     def box_counts_1_func(self):
         """
@@ -1321,18 +1361,14 @@ class user_interface(QMainWindow):
         
         """
         try:
-            self.experiment.lifetimes = []
+            self.experiment.reset_lifetimes()
+            self.histogram_LFT.clear()
+            self.fit_LFT.reset()
+            self.events_added_LFT = len(self.experiment.total_lifetimes)
 
             # plot empty histogram
-            self.figure_LFT.clear()
-            ax = self.figure_LFT.add_subplot(111)
-            ax.hist([])
-            plt.xlim(left=0)
-            plt.ylim(bottom=0)
-            plt.xlabel("Lifetime (ns)")
-            plt.ylabel("Counts")
-            plt.grid()
-            self.display_LFT.draw()
+            self.live_plot_LFT.clear()
+            self.fit_display_LFT.setText("")
         except:
             pass
 
@@ -1343,30 +1379,22 @@ class user_interface(QMainWindow):
         """
 
         try:
-            # get values
-            lifetimes = self.experiment.lifetimes
-            bins = int(self.bins_dropper_LFT.currentText())
-            x_max = self.slider_LFT.value() * 100
-
-            # plot values in histogram
-            self.figure_LFT.clear()
-            ax_LFT = self.figure_LFT.add_subplot(111)
-            ax_LFT.hist(
-                lifetimes,
-                color=[230 / 255, 25 / 255, 61 / 255],
-                edgecolor="black",
-                linewidth=0.5,
-                bins=bins,
+            # add lifetimes measured since previous update to histogram, fit
+            # and plot it
+            total_lifetimes = self.experiment.total_lifetimes
+            update_lifetime_plot(
+                self.live_plot_LFT,
+                self.histogram_LFT,
+                self.fit_LFT,
+                total_lifetimes[self.events_added_LFT :],
+                bins=int(self.bins_dropper_LFT.currentText()),
+                x_max=self.slider_LFT.value() * 100,
             )
-            ax_LFT.set_xlim(0, x_max)
-            ax_LFT.set_ylim(bottom=0)
-            ax_LFT.set_xlabel("Lifetime (ns)")
-            ax_LFT.set_ylabel("Counts")
-            ax_LFT.grid()
-            self.display_LFT.draw()
-
-            # update total events count
-            self.event_display_LFT.setText(str(len(lifetimes)))
+            self.events_added_LFT = len(total_lifetimes)
+
+            # update total events count and fitted lifetime
+            self.event_display_LFT.setText(str(self.histogram_LFT.count))
+            self.fit_display_LFT.setText(str(self.fit_LFT))
         except:
             pass
 
@@ -1426,18 +1454,12 @@ class user_interface(QMainWindow):
         """
 
         try:
-            self.experiment.delta_times = []
+            self.experiment.reset_delta_times()
+            self.histogram_DT.clear()
+            self.events_added_DT = len(self.experiment.total_delta_times)
 
             # plot empty histogram
-            self.figure_DT.clear()
-            ax = self.figure_DT.add_subplot(111)
-            ax.hist([])
-            plt.xlim(left=0)
-            plt.ylim(bottom=0, top=1)
-            plt.xlabel("Delta time (ns)")
-            plt.ylabel("Counts")
-            plt.grid()
-            self.display_DT.draw()
+            self.live_plot_DT.clear()
         except:
             pass
 
@@ -1447,25 +1469,17 @@ class user_interface(QMainWindow):
         
         """
 
-        # get values
-        delta_times = self.experiment.delta_times
+        # add delta times measured since previous update to histogram
+        total_delta_times = self.experiment.total_delta_times
+        self.histogram_DT.add(total_delta_times[self.events_added_DT :])
+        self.events_added_DT = len(total_delta_times)
+
+        # bins over range of measured values are made from the histogram
         bins = int(self.bins_dropper_DT.currentText())
+        counts, edges = self.histogram_DT.rebin(bins)
 
         # plot values in histogram
-        self.figure_DT.clear()
-        ax_DT = self.figure_DT.add_subplot(111)
-        ax_DT.hist(
-            delta_times,
-            color=[230 / 255, 25 / 255, 61 / 255],
-            edgecolor="black",
-            linewidth=0.5,
-            bins=bins,
-        )
-        ax_DT.set_ylim(bottom=0)
-        ax_DT.set_xlabel("Delta time (ns)")
-        ax_DT.set_ylabel("Counts")
-        ax_DT.grid()
-        self.display_DT.draw()
+        self.live_plot_DT.update(counts, edges)
 
     ##########
 
@@ -1480,6 +1494,8 @@ class user_interface(QMainWindow):
         try:
             # set MuonLab to return the digitised input signal of channel 1
             self.experiment.set_measurement(waveform=True)
+            # start a new persistence image
+            self.experiment.reset_waveforms()
 
             # create timer to update plot
             self.signal_timer = QTimer()
@@ -1505,16 +1521,7 @@ class user_interface(QMainWindow):
             self.experiment.set_measurement(waveform=False)
 
             # clear plot
-            self.figure_WF.clear()
-            ax_WF = self.figure_WF.add_subplot(111)
-            ax_WF.set_facecolor((0, 0, 0))
-            ax_WF.plot([0], [0])
-            ax_WF.set_xlim(left=0)
-            ax_WF.set_ylim(300, 0)
-            ax_WF.set_xlabel("Time (ns)")
-            ax_WF.set_ylabel("Amplitude (mV)")
-            ax_WF.grid()
-            self.display_WF.draw()
+            self.live_plot_WF.clear()
 
             # update status display
             self.status_display_WF.setText("STOPPED")
@@ -1538,28 +1545,20 @@ class user_interface(QMainWindow):
         # offset from zero is put in manually
         threshold_value = self.left_slider_TL.value()
         signal_data = total_waveform[pre_trigger:time_to_display]
+        # nothing to plot until a signal has been received
+        if len(signal_data) < n_steps:
+            return
 
         x_data = np.arange(0, n_steps) * 5
 
-        # plot values
-        self.figure_WF.clear()
-        ax_WF = self.figure_WF.add_subplot(111)
-        ax_WF.set_facecolor((0, 0, 0))
-        # plot data
-        ax_WF.plot(x_data, signal_data, color=[230 / 255, 25 / 255, 61 / 255])
-        # plot threshold as straight line
-        ax_WF.plot(
-            [0, x_data[-1]],
-            [threshold_value, threshold_value],
-            color=[150 / 255, 25 / 255, 61 / 255],
-        )
-        ax_WF.plot
-        ax_WF.set_ylim(300, 0)
-        ax_WF.set_xlim(0, x_data[-1])
-        ax_WF.set_xlabel("Time (ns)")
-        ax_WF.set_ylabel("Amplitude (mV)")
-        ax_WF.grid()
-        self.display_WF.draw()
+        # persistence and mean of all signals since the start, costs the same
+        # for any number of signals
+        accumulator = self.experiment.waveform_accumulator
+        occupancy = accumulator.occupancy[:, pre_trigger:time_to_display]
+        mean = accumulator.mean[pre_trigger:time_to_display]
+
+        # plot values and threshold as straight line
+        self.live_plot_WF.update(x_data, signal_data, threshold_value, occupancy, mean)
 
     ##########
 
@@ -1762,6 +1761,13 @@ class user_interface(QMainWindow):
         
         """
 
+        # write all data measured since the last save to the .csv file
+        try:
+            if self.experiment.start_save == True:
+                self.experiment.export_data()
+        except:
+            pass
+
         # set all MuonLab settings back to default and close measuring loop
         try:
             self.experiment.run_measurements = False
@@ -1774,13 +1780,13 @@ class user_interface(QMainWindow):
 
         # close thread
         try:
-            self.main_thread.close()
+            self.main_thread.join()
         except:
             pass
 
-        # close off serial connection to port
+        # close off serial connection to port and remove the event files
         try:
-            self.experiment.device.close()
+            self.experiment.close()
         except:
             pass
 
@@ -0,0 +1,201 @@
+"""
+Compact storage of measured events, in memory or in a memory mapped file.
+
+"""
+
+import tempfile
+
+import numpy as np
+
+
+class MuonLab_event_buffer:
+    """
+    Growable array of events of a single type. Capacity doubles whenever it
+    runs out, so adding events costs amortised O(1) per event, and all events
+    are stored as one typed array instead of a list of Python objects.
+
+    Measurements shown in the GUI can be reset without losing data: reset()
+    only moves an offset, current() returns the events since the last reset
+    and total() returns all events.
+
+    Events can be added from one thread while others read them. Views are
+    taken without copying and stay valid when the buffer grows.
+
+    """
+
+    def __init__(self, dtype, capacity=1024):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+        self.reset_offset = 0
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, values):
+        """
+        Adds events to the end of the buffer.
+
+        """
+
+        values = np.asarray(values, dtype=self.data.dtype)
+        new_size = self.size + len(values)
+
+        if new_size > len(self.data):
+            capacity = max(len(self.data), 1)
+            while capacity < new_size:
+                capacity *= 2
+            self.grow(capacity)
+
+        # size is updated last, so readers never see unwritten events
+        self.data[self.size : new_size] = values
+        self.size = new_size
+
+    def grow(self, capacity):
+        """
+        Replaces the storage by one of the given capacity holding the same
+        events. Views on the old storage keep their events.
+
+        """
+
+        data = np.empty(capacity, dtype=self.data.dtype)
+        data[: self.size] = self.data[: self.size]
+        self.data = data
+
+    def view(self, start=0, stop=None):
+        """
+        Returns events from start to stop as a view on the buffer.
+
+        """
+
+        # size is read before data, so all events up to size are in data
+        size = self.size
+        data = self.data
+        if stop is None or stop > size:
+            stop = size
+
+        return data[start:stop]
+
+    def current(self):
+        """
+        Returns all events added since the last reset.
+
+        """
+
+        return self.view(self.reset_offset)
+
+    def total(self):
+        """
+        Returns all events.
+
+        """
+
+        return self.view(0)
+
+    def reset(self):
+        """
+        Starts a new current measurement. Events remain in total().
+
+        """
+
+        self.reset_offset = self.size
+
+
+def select_time_window(values, timestamps, start=None, stop=None):
+    """
+    Returns the values, and their timestamps, with start <= timestamp < stop.
+    The timestamps must be sorted, the window is found by binary search, so
+    only a few of them are read, also from memory mapped files.
+
+    Arguments:
+        values: array of values
+        timestamps: array of the same length with the time of each value
+        start: start of the window, in the unit of the timestamps, None for
+            no start
+        stop: end of the window, None for no end
+
+    Returns:
+        values: view on the values in the window
+        timestamps: view on their timestamps
+
+    """
+
+    first = 0
+    last = len(timestamps)
+    if start is not None:
+        first = np.searchsorted(timestamps, start, side="left")
+    if stop is not None:
+        last = np.searchsorted(timestamps, stop, side="left")
+
+    return values[first:last], timestamps[first:last]
+
+
+def seconds_to_ns(seconds):
+    """
+    Converts seconds to integer ns, None stays None.
+
+    """
+
+    if seconds is None:
+        return None
+
+    return int(round(seconds * 1e9))
+
+
+class MuonLab_mapped_event_buffer(MuonLab_event_buffer):
+    """
+    MuonLab_event_buffer of which the events are kept in a file of fixed
+    size records, mapped into memory with np.memmap. The operating system
+    keeps only the recently used part of the file in memory, so runs of
+    weeks do not fill the memory. Views read the file directly.
+
+    When the file runs out, the events are copied into a new file of double
+    the size, like MuonLab_event_buffer does in memory. A mapped file is never
+    resized, which fails on Windows. Views on the old file stay valid, the
+    operating system keeps it until its last view is gone.
+
+    The file is anonymous scratch space of the running program and is removed
+    when the buffer is closed or deleted, it can not be opened afterwards.
+    Measured events are saved by the run writer, see MuonLab_storage.
+
+    Arguments:
+        dtype: type of the events
+        capacity: number of events the file initially holds
+        directory: directory of the file, the default temporary directory if
+            None
+
+    """
+
+    def __init__(self, dtype, capacity=2**16, directory=None):
+        self.directory = directory
+        self.file = None
+        self.dtype = np.dtype(dtype)
+        self.data = np.empty(0, dtype=self.dtype)
+        self.size = 0
+        self.reset_offset = 0
+        self.grow(capacity)
+
+    def grow(self, capacity):
+        # the new file is sized before it is mapped
+        new_file = tempfile.TemporaryFile(prefix="muonlab_events_", dir=self.directory)
+        new_file.truncate(capacity * self.dtype.itemsize)
+        data = np.memmap(new_file, dtype=self.dtype, mode="r+", shape=(capacity,))
+        data[: self.size] = self.data[: self.size]
+
+        # the mapping keeps its own handle of the old file, so closing it
+        # only removes the file once no view maps it anymore
+        old_file = self.file
+        self.file = new_file
+        self.data = data
+        if old_file is not None:
+            old_file.close()
+
+    def close(self):
+        """
+        Removes the file. Views on the buffer must not be used afterwards.
+
+        """
+
+        self.data = np.empty(0, dtype=self.dtype)
+        self.size = 0
+        self.reset_offset = 0
+        self.file.close()
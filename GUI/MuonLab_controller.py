@@ -1,10 +1,23 @@
 import threading
+import time
 import serial
 import serial.tools.list_ports
-import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime
 from pathlib import Path
 
+import numpy as np
+
+from MuonLab_buffers import (
+    MuonLab_mapped_event_buffer,
+    seconds_to_ns,
+    select_time_window,
+)
+from MuonLab_decoder import MuonLab_frame_decoder
+from MuonLab_reader import READ_TIMEOUT, MuonLab_serial_reader
+from MuonLab_recording import MuonLab_recording_device
+from MuonLab_storage import TIMESTAMP_SUFFIX, open_run_writer
+from MuonLab_waveforms import MuonLab_waveform_accumulator, MuonLab_waveform_ring
+
 
 class MuonLab_experiment:
     """
@@ -13,8 +26,11 @@ class MuonLab_experiment:
     
     """
 
-    def __init__(self, port):
-        self.device = serial.Serial(port)
+    def __init__(self, port, device=None):
+        # an already opened device, e.g. an emulator, can be given instead of a port
+        if device is None:
+            device = serial.Serial(port, timeout=READ_TIMEOUT)
+        self.device = device
 
         # set initial settings of setup. see "Message Protocol MuonLab III.pdf" on wiki
         self.device.write(
@@ -33,12 +49,26 @@ class MuonLab_experiment:
             b"\x99\x10\x55\x66"
         )  # Set offset ADC CH1 offset = (nBit/255)*380mV x55=d85 = 126 mV
         self.device.write(b"\x99\x20\x08\x66")  # Enable USB for data reception
-        # flush buffer to avoid overflowing
-        self.flush_input()
+
+        # byte values of the settings written to the device, saved with binary runs
+        self.settings = {
+            "HV ch1": 0x00,
+            "HV ch2": 0x00,
+            "Threshold ch1": 0x97,
+            "Threshold ch2": 0x97,
+            "Offset ADC ch1": 0x55,
+            "Selection": 0x08,
+        }
+
+        # decodes raw bytes read from the device
+        self.decoder = MuonLab_frame_decoder()
+        # reads the device in its own thread while measuring, see data_acquisition
+        self.reader = None
 
         # set saving data to true
         self.start_save = False
         self.filename = None
+        self.writer = None
 
         # set all possible measurements to inactive initially
         self.measure_lifetime = 0
@@ -49,14 +79,23 @@ class MuonLab_experiment:
 
         ##### DATA LISTS #####
 
-        # lifetime data
-        self.lifetimes = []
-
-        # delta time data
-        self.delta_times = []
-
-        # digitised input signal
-        self.input_signal = []
+        # lifetime and delta time data are kept in a single buffer each, see
+        # the lifetimes and total_lifetimes properties. the buffers are memory
+        # mapped files, so long runs do not fill the memory
+        # lifetimes are multiples of 10 ns up to 655350 ns
+        self.lifetime_buffer = MuonLab_mapped_event_buffer(np.int32)
+        # delta times are multiples of 0.5 ns up to 32767.5 ns, exact as float32
+        self.delta_time_buffer = MuonLab_mapped_event_buffer(np.float32)
+        # time each lifetime and delta time was received, in ns since the
+        # start of the run, see events_in_window
+        self.lifetime_time_buffer = MuonLab_mapped_event_buffer(np.int64)
+        self.delta_time_time_buffer = MuonLab_mapped_event_buffer(np.int64)
+        self.start_time_ns = time.monotonic_ns()
+
+        # digitised input signals, the most recent ones are kept, and the mean
+        # and persistence of all of them since the last reset
+        self.waveforms = MuonLab_waveform_ring()
+        self.waveform_accumulator = MuonLab_waveform_accumulator()
 
         # hit rate data
         # counter to help with calculating average while saving
@@ -74,13 +113,8 @@ class MuonLab_experiment:
 
         ##### TOTAL DATA FOR SAVING #####
         # total data objects are created to prevent accidental data loss
-        # when for example resetting a measurement in the GUI
-
-        # lifetime data
-        self.total_lifetimes = []
-
-        # delta time data
-        self.total_delta_times = []
+        # when for example resetting a measurement in the GUI. lifetimes and
+        # delta times are only reset up to an offset in their buffers
 
         # hit rate data
         # counter to help with calculating average while saving
@@ -94,6 +128,112 @@ class MuonLab_experiment:
         # coincident data
         self.coincidences_total = 0
 
+    @property
+    def input_signal(self):
+        """
+        Returns the most recent digitised input signal as a view on the
+        waveform ring, empty if none was received.
+
+        """
+
+        return self.waveforms.latest()
+
+    @property
+    def lifetimes(self):
+        """
+        Lifetimes in ns measured since the last reset, as array view.
+
+        """
+
+        return self.lifetime_buffer.current()
+
+    @property
+    def total_lifetimes(self):
+        """
+        All lifetimes in ns measured, as array view.
+
+        """
+
+        return self.lifetime_buffer.total()
+
+    @property
+    def delta_times(self):
+        """
+        Delta times in ns measured since the last reset, as array view.
+
+        """
+
+        return self.delta_time_buffer.current()
+
+    @property
+    def total_delta_times(self):
+        """
+        All delta times in ns measured, as array view.
+
+        """
+
+        return self.delta_time_buffer.total()
+
+    def reset_lifetimes(self):
+        """
+        Resets lifetimes displayed, all lifetimes are kept for saving.
+
+        """
+
+        self.lifetime_buffer.reset()
+        self.lifetime_time_buffer.reset()
+
+    def reset_delta_times(self):
+        """
+        Resets delta times displayed, all delta times are kept for saving.
+
+        """
+
+        self.delta_time_buffer.reset()
+        self.delta_time_time_buffer.reset()
+
+    def events_in_window(self, event_type, start=None, stop=None):
+        """
+        Returns the lifetimes or delta times received in a time window of the
+        run. The window is found by binary search on the timestamps, so the
+        whole run is not scanned.
+
+        Arguments:
+            event_type: "lifetime" or "delta_time"
+            start: start of the window, seconds since the start of the run,
+                None for all events received before stop
+            stop: end of the window, None for up to now
+
+        Returns:
+            values: the events in the window
+            times: the time each event was received, ns since the start of the run
+
+        """
+
+        buffers = {
+            "lifetime": (self.lifetime_buffer, self.lifetime_time_buffer),
+            "delta_time": (self.delta_time_buffer, self.delta_time_time_buffer),
+        }
+        value_buffer, time_buffer = buffers[event_type]
+
+        # events may be added while reading, only complete pairs are used
+        size = min(len(value_buffer), len(time_buffer))
+
+        return select_time_window(
+            value_buffer.view(0, size),
+            time_buffer.view(0, size),
+            seconds_to_ns(start),
+            seconds_to_ns(stop),
+        )
+
+    def reset_waveforms(self):
+        """
+        Starts a new mean and persistence of the digitised input signals.
+
+        """
+
+        self.waveform_accumulator.reset()
+
     def set_value_PMT_1(self, value):
         """
         Changes voltage over PMT 1. Value provided should be in range(0,254), 254 
@@ -101,10 +241,9 @@ class MuonLab_experiment:
         
         """
 
-        self.flush_input()
-
         message = b"\x99" + b"\x14" + bytes([value]) + b"\x66"
         self.device.write(message)
+        self.settings["HV ch1"] = value
 
     def set_value_PMT_2(self, value):
         """
@@ -113,10 +252,9 @@ class MuonLab_experiment:
         
         """
 
-        self.flush_input()
-
         message = b"\x99" + b"\x15" + bytes([value]) + b"\x66"
         self.device.write(message)
+        self.settings["HV ch2"] = value
 
     def set_threshold_ch_1(self, value):
         """
@@ -125,10 +263,9 @@ class MuonLab_experiment:
         
         """
 
-        self.flush_input()
-
         message = b"\x99" + b"\x16" + bytes([value]) + b"\x66"
         self.device.write(message)
+        self.settings["Threshold ch1"] = value
 
     def set_threshold_ch_2(self, value):
         """
@@ -137,10 +274,9 @@ class MuonLab_experiment:
         
         """
 
-        self.flush_input()
-
         message = b"\x99" + b"\x17" + bytes([value]) + b"\x66"
         self.device.write(message)
+        self.settings["Threshold ch2"] = value
 
     def set_measurement(
         self, lifetime=None, delta_time=None, waveform=None, coincidence=None
@@ -191,6 +327,7 @@ class MuonLab_experiment:
         # write message to MuonLab III
         message = b"\x99" + b"\x20" + bytes([selection_byte_value_decimal]) + b"\x66"
         self.device.write(message)
+        self.settings["Selection"] = selection_byte_value_decimal
 
     def data_acquisition(self):
         """
@@ -203,155 +340,249 @@ class MuonLab_experiment:
         
         """
 
-        # flush input if too many bytes are queued to avoid overflow
-        self.flush_input()
+        # data queued before the start is decoded too, nothing is discarded.
+        # bytes that can not be decoded are counted as lost
+        self.decoder.reset()
 
-        # save time for saving intervals
-        self.start_time_measurements = datetime.now()
-        self.start_time_interval = datetime.now()
-        self.save_interval = timedelta(seconds=30)
+        # the port is read in a separate thread, so decoding and saving here
+        # never delay reading it. a backlog is drained at full speed
+        # events are timed from here, before the first chunk is read
+        self.start_autosave()
+
+        self.reader = MuonLab_serial_reader(self.device)
+        self.reader.start()
 
         # runs continuously
         while self.run_measurements == True:
-            # check for beginning of a data message
-            byte_1 = self.device.read(1)
-            if byte_1 == b"\x99":
-
-                ##### DATA TYPES #####
-                # check identifier of running data message to determine data type
-                byte_2 = self.device.read(1)
-
-                # DIGITISED INPUT SIGNAL
-                if byte_2 == b"\xC5":
-
-                    # true data is 2000 bytes but signal is located in first 100
-                    data_bytes = self.device.read(100)
-                    self.input_signal = list(data_bytes)
-
-                # HIT RATES(always active)
-                if byte_2 == b"\x35":
-
-                    self.hit_byte_counter += 1
-                    self.hit_byte_counter_total += 1
-
-                    bytes_ch2 = self.device.read(2)
-                    hit_ch2 = int.from_bytes(bytes_ch2, byteorder="big")
-                    bytes_ch1 = self.device.read(2)
-                    hit_ch1 = int.from_bytes(bytes_ch1, byteorder="big")
-
-                    # ch1
-                    self.hits_ch1_last_10.append(hit_ch1)
-                    del self.hits_ch1_last_10[0]
-                    # use previous average and total values counted to avoid creating large list
-                    self.hits_ch1_avg = (
-                        self.hits_ch1_avg * (self.hit_byte_counter - 1) + hit_ch1
-                    ) / self.hit_byte_counter
-                    self.hits_ch1_total += hit_ch1
-
-                    self.hits_ch1_avg_total = (
-                        self.hits_ch1_avg_total * (self.hit_byte_counter_total - 1)
-                        + hit_ch1
-                    ) / self.hit_byte_counter_total
-                    self.hits_ch1_total_all_time += hit_ch1
-
-                    # ch2
-                    self.hits_ch2_last_10.append(hit_ch2)
-                    del self.hits_ch2_last_10[0]
-                    self.hits_ch2_avg = (
-                        self.hits_ch2_avg * (self.hit_byte_counter - 1) + hit_ch2
-                    ) / self.hit_byte_counter
-                    self.hits_ch2_total += hit_ch2
-
-                    self.hits_ch2_avg_total = (
-                        self.hits_ch2_avg_total * (self.hit_byte_counter_total - 1)
-                        + hit_ch2
-                    ) / self.hit_byte_counter_total
-                    self.hits_ch2_total_all_time += hit_ch2
-
-                # COINCIDENT HITS
-                if byte_2 == b"\x55":
-
-                    self.coincidences += 1
-
-                    self.coincidences_total += 1
-
-                # LIFETIME
-                # TODO: A7 is ch2
-                if byte_2 == b"\xA5":
-
-                    # read and convert next 2 bytes corresponding to time
-                    bytes_value = self.device.read(2)
-                    int_value = int.from_bytes(bytes_value, byteorder="big")
-                    # step size = 10 ns
-                    time_value = int_value * 10
-                    self.lifetimes.append(time_value)
-                    self.total_lifetimes.append(time_value)
-
-                # DELTA TIME
-                if byte_2 == b"\xB5" or byte_2 == b"\xB7":
-
-                    bytes_time = self.device.read(2)
-                    value_time = int.from_bytes(bytes_time, byteorder="big") * 0.5
-                    # if identifier == b\'xB7' detector 2 was hit first so time should be reversed
-                    if byte_2 == b"\xB7":
-                        value_time *= -1
-                    self.delta_times.append(value_time)
-                    self.total_delta_times.append(value_time)
-
-            # save data every set time interval if measuring
-            if self.start_save == True:
-                self.current_time = datetime.now()
-                if (self.current_time - self.start_time_interval) > self.save_interval:
-                    try:
-                        self.save_data()
-                    except:
-                        pass
-
-                    # reset interval timer
-                    self.start_time_interval = datetime.now()
-
-    def flush_input(self):
-        """ 
-        Flush device if buffer is too full to avoid overfilling
-
-        """
-
-        if self.device.inWaiting() > 65000:
-            self.device.flushInput()
+            # decode all chunks read since the previous pass at once
+            chunks = self.reader.get(timeout=0.1)
+            batch = self.decoder.feed_chunks(chunks)
+            self.process_batch(batch)
+            self.autosave()
+
+        self.reader.stop()
+
+    def start_autosave(self, interval=30):
+        """
+        Starts the run time, from which event timestamps are counted, and the
+        autosave interval timer.
+
+        Arguments:
+            interval: seconds between two autosaves
+
+        """
+
+        self.start_time_measurements = datetime.now()
+        self.start_time_ns = time.monotonic_ns()
+        self.save_interval = interval
+        # monotonic, so changes of the system clock do not affect saving
+        self.next_save = time.monotonic() + interval
+
+    def autosave(self):
+        """
+        Saves data every set time interval if measuring. Called once per
+        decoded chunk, not per byte.
+
+        """
+
+        if self.start_save == True and time.monotonic() >= self.next_save:
+            try:
+                self.save_data()
+            except:
+                pass
+
+            # reset interval timer
+            self.next_save = time.monotonic() + self.save_interval
+
+    def transfer_summary(self):
+        """
+        Returns the number of bytes received and the number that could not be
+        decoded, as saved in the summary file.
+
+        """
+
+        return {
+            "Bytes received": self.decoder.bytes_received,
+            "Bytes lost": self.decoder.bytes_lost,
+            "Data complete": self.decoder.data_complete,
+        }
+
+    def reader_status(self):
+        """
+        Returns statistics of the queue between reading and decoding, see
+        MuonLab_serial_reader. Empty if not measuring. Raises the error that
+        stopped reading the port, if any.
+
+        """
+
+        if self.reader is None:
+            return {}
+
+        self.reader.raise_error()
+        return self.reader.status()
+
+    def process_batch(self, batch):
+        """
+        Adds all data decoded from one chunk of raw bytes to the measurements.
+
+        Arguments:
+            batch: MuonLab_data_batch as returned by MuonLab_frame_decoder.feed
+
+        """
+
+        # DIGITISED INPUT SIGNAL
+        self.waveforms.add(batch.signals)
+        self.waveform_accumulator.add(batch.signals)
+
+        # HIT RATES(always active)
+        for hit_ch1, hit_ch2 in zip(batch.hits_ch1.tolist(), batch.hits_ch2.tolist()):
+
+            self.hit_byte_counter += 1
+            self.hit_byte_counter_total += 1
+
+            # ch1
+            self.hits_ch1_last_10.append(hit_ch1)
+            del self.hits_ch1_last_10[0]
+            # use previous average and total values counted to avoid creating large list
+            self.hits_ch1_avg = (
+                self.hits_ch1_avg * (self.hit_byte_counter - 1) + hit_ch1
+            ) / self.hit_byte_counter
+            self.hits_ch1_total += hit_ch1
+
+            self.hits_ch1_avg_total = (
+                self.hits_ch1_avg_total * (self.hit_byte_counter_total - 1) + hit_ch1
+            ) / self.hit_byte_counter_total
+            self.hits_ch1_total_all_time += hit_ch1
+
+            # ch2
+            self.hits_ch2_last_10.append(hit_ch2)
+            del self.hits_ch2_last_10[0]
+            self.hits_ch2_avg = (
+                self.hits_ch2_avg * (self.hit_byte_counter - 1) + hit_ch2
+            ) / self.hit_byte_counter
+            self.hits_ch2_total += hit_ch2
+
+            self.hits_ch2_avg_total = (
+                self.hits_ch2_avg_total * (self.hit_byte_counter_total - 1) + hit_ch2
+            ) / self.hit_byte_counter_total
+            self.hits_ch2_total_all_time += hit_ch2
+
+        # COINCIDENT HITS
+        self.coincidences += batch.coincidences
+        self.coincidences_total += batch.coincidences
+
+        # LIFETIME
+        # the time is added first, so a value always has its time
+        self.lifetime_time_buffer.extend(batch.lifetime_times - self.start_time_ns)
+        self.lifetime_buffer.extend(batch.lifetimes)
+
+        # DELTA TIME
+        self.delta_time_time_buffer.extend(
+            batch.delta_time_times - self.start_time_ns
+        )
+        self.delta_time_buffer.extend(batch.delta_times)
+
+    def start_recording(self, path):
+        """
+        Writes all bytes read from the device to a raw log from now on, see
+        MuonLab_recording.
+
+        """
+
+        self.stop_recording()
+        self.device = MuonLab_recording_device(self.device, path)
+        if self.reader is not None:
+            self.reader.device = self.device
+
+    def stop_recording(self):
+        """
+        Closes the raw log, if one is being written.
+
+        """
+
+        if isinstance(self.device, MuonLab_recording_device):
+            self.device.stop()
+            self.device = self.device.device
+            if self.reader is not None:
+                self.reader.device = self.device
 
     def save_data(self):
         """
-        Saves measured lifetimes, coincidences, hit rates and delta 
-        times in a .csv file.
-        
+        Saves measured lifetimes, coincidences, hit rates and delta
+        times. Only events measured since the previous save are appended to
+        the events file, the totals are kept in a summary file. See
+        MuonLab_run_writer, or MuonLab_binary_run_writer if the filename ends
+        in .muonlab.
+
         """
 
+        # start new files whenever the filename is changed
+        if self.writer is None or self.writer.filename != f"{self.filename}":
+            self.writer = open_run_writer(self.filename, self.settings)
+            self.saved_lifetimes = 0
+            self.saved_delta_times = 0
+
         total_runtime = datetime.now() - self.start_time_measurements
         total_runtime_seconds = total_runtime.total_seconds()
 
-        # make dataframes of all data
-        df_runtime = pd.DataFrame({"Total runtime (s)": [total_runtime_seconds]})
-        df_hits_ch1 = pd.DataFrame({"Hits channel 1": [self.hits_ch1_total_all_time]})
-        df_hits_ch2 = pd.DataFrame({"Hits channel 2": [self.hits_ch2_total_all_time]})
-        df_lifetime = pd.DataFrame({"Lifetimes (ns)": self.total_lifetimes})
-        df_delta_time = pd.DataFrame({"Delta times (ns)": self.total_delta_times})
-        df_coincidence = pd.DataFrame({"Total coincidences": [self.coincidences_total]})
-
-        df_total = pd.concat(
-            [
-                df_runtime,
-                df_hits_ch1,
-                df_hits_ch2,
-                df_lifetime,
-                df_delta_time,
-                df_coincidence,
-            ],
-            axis=1,
+        # append new events
+        n_lifetimes = len(self.lifetime_buffer)
+        n_delta_times = len(self.delta_time_buffer)
+        new_lifetimes = self.lifetime_buffer.view(self.saved_lifetimes, n_lifetimes)
+        new_delta_times = self.delta_time_buffer.view(
+            self.saved_delta_times, n_delta_times
         )
+        # times are added before values, so every value has its time
+        self.writer.append(
+            lifetime=new_lifetimes.tolist(),
+            delta_time=new_delta_times.tolist(),
+            **{
+                "lifetime" + TIMESTAMP_SUFFIX: self.lifetime_time_buffer.view(
+                    self.saved_lifetimes, n_lifetimes
+                ),
+                "delta_time" + TIMESTAMP_SUFFIX: self.delta_time_time_buffer.view(
+                    self.saved_delta_times, n_delta_times
+                ),
+            },
+        )
+        self.saved_lifetimes = n_lifetimes
+        self.saved_delta_times = n_delta_times
+
+        self.writer.write_summary(
+            {
+                "Total runtime (s)": total_runtime_seconds,
+                "Hits channel 1": self.hits_ch1_total_all_time,
+                "Hits channel 2": self.hits_ch2_total_all_time,
+                "Total coincidences": self.coincidences_total,
+                **self.transfer_summary(),
+            }
+        )
+
+    def export_data(self):
+        """
+        Saves all data and writes it to the chosen filename as a single .csv file
+        with one column per data type.
+
+        """
+
+        self.save_data()
+        self.writer.export_csv()
 
-        path = f"{self.filename}"
+    def close(self):
+        """
+        Closes the device and removes the files of the event buffers. The
+        measuring loop has to be stopped first, see data_acquisition.
+
+        """
 
-        df_total.to_csv(f"{path}", index=False)
+        self.device.close()
+        for buffer in [
+            self.lifetime_buffer,
+            self.delta_time_buffer,
+            self.lifetime_time_buffer,
+            self.delta_time_time_buffer,
+        ]:
+            buffer.close()
 
 
 def list_devices():
@@ -0,0 +1,380 @@
+"""
+Decoding of the raw byte stream sent by NIKHEF's MuonLab III. Messages are
+sent in the following format:
+
+    header  identifier  data(length can vary)   end
+    0x99    0x??        0x??                    0x66
+
+For explicit communication protocol see Message Protocol MuonLab III (available on wiki)
+
+"""
+
+import time
+
+import numpy as np
+
+# samples of a digitised input signal, 5 ns apart
+WAVEFORM_LENGTH = 2000
+
+# number of data bytes following each known identifier
+PAYLOAD_LENGTHS = {
+    0xC5: WAVEFORM_LENGTH,  # digitised input signal
+    0x35: 4,  # hit rates ch2, ch1
+    0x55: 0,  # coincidence
+    0xA5: 2,  # lifetime
+    0xB5: 2,  # delta time, ch1 hit first
+    0xB7: 2,  # delta time, ch2 hit first
+}
+
+# lookup tables for every possible identifier. unknown identifiers only
+# consume the identifier byte itself
+KNOWN_IDENTIFIERS = np.zeros(256, dtype=bool)
+CONSUMED_LENGTHS = np.ones(256, dtype=np.int64)
+# bytes of a complete message from header up to and including the end byte
+MESSAGE_LENGTHS = np.zeros(256, dtype=np.int64)
+for identifier, length in PAYLOAD_LENGTHS.items():
+    KNOWN_IDENTIFIERS[identifier] = True
+    CONSUMED_LENGTHS[identifier] = 1 + length
+    MESSAGE_LENGTHS[identifier] = 3 + length
+
+# step sizes of the time values
+LIFETIME_STEP = 10  # ns
+DELTA_TIME_STEP = 0.5  # ns
+
+
+class MuonLab_data_batch:
+    """
+    All data decoded from one chunk of raw bytes, grouped per data type. Every
+    array keeps the order in which the messages arrived.
+
+    Attributes:
+        lifetimes: lifetimes in ns
+        delta_times: delta times in ns, negative if channel 2 was hit first
+        hits_ch1: hits registered on ch1 in the last second, one per hit rate message
+        hits_ch2: hits registered on ch2 in the last second, one per hit rate message
+        coincidences: number of coincidence messages
+        signals: digitised input signals of ch1, one row per message
+
+    The time each event was received is kept in ns of the monotonic clock,
+    one timestamp per event:
+
+        lifetime_times, delta_time_times: of each lifetime and delta time
+        hit_times: of each hit rate message
+        coincidence_times: of each coincidence message
+
+    """
+
+    def __init__(
+        self,
+        lifetimes,
+        delta_times,
+        hits_ch1,
+        hits_ch2,
+        coincidences,
+        signals,
+        lifetime_times=None,
+        delta_time_times=None,
+        hit_times=None,
+        coincidence_times=None,
+    ):
+        self.lifetimes = lifetimes
+        self.delta_times = delta_times
+        self.hits_ch1 = hits_ch1
+        self.hits_ch2 = hits_ch2
+        self.coincidences = coincidences
+        self.signals = signals
+
+        self.lifetime_times = lifetime_times
+        self.delta_time_times = delta_time_times
+        self.hit_times = hit_times
+        self.coincidence_times = coincidence_times
+
+
+def gather_bytes(buffer, starts, length):
+    """
+    Returns a (len(starts), length) array of the bytes following each start offset.
+
+    """
+
+    return buffer[starts[:, None] + np.arange(length)]
+
+
+def find_message_offsets(buffer):
+    """
+    Finds the offsets of all message headers in a buffer, consuming bytes exactly
+    like reading the stream byte by byte would: a 0x99 header is followed by one
+    identifier byte, and only the data of known identifiers is read. The 0x66 end
+    byte is not checked but skipped while searching for the next header.
+
+    Candidate headers are found with a single scan. Since the data of a message
+    can contain 0x99, every candidate points to the first candidate that can
+    follow it, and the chain starting at the first candidate is resolved by
+    pointer doubling in O(log n) array operations.
+
+    Arguments:
+        buffer: uint8 array of raw bytes
+
+    Returns:
+        offsets: offsets of all complete messages with a known identifier
+        consumed: number of bytes that can be discarded from the buffer
+
+    """
+
+    end = len(buffer)
+    candidates = np.flatnonzero(buffer == 0x99)
+    n_candidates = len(candidates)
+    if n_candidates == 0:
+        return candidates, end
+
+    # a header as last byte still needs its identifier
+    identifiers = np.zeros(n_candidates, dtype=np.uint8)
+    has_identifier = candidates + 1 < end
+    identifiers[has_identifier] = buffer[candidates[has_identifier] + 1]
+    message_ends = candidates + 1 + CONSUMED_LENGTHS[identifiers]
+    incomplete = ~has_identifier | (message_ends > end)
+
+    # index of next candidate on the chain, n_candidates marks end of chain
+    sink = n_candidates
+    next_index = np.empty(n_candidates + 1, dtype=np.int64)
+    next_index[:-1] = np.searchsorted(candidates, message_ends, side="left")
+    next_index[:-1][incomplete] = sink
+    next_index[-1] = sink
+
+    # collect all candidates reachable from the first one by doubling the
+    # number of steps followed each iteration. steps taken later always land
+    # on later candidates, so the chain stays sorted
+    reached = np.zeros(1, dtype=np.int64)
+    jump = next_index
+    while True:
+        reached = np.concatenate((reached, jump[reached]))
+        if np.all(jump[reached] == sink):
+            break
+        jump = jump[jump]
+    chain = reached[reached != sink]
+
+    # an incomplete message can only be the last one on the chain
+    consumed = end
+    if len(chain) > 0 and incomplete[chain[-1]]:
+        consumed = int(candidates[chain[-1]])
+        chain = chain[:-1]
+
+    offsets = candidates[chain[KNOWN_IDENTIFIERS[identifiers[chain]]]]
+
+    return offsets, consumed
+
+
+def decode_buffer(buffer, offsets, message_times=None):
+    """
+    Decodes all messages at the given offsets at once.
+
+    Arguments:
+        buffer: uint8 array of raw bytes
+        offsets: offsets of complete messages as returned by find_message_offsets
+        message_times: time each message was received, given to the events
+            decoded from it. None leaves the events without a timestamp
+
+    Returns:
+        batch: MuonLab_data_batch holding all decoded data
+
+    """
+
+    identifiers = buffer[offsets + 1]
+    data_starts = offsets + 2
+
+    # LIFETIME
+    # TODO: A7 is ch2
+    starts = data_starts[identifiers == 0xA5]
+    raw = gather_bytes(buffer, starts, 2).view(">u2").ravel()
+    # step size = 10 ns
+    lifetimes = raw.astype(np.int64) * LIFETIME_STEP
+
+    # DELTA TIME
+    is_delta = (identifiers == 0xB5) | (identifiers == 0xB7)
+    starts = data_starts[is_delta]
+    raw = gather_bytes(buffer, starts, 2).view(">u2").ravel()
+    delta_times = raw * DELTA_TIME_STEP
+    # if identifier == 0xB7 detector 2 was hit first so time should be reversed
+    delta_times[identifiers[is_delta] == 0xB7] *= -1
+
+    # HIT RATES
+    starts = data_starts[identifiers == 0x35]
+    raw = gather_bytes(buffer, starts, 4).view(">u2")
+    hits_ch2 = raw[:, 0].astype(np.int64)
+    hits_ch1 = raw[:, 1].astype(np.int64)
+
+    # COINCIDENT HITS
+    coincidences = int(np.count_nonzero(identifiers == 0x55))
+
+    # DIGITISED INPUT SIGNAL
+    # whole signals are copied at once from a view of all windows of the
+    # buffer, without an index for every sample
+    starts = data_starts[identifiers == 0xC5]
+    if len(starts) > 0:
+        windows = np.lib.stride_tricks.sliding_window_view(buffer, WAVEFORM_LENGTH)
+        signals = windows[starts]
+    else:
+        signals = np.empty((0, WAVEFORM_LENGTH), dtype=np.uint8)
+
+    batch = MuonLab_data_batch(
+        lifetimes, delta_times, hits_ch1, hits_ch2, coincidences, signals
+    )
+    if message_times is not None:
+        batch.lifetime_times = message_times[identifiers == 0xA5]
+        batch.delta_time_times = message_times[is_delta]
+        batch.hit_times = message_times[identifiers == 0x35]
+        batch.coincidence_times = message_times[identifiers == 0x55]
+
+    return batch
+
+
+def count_covered_bytes(buffer, offsets, consumed, unchecked_before=0):
+    """
+    Counts the bytes of the first consumed bytes of a buffer that belong to a
+    complete message with a known identifier. A message is only complete if it
+    ends with the 0x66 end byte the decoder skips, so a message cut short when
+    the device buffer overflowed does not count, even if the bytes after the
+    cut fill it up to its length. All other bytes are lost data.
+
+    The end byte of the last message can be the first byte of the next buffer.
+    The message is then counted as covered and checked with that buffer.
+
+    Arguments:
+        buffer: uint8 array of raw bytes
+        offsets: offsets of messages as returned by find_message_offsets
+        consumed: bytes discarded from the buffer
+        unchecked_before: length of the message of the previous buffer of which
+            the end byte is the first byte of this buffer, 0 if none
+
+    Returns:
+        covered: number of bytes belonging to messages, less than zero if the
+            unchecked message of the previous buffer was not complete
+        unchecked_after: length of the last message if its end byte is the
+            first byte of the next buffer, 0 otherwise
+
+    """
+
+    end = len(buffer)
+    covered = 0
+    if unchecked_before:
+        if end == 0:
+            return 0, unchecked_before
+        if buffer[0] == 0x66:
+            covered = 1
+        else:
+            # the bytes counted with the previous buffer were lost
+            covered = 1 - unchecked_before
+
+    message_lengths = MESSAGE_LENGTHS[buffer[offsets + 1]]
+    end_bytes = offsets + message_lengths - 1
+    received = end_bytes < end
+    complete = ~received | (buffer[np.minimum(end_bytes, end - 1)] == 0x66)
+    covered_lengths = np.minimum(offsets + message_lengths, consumed) - offsets
+    covered += int(covered_lengths[complete].sum())
+
+    unchecked_after = 0
+    if len(offsets) > 0 and not received[-1]:
+        unchecked_after = int(message_lengths[-1])
+
+    return covered, unchecked_after
+
+
+class MuonLab_frame_decoder:
+    """
+    Decodes chunks of raw bytes read from the MuonLab III. Bytes of a message
+    that has not been fully received yet are kept until the next chunk arrives,
+    so chunks can be cut at any position.
+
+    Bytes that are not part of any complete message are counted as lost, e.g.
+    when messages are cut short because the device buffer overflowed:
+
+        bytes_received: bytes fed to the decoder
+        bytes_lost: bytes that did not belong to a complete message
+
+    """
+
+    def __init__(self):
+        self.buffer = b""
+        self.bytes_received = 0
+        self.bytes_lost = 0
+        # length of the last decoded message if its end byte was not received
+        self.unchecked_length = 0
+
+    def feed(self, data, timestamp=None):
+        """
+        Adds a chunk of raw bytes and decodes all messages completed by it.
+
+        Arguments:
+            data: bytes read from the device
+            timestamp: time the bytes were read in ns of the monotonic clock,
+                given to all decoded events. Defaults to now
+
+        Returns:
+            batch: MuonLab_data_batch holding all decoded data
+
+        """
+
+        if timestamp is None:
+            timestamp = time.monotonic_ns()
+
+        return self.feed_chunks([(timestamp, data)])
+
+    def feed_chunks(self, chunks):
+        """
+        Adds several chunks of raw bytes and decodes all messages completed by
+        them at once. Every event gets the time of the chunk its message was
+        completed in.
+
+        Arguments:
+            chunks: list of (time read in ns of the monotonic clock, bytes),
+                as returned by MuonLab_serial_reader.get
+
+        Returns:
+            batch: MuonLab_data_batch holding all decoded data
+
+        """
+
+        data = b"".join(chunk for _, chunk in chunks)
+        self.bytes_received += len(data)
+        kept = len(self.buffer)
+        if self.buffer:
+            data = self.buffer + data
+        buffer = np.frombuffer(data, dtype=np.uint8)
+
+        offsets, consumed = find_message_offsets(buffer)
+        # keep unconsumed bytes for next chunk
+        self.buffer = bytes(data[consumed:])
+
+        covered, self.unchecked_length = count_covered_bytes(
+            buffer, offsets, consumed, self.unchecked_length
+        )
+        self.bytes_lost += consumed - covered
+
+        # a message is complete once its last data byte was read. kept bytes
+        # never hold a complete message, so it always ends in a new chunk
+        chunk_ends = kept + np.cumsum([len(chunk) for _, chunk in chunks])
+        chunk_times = np.array([timestamp for timestamp, _ in chunks], dtype=np.int64)
+        last_bytes = offsets + CONSUMED_LENGTHS[buffer[offsets + 1]]
+        chunk_indices = np.searchsorted(chunk_ends, last_bytes, side="right")
+
+        return decode_buffer(buffer, offsets, chunk_times[chunk_indices])
+
+    @property
+    def data_complete(self):
+        """
+        True if no bytes were lost.
+
+        """
+
+        return self.bytes_lost == 0
+
+    def reset(self):
+        """
+        Discards any partially received message and starts counting received
+        and lost bytes from zero.
+
+        """
+
+        self.buffer = b""
+        self.bytes_received = 0
+        self.bytes_lost = 0
+        self.unchecked_length = 0
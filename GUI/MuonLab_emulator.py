@@ -0,0 +1,550 @@
+"""
+Software emulator of NIKHEF's MuonLab III, to run and benchmark the GUI,
+the terminal controller and the decoding without a detector.
+
+The emulator sends the same data messages as the detector:
+
+    header  identifier  data(length can vary)   end
+    0x99    0x??        0x??                    0x66
+
+    0x35: hit rates of ch2 and ch1 in the last second, once per second
+    0x55: coincidence
+    0xA5: lifetime in steps of 10 ns, exponentially distributed
+    0xB5/0xB7: delta time in steps of 0.5 ns, 0xB7 if ch2 was hit first
+    0xC5: digitised input signal of ch1, 2000 samples
+
+and handles the setting messages 0x10 (ADC offset), 0x14/0x15 (high
+voltage), 0x16/0x17 (threshold) and 0x20 (measurement selection). Rates can
+be set far beyond what the detector produces.
+
+It can be used in two ways:
+    - in the same process, by passing a MuonLab_emulated_serial as device
+      to MuonLab_experiment
+    - as a separate program creating a pseudo terminal that can be opened like
+      the USB port of the detector (Linux and macOS):
+
+        python ./GUI/MuonLab_emulator.py
+        python ./terminal_controllers/MuonLab_terminal_controller.py /dev/pts/3 lifetimes
+
+"""
+
+import argparse
+import os
+import select
+import threading
+import time
+
+import numpy as np
+
+from MuonLab_decoder import WAVEFORM_LENGTH
+
+# bits of the measurement selection byte, see MuonLab_experiment.set_measurement
+SELECT_LIFETIME = 1
+SELECT_DELTA_TIME = 2
+SELECT_WAVEFORM = 4
+SELECT_USB = 8
+SELECT_COINCIDENCE = 16
+
+# mean lifetime of muons
+MUON_LIFETIME = 2197  # ns
+
+
+def make_frames(identifier, data):
+    """
+    Wraps rows of data bytes in data messages.
+
+    Arguments:
+        identifier: identifier byte
+        data: (n messages, n data bytes) uint8 array
+
+    Returns:
+        frames: (n messages, n data bytes + 3) uint8 array
+
+    """
+
+    n_frames = len(data)
+    frames = np.empty((n_frames, data.shape[1] + 3), dtype=np.uint8)
+    frames[:, 0] = 0x99
+    frames[:, 1] = identifier
+    frames[:, 2:-1] = data
+    frames[:, -1] = 0x66
+
+    return frames
+
+
+def big_endian_bytes(values):
+    """
+    Converts values to (n values, 2) uint8 array of 2 byte big endian integers.
+
+    """
+
+    values = np.clip(values, 0, 65535).astype(">u2")
+
+    return values.view(np.uint8).reshape(-1, 2)
+
+
+class MuonLab_emulator:
+    """
+    Generates the byte stream of a MuonLab III for any stretch of emulated time.
+
+    Rates are given at full detector efficiency. If model_settings is True,
+    rates follow the high voltage and threshold settings sent to the emulator:
+    hit rates rise along a plateau curve with the high voltage of each PMT
+    and drop with the threshold, and the rates of events that need both
+    detectors drop with the efficiency of both. Otherwise settings are stored,
+    but rates stay as given.
+
+    Arguments:
+        hit_rate: hits per second on each channel
+        coincidence_rate: coincidences per second
+        lifetime_rate: lifetimes per second
+        delta_time_rate: delta times per second
+        waveform_rate: digitised signals per second
+        lifetime_background: fraction of lifetimes that are uniformly
+            distributed background instead of muon decays
+        delta_time_mean: mean delta time in ns
+        delta_time_sigma: spread of delta times in ns
+        noise_rate: hits per second from PMT noise at the highest voltage
+        model_settings: let rates depend on high voltage and threshold
+        seed: seed of random number generator
+
+    """
+
+    def __init__(
+        self,
+        hit_rate=40,
+        coincidence_rate=1,
+        lifetime_rate=0.1,
+        delta_time_rate=1,
+        waveform_rate=2,
+        lifetime_background=0.05,
+        delta_time_mean=3,
+        delta_time_sigma=2,
+        noise_rate=200,
+        model_settings=True,
+        seed=None,
+    ):
+        self.hit_rate = hit_rate
+        self.coincidence_rate = coincidence_rate
+        self.lifetime_rate = lifetime_rate
+        self.delta_time_rate = delta_time_rate
+        self.waveform_rate = waveform_rate
+        self.lifetime_background = lifetime_background
+        self.delta_time_mean = delta_time_mean
+        self.delta_time_sigma = delta_time_sigma
+        self.noise_rate = noise_rate
+        self.model_settings = model_settings
+        self.rng = np.random.default_rng(seed)
+
+        # settings as sent by the setting messages, in bits. the detector starts
+        # with the highest voltage and USB enabled
+        self.settings = {
+            0x10: 0x55,  # ADC offset ch1
+            0x14: 255,  # high voltage PMT ch1
+            0x15: 255,  # high voltage PMT ch2
+            0x16: 101,  # threshold ch1
+            0x17: 101,  # threshold ch2
+            0x20: SELECT_USB,  # measurement selection
+        }
+        self.command_buffer = b""
+
+        # emulated time in s
+        self.time = 0.0
+
+    ##### SETTINGS #####
+    def write(self, data):
+        """
+        Handles setting messages sent to the detector.
+
+        """
+
+        data = self.command_buffer + bytes(data)
+        position = 0
+        while True:
+            position = data.find(b"\x99", position)
+            if position == -1:
+                position = len(data)
+                break
+            # keep incomplete setting message
+            if position + 4 > len(data):
+                break
+            if data[position + 3] == 0x66 and data[position + 1] in self.settings:
+                self.settings[data[position + 1]] = data[position + 2]
+                position += 4
+            else:
+                position += 1
+        self.command_buffer = data[position:]
+
+    def efficiency(self, channel):
+        """
+        Fraction of muons detected on a channel for the current settings.
+
+        """
+
+        if not self.model_settings:
+            return 1.0
+
+        # HV = 300+((nBit/255)*1400), TV = (nBit/255)*380mV
+        voltage = 300 + (self.settings[0x13 + channel] / 255) * 1400
+        threshold = (self.settings[0x15 + channel] / 255) * 380
+
+        efficiency = 1 / (1 + np.exp(-(voltage - 1150) / 60))
+        efficiency /= 1 + np.exp((threshold - 250) / 30)
+
+        return efficiency
+
+    def noise(self, channel):
+        """
+        Hits per second on a channel that are caused by PMT noise.
+
+        """
+
+        if not self.model_settings:
+            return 0.0
+
+        voltage = 300 + (self.settings[0x13 + channel] / 255) * 1400
+        threshold = (self.settings[0x15 + channel] / 255) * 380
+
+        return self.noise_rate * np.exp((voltage - 1700) / 100 - threshold / 50)
+
+    ##### DATA #####
+    def generate(self, duration):
+        """
+        Generates all data messages sent in the next duration seconds of emulated
+        time, in order of arrival.
+
+        Returns:
+            data: bytes sent by the detector
+
+        """
+
+        start = self.time
+        end = start + duration
+        self.time = end
+
+        selection = self.settings[0x20]
+        if not selection & SELECT_USB:
+            return b""
+
+        efficiency_ch1 = self.efficiency(1)
+        efficiency_ch2 = self.efficiency(2)
+        efficiency_both = efficiency_ch1 * efficiency_ch2
+
+        frames = []
+
+        # HIT RATES, sent at the end of every full second
+        seconds = np.arange(np.floor(start) + 1, np.floor(end) + 1)
+        if len(seconds) > 0:
+            rate_ch1 = self.hit_rate * efficiency_ch1 + self.noise(1)
+            rate_ch2 = self.hit_rate * efficiency_ch2 + self.noise(2)
+            hits = np.empty((len(seconds), 4), dtype=np.uint8)
+            hits[:, 0:2] = big_endian_bytes(self.rng.poisson(rate_ch2, len(seconds)))
+            hits[:, 2:4] = big_endian_bytes(self.rng.poisson(rate_ch1, len(seconds)))
+            frames.append((seconds, make_frames(0x35, hits)))
+
+        # COINCIDENT HITS
+        if selection & SELECT_COINCIDENCE:
+            n = self.rng.poisson(self.coincidence_rate * efficiency_both * duration)
+            data = np.empty((n, 0), dtype=np.uint8)
+            frames.append((self.arrival_times(n, start, end), make_frames(0x55, data)))
+
+        # LIFETIME
+        if selection & SELECT_LIFETIME:
+            n = self.rng.poisson(self.lifetime_rate * efficiency_both * duration)
+            lifetimes = self.rng.exponential(MUON_LIFETIME, n)
+            background = self.rng.random(n) < self.lifetime_background
+            lifetimes[background] = self.rng.uniform(0, 20000, background.sum())
+            # step size = 10 ns
+            data = big_endian_bytes(np.round(lifetimes / 10))
+            frames.append((self.arrival_times(n, start, end), make_frames(0xA5, data)))
+
+        # DELTA TIME
+        if selection & SELECT_DELTA_TIME:
+            n = self.rng.poisson(self.delta_time_rate * efficiency_both * duration)
+            delta_times = self.rng.normal(
+                self.delta_time_mean, self.delta_time_sigma, n
+            )
+            # step size = 0.5 ns, 0xB7 if detector 2 was hit first
+            data = big_endian_bytes(np.round(np.abs(delta_times) / 0.5))
+            times = self.arrival_times(n, start, end)
+            first_ch1 = delta_times >= 0
+            frames.append((times[first_ch1], make_frames(0xB5, data[first_ch1])))
+            frames.append((times[~first_ch1], make_frames(0xB7, data[~first_ch1])))
+
+        # DIGITISED INPUT SIGNAL
+        if selection & SELECT_WAVEFORM:
+            n = self.rng.poisson(self.waveform_rate * duration)
+            frames.append(
+                (self.arrival_times(n, start, end), make_frames(0xC5, self.signals(n)))
+            )
+
+        return self.merge(frames)
+
+    def arrival_times(self, n, start, end):
+        return self.rng.uniform(start, end, n)
+
+    def signals(self, n):
+        """
+        Digitised pulses: a baseline set by the ADC offset with an exponentially
+        decaying pulse shortly after the trigger.
+
+        """
+
+        baseline = self.settings[0x10] / 4
+        samples = np.arange(WAVEFORM_LENGTH)
+        start = 10
+        rise = 1 - np.exp(-(samples - start + 1).clip(0) / 1.5)
+        decay = np.where(samples >= start, np.exp(-(samples - start) / 4.0), 0.0)
+        amplitudes = self.rng.uniform(40, 200, (n, 1))
+        noise = self.rng.normal(0, 1.5, (n, WAVEFORM_LENGTH))
+        signals = baseline + amplitudes * rise * decay + noise
+
+        return np.clip(np.round(signals), 0, 255).astype(np.uint8)
+
+    def merge(self, frames):
+        """
+        Joins data messages of all types into a single stream, in order of their
+        arrival times.
+
+        Arguments:
+            frames: list of (arrival times, (n messages, message length) array)
+
+        """
+
+        frames = [(times, data) for times, data in frames if len(data) > 0]
+        if len(frames) == 0:
+            return b""
+
+        times = np.concatenate([times for times, _ in frames])
+        lengths = np.concatenate(
+            [np.full(len(data), data.shape[1]) for _, data in frames]
+        )
+        flat = np.concatenate([data.ravel() for _, data in frames])
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+        # gather the bytes of all messages in order of arrival
+        order = np.argsort(times, kind="stable")
+        sorted_lengths = lengths[order]
+        sorted_starts = np.concatenate(([0], np.cumsum(sorted_lengths)[:-1]))
+        positions = np.arange(sorted_lengths.sum())
+        offsets = positions - np.repeat(sorted_starts, sorted_lengths)
+        indices = np.repeat(starts[order], sorted_lengths) + offsets
+
+        return flat[indices].tobytes()
+
+
+class MuonLab_emulated_serial:
+    """
+    Serial port connected to a MuonLab_emulator, with the parts of the
+    pyserial interface used by MuonLab_experiment and MuonLab_III.
+
+    Arguments:
+        emulator: MuonLab_emulator generating the data
+        speed: emulated seconds per second. None generates data as fast as it is
+            read, chunk_duration emulated seconds at a time
+        chunk_duration: emulated seconds generated at once if speed is None
+        duration: emulated seconds after which no more data is sent
+        timeout: seconds read() waits for data, None waits forever
+
+    """
+
+    def __init__(
+        self,
+        emulator,
+        speed=1.0,
+        chunk_duration=0.01,
+        duration=None,
+        timeout=None,
+    ):
+        self.emulator = emulator
+        self.speed = speed
+        self.chunk_duration = chunk_duration
+        self.duration = duration
+        self.timeout = timeout
+
+        self.buffer = bytearray()
+        self.bytes_sent = 0
+        self.is_open = True
+        self.start_time = time.monotonic()
+
+    @property
+    def finished(self):
+        """
+        True once all data of the set duration has been generated.
+
+        """
+
+        return self.duration is not None and self.emulator.time >= self.duration
+
+    def generate(self):
+        """
+        Adds the data generated since the previous call to the input buffer.
+
+        """
+
+        if self.finished:
+            return
+
+        if self.speed is None:
+            # generate until there is data to read
+            while len(self.buffer) == 0 and not self.finished:
+                self.add(self.chunk_duration)
+        else:
+            elapsed = (time.monotonic() - self.start_time) * self.speed
+            self.add(elapsed - self.emulator.time)
+
+    def add(self, duration):
+        if self.duration is not None:
+            duration = min(duration, self.duration - self.emulator.time)
+        if duration > 0:
+            data = self.emulator.generate(duration)
+            self.buffer += data
+            self.bytes_sent += len(data)
+
+    @property
+    def in_waiting(self):
+        self.generate()
+        return len(self.buffer)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def read(self, size=1):
+        """
+        Reads up to size bytes, waiting up to timeout seconds for data.
+
+        """
+
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+
+        self.generate()
+        while len(self.buffer) < size and not self.finished and self.is_open:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            time.sleep(0.001)
+            self.generate()
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+
+        return len(data)
+
+    def write(self, data):
+        self.emulator.write(data)
+
+        return len(data)
+
+    def reset_input_buffer(self):
+        self.generate()
+        self.buffer.clear()
+
+    def flushInput(self):
+        self.reset_input_buffer()
+
+    def close(self):
+        self.is_open = False
+
+
+def serve_pty(emulator, speed=1.0, interval=0.01):
+    """
+    Creates a pseudo terminal the emulator sends its data to, in real time times
+    speed. Data that is not read is lost once the terminal buffer is full, like
+    on the detector.
+
+    Returns:
+        port: path of the terminal to open as serial port
+        thread: thread running the emulator
+
+    """
+
+    import tty
+
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    os.set_blocking(master, False)
+    port = os.ttyname(slave)
+
+    def run():
+        start_time = time.monotonic()
+        pending = b""
+        while True:
+            # handle setting messages
+            readable, _, _ = select.select([master], [], [], interval)
+            if readable:
+                try:
+                    emulator.write(os.read(master, 4096))
+                except OSError:
+                    pass
+
+            elapsed = (time.monotonic() - start_time) * speed
+            pending += emulator.generate(elapsed - emulator.time)
+            try:
+                written = os.write(master, pending)
+                pending = pending[written:]
+            except BlockingIOError:
+                # terminal buffer full, data is lost
+                pending = b""
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    return port, thread
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Emulate a NIKHEF MuonLab III on a pseudo terminal."
+    )
+    parser.add_argument(
+        "--hit-rate", type=float, default=40, help="hits per second on each channel"
+    )
+    parser.add_argument(
+        "--coincidence-rate", type=float, default=1, help="coincidences per second"
+    )
+    parser.add_argument(
+        "--lifetime-rate", type=float, default=0.1, help="lifetimes per second"
+    )
+    parser.add_argument(
+        "--delta-time-rate", type=float, default=1, help="delta times per second"
+    )
+    parser.add_argument(
+        "--waveform-rate", type=float, default=2, help="digitised signals per second"
+    )
+    parser.add_argument(
+        "--speed", type=float, default=1, help="emulated seconds per second"
+    )
+    parser.add_argument(
+        "--ignore-settings",
+        action="store_true",
+        help="keep rates independent of high voltage and threshold settings",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="random seed")
+    args = parser.parse_args()
+
+    emulator = MuonLab_emulator(
+        hit_rate=args.hit_rate,
+        coincidence_rate=args.coincidence_rate,
+        lifetime_rate=args.lifetime_rate,
+        delta_time_rate=args.delta_time_rate,
+        waveform_rate=args.waveform_rate,
+        model_settings=not args.ignore_settings,
+        seed=args.seed,
+    )
+    port, thread = serve_pty(emulator, speed=args.speed)
+
+    print("Emulated MuonLab III available at: {}".format(port))
+    print("Press Ctrl-C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("")
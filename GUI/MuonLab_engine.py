@@ -0,0 +1,315 @@
+"""
+Acquisition engine running in a process of its own. The engine reads and
+decodes the serial port and sends the decoded data to the GUI process, so
+plotting in the GUI can not slow down reading the port, as it would when both
+share one Python interpreter.
+
+    GUI process                         engine process
+    MuonLab_engine_experiment           run_engine
+        setting messages   -- control pipe -->  written to the port
+        process_batch      <-- ring buffer --   decoded events
+                           <-- event queue --   digitised signals and counters
+
+The events are kept in a ring buffer in shared memory, see
+MuonLab_ring_buffer, which other processes can read as well.
+
+MuonLab_engine_experiment has the same interface as MuonLab_experiment. The
+GUI only has to stop its measuring loop before closing the engine, since the
+loop reads the ring buffer the engine removes.
+
+"""
+
+import multiprocessing
+import queue
+import threading
+import time
+
+import numpy as np
+import serial
+
+from MuonLab_controller import MuonLab_experiment
+from MuonLab_decoder import MuonLab_frame_decoder
+from MuonLab_reader import READ_TIMEOUT, MuonLab_serial_reader
+from MuonLab_recording import MuonLab_recording_device
+from MuonLab_ring_buffer import (
+    RING_NAME,
+    MuonLab_ring_buffer,
+    MuonLab_ring_reader,
+    records_to_batch,
+)
+
+
+def engine_status(decoder, reader):
+    return {
+        "bytes_received": decoder.bytes_received,
+        "bytes_lost": decoder.bytes_lost,
+        "data_complete": decoder.data_complete,
+        "reader": reader.status(),
+    }
+
+
+def run_engine(
+    port, control, events, ring_name, device_factory=None, status_interval=0.5
+):
+    """
+    Main function of the engine process. Reads and decodes the port until the
+    stop command is received, or the GUI process has gone.
+
+    Arguments:
+        port: serial port to open
+        control: connection receiving (command, argument) pairs
+        events: queue to put (message, content, status) triples on
+        ring_name: name of the ring buffer to write the decoded events to
+        device_factory: function returning an opened device to use instead of
+            the port, e.g. an emulator
+        status_interval: seconds between status messages while no data arrives
+
+    """
+
+    try:
+        if device_factory is None:
+            device = serial.Serial(port, timeout=READ_TIMEOUT)
+        else:
+            device = device_factory()
+    except Exception as error:
+        events.put(("error", repr(error), None))
+        return
+
+    # the GUI process created the buffer, this process shares its tracker
+    ring = MuonLab_ring_buffer(ring_name, create=False, track=True)
+    decoder = MuonLab_frame_decoder()
+    reader = MuonLab_serial_reader(device)
+    reader.start()
+    events.put(("ready", None, engine_status(decoder, reader)))
+
+    next_status = time.monotonic() + status_interval
+    running = True
+    while running:
+        # handle settings and other commands of the GUI process
+        try:
+            while control.poll():
+                command, argument = control.recv()
+                if command == "write":
+                    reader.device.write(argument)
+                elif command == "start_recording":
+                    if isinstance(reader.device, MuonLab_recording_device):
+                        reader.device.stop()
+                        reader.device = reader.device.device
+                    reader.device = MuonLab_recording_device(reader.device, argument)
+                elif command == "stop_recording":
+                    if isinstance(reader.device, MuonLab_recording_device):
+                        reader.device.stop()
+                        reader.device = reader.device.device
+                elif command == "stop":
+                    running = False
+        # the GUI process has closed its end of the pipe
+        except (EOFError, OSError):
+            running = False
+
+        try:
+            chunks = reader.get(timeout=0.05)
+        except Exception as error:
+            # reading the port failed, the GUI process raises the error
+            events.put(("error", repr(error), engine_status(decoder, reader)))
+            break
+        if chunks:
+            # every event gets the time its chunk was read
+            batch = decoder.feed_chunks(chunks)
+            ring.write_batch(batch)
+            # digitised signals are not events, they are sent with the message
+            signals = batch.signals if len(batch.signals) > 0 else None
+            events.put(("batch", signals, engine_status(decoder, reader)))
+            next_status = time.monotonic() + status_interval
+        elif time.monotonic() >= next_status:
+            events.put(("status", None, engine_status(decoder, reader)))
+            next_status = time.monotonic() + status_interval
+
+    reader.stop()
+    if isinstance(reader.device, MuonLab_recording_device):
+        reader.device.stop()
+    device.close()
+    ring.close()
+    events.put(("stopped", None, engine_status(decoder, reader)))
+
+
+class MuonLab_engine:
+    """
+    Starts the engine process and is used as device by
+    MuonLab_engine_experiment: messages written to it are sent to the engine,
+    which writes them to the port. Creates the ring buffer the engine writes
+    the decoded events to.
+
+    Arguments:
+        port: serial port to open in the engine process
+        device_factory: function returning an opened device to use instead of
+            the port, must be picklable
+        timeout: seconds to wait for the engine to open the port
+        ring_name: name of the ring buffer, see MuonLab_ring_buffer
+
+    """
+
+    def __init__(self, port, device_factory=None, timeout=10, ring_name=RING_NAME):
+        try:
+            self.ring = MuonLab_ring_buffer(ring_name)
+        except FileExistsError:
+            # left behind by a GUI that did not close properly
+            stale = MuonLab_ring_buffer(ring_name, create=False, track=True)
+            stale.memory.unlink()
+            stale.close()
+            self.ring = MuonLab_ring_buffer(ring_name)
+        self.ring_reader = MuonLab_ring_reader(self.ring.name, track=True)
+
+        # spawn a fresh interpreter, forking a process running Qt is unsafe
+        context = multiprocessing.get_context("spawn")
+        self.control, engine_control = context.Pipe()
+        self.events = context.Queue()
+        self.control_lock = threading.Lock()
+
+        self.process = context.Process(
+            target=run_engine,
+            args=(port, engine_control, self.events, self.ring.name, device_factory),
+            daemon=True,
+        )
+        self.process.start()
+
+        message, content, self.status = self.events.get(timeout=timeout)
+        if message == "error":
+            self.process.join()
+            self.close_ring()
+            raise OSError(f"Could not open port {port}: {content}")
+
+    def send(self, command, argument=None):
+        with self.control_lock:
+            self.control.send((command, argument))
+
+    def write(self, data):
+        self.send("write", bytes(data))
+
+        return len(data)
+
+    def get(self, timeout=None):
+        """
+        Returns the next (message, content, status) triple sent by the engine,
+        None if nothing arrived within timeout seconds.
+
+        """
+
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def get_all(self, timeout=None):
+        """
+        Returns all (message, content, status) triples sent by the engine that
+        are waiting, waiting up to timeout seconds for the first one. Empty if
+        nothing arrived.
+
+        """
+
+        messages = []
+        message = self.get(timeout)
+        while message is not None:
+            messages.append(message)
+            try:
+                message = self.events.get_nowait()
+            except queue.Empty:
+                message = None
+
+        return messages
+
+    def close(self, timeout=2):
+        """
+        Stops the engine, which closes the port, and removes the ring buffer.
+
+        """
+
+        if self.process.is_alive():
+            try:
+                self.send("stop")
+            except (OSError, ValueError):
+                pass
+            self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.close_ring()
+
+    def close_ring(self):
+        if self.ring is not None:
+            self.ring_reader.close()
+            self.ring.close()
+            self.ring = None
+
+
+class MuonLab_engine_experiment(MuonLab_experiment):
+    """
+    MuonLab_experiment of which the port is read and decoded by an engine
+    process. data_acquisition only adds the decoded data to the measurements
+    and saves them.
+
+    Arguments:
+        port: serial port of the MuonLab III
+        device_factory: function returning an opened device to use instead of
+            the port, see MuonLab_engine
+
+    """
+
+    def __init__(self, port, device_factory=None):
+        engine = MuonLab_engine(port, device_factory)
+        super().__init__(port, device=engine)
+
+    def data_acquisition(self):
+        """
+        Loop adding data decoded by the engine to the measurements.
+
+        """
+
+        self.start_autosave()
+
+        while self.run_measurements == True:
+            # all waiting messages are taken at once, so they can not pile up
+            # when the GUI falls behind
+            signals = []
+            error = None
+            for kind, content, self.device.status in self.device.get_all(0.1):
+                if kind == "batch" and content is not None:
+                    signals.append(content)
+                elif kind == "error":
+                    error = content
+            signals = np.concatenate(signals) if signals else None
+
+            # all events written up to the message are in the ring buffer
+            records = self.device.ring_reader.read()
+            self.process_batch(records_to_batch(records, signals))
+            self.autosave()
+
+            if error is not None:
+                raise OSError(f"Reading the port failed: {error}")
+
+    def reader_status(self):
+        status = self.device.status["reader"]
+        if status["error"] is not None:
+            raise OSError(f"Reading the port failed: {status['error']}")
+
+        return status
+
+    def transfer_summary(self):
+        return {
+            "Bytes received": self.device.status["bytes_received"],
+            "Bytes lost": self.device.status["bytes_lost"],
+            "Data complete": self.device.status["data_complete"]
+            and self.device.ring_reader.lost == 0,
+            "Events lost": self.device.ring_reader.lost,
+        }
+
+    def start_recording(self, path):
+        """
+        Lets the engine write all bytes read from the port to a raw log, see
+        MuonLab_recording.
+
+        """
+
+        self.device.send("start_recording", str(path))
+
+    def stop_recording(self):
+        self.device.send("stop_recording")
@@ -0,0 +1,247 @@
+"""
+Fits to measured events that are updated as events arrive.
+
+"""
+
+import numpy as np
+
+# fits need at least this many events in their range
+MINIMUM_EVENTS = 10
+
+# highest lifetime fitted by default in ns. background lifetimes are spread
+# evenly up to the end of the lifetime window, a fit range ending beyond it
+# would spread them too thin
+LIFETIME_WINDOW = 20000
+
+
+def numerical_derivatives(function, x, step=1e-4):
+    """
+    Returns the gradient and Hessian matrix of a function of a few parameters,
+    from central differences around x.
+
+    """
+
+    n = len(x)
+    shifts = step * np.eye(n)
+    value = function(x)
+    gradient = np.empty(n)
+    hessian = np.empty((n, n))
+    for i in range(n):
+        up = function(x + shifts[i])
+        down = function(x - shifts[i])
+        gradient[i] = (up - down) / (2 * step)
+        hessian[i, i] = (up - 2 * value + down) / step**2
+        for j in range(i):
+            hessian[i, j] = hessian[j, i] = (
+                function(x + shifts[i] + shifts[j])
+                - function(x + shifts[i] - shifts[j])
+                - function(x - shifts[i] + shifts[j])
+                + function(x - shifts[i] - shifts[j])
+            ) / (4 * step**2)
+
+    return value, gradient, hessian
+
+
+class MuonLab_lifetime_fit:
+    """
+    Maximum likelihood fit of an exponential decay on a constant background to
+    a lifetime histogram, e.g. of uncorrelated muons stopping in the detector:
+
+        f(t) = (1 - b) * exp(-t / tau) / tau + b / (high - low)
+
+    normalised on the fit range from low to high. The fit only uses the counts
+    of the base bins of a MuonLab_histogram in the fit range, which hold all
+    information of the events, so updating the fit costs time for the number of
+    bins and not for the number of events. Every update starts from the
+    previous result, which changes little once enough events were measured, so
+    a few Newton steps are enough.
+
+    Uncertainties are found from the curvature of the likelihood at its
+    maximum.
+
+    Arguments:
+        low: lowest lifetime fitted
+        high: highest lifetime fitted, None for the highest lifetime
+            measured
+        lifetime: lifetime the first fit starts from, defaults to the mean
+            lifetime measured
+
+    Attributes:
+        lifetime: fitted lifetime tau, None until the first fit
+        lifetime_error: uncertainty of the fitted lifetime
+        background: fitted fraction b of background events
+        background_error: uncertainty of the background fraction
+        events: number of events in the fit range
+
+    """
+
+    def __init__(self, low=0, high=LIFETIME_WINDOW, lifetime=None):
+        self.low = low
+        self.high = high
+        self.initial_lifetime = lifetime
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the previous fit.
+
+        """
+
+        self.parameters = None
+        self.lifetime = None
+        self.lifetime_error = None
+        self.background = None
+        self.background_error = None
+        self.events = 0
+        self.fit_range = None
+
+    def update(self, histogram, max_iterations=50, tolerance=1e-8):
+        """
+        Fits the counts of a histogram, starting from the previous fit.
+
+        Arguments:
+            histogram: MuonLab_histogram of lifetimes
+            max_iterations: maximum number of Newton steps
+            tolerance: change of the parameters below which the fit is done
+
+        Returns:
+            fitted: True if there were enough events to fit
+
+        """
+
+        if histogram.count == 0:
+            return False
+
+        low = self.low
+        high = self.high
+        if high is None:
+            high = histogram.highest + histogram.step
+        # base bins hold the values rounded to the nearest step
+        half_step = histogram.step / 2
+        inside = (histogram.values >= low) & (histogram.values < high)
+        counts = histogram.counts[inside]
+        starts = np.clip(histogram.values[inside] - half_step, low, high) - low
+        ends = np.clip(histogram.values[inside] + half_step, low, high) - low
+        # empty bins do not add to the likelihood
+        filled = counts > 0
+        counts, starts, ends = counts[filled], starts[filled], ends[filled]
+
+        self.events = int(counts.sum())
+        if self.events < MINIMUM_EVENTS or high <= low:
+            return False
+
+        fit_range = high - low
+        self.fit_range = fit_range
+        background_shapes = (ends - starts) / fit_range
+
+        def log_likelihood(parameters):
+            log_tau, logit_b = parameters
+            tau = np.exp(log_tau)
+            b = 1 / (1 + np.exp(-logit_b))
+            decay_shapes = np.exp(-starts / tau) - np.exp(-ends / tau)
+            decay_shapes /= -np.expm1(-fit_range / tau)
+            probabilities = (1 - b) * decay_shapes + b * background_shapes
+            return np.dot(counts, np.log(np.maximum(probabilities, 1e-300)))
+
+        # parameters are the logarithm of the lifetime and the logit of the
+        # background fraction, so any step stays within their allowed range
+        lower = np.array([np.log(histogram.step / 10), -20])
+        upper = np.array([np.log(100 * fit_range), 20])
+        if self.parameters is None:
+            lifetime = self.initial_lifetime
+            if lifetime is None:
+                mean = np.dot(counts, (starts + ends) / 2) / self.events
+                lifetime = max(mean, histogram.step)
+            self.parameters = np.clip(
+                [np.log(lifetime), np.log(0.05 / 0.95)], lower, upper
+            )
+
+        parameters = self.parameters
+        for _ in range(max_iterations):
+            value, gradient, hessian = numerical_derivatives(
+                log_likelihood, parameters
+            )
+            # Newton step, damped towards gradient ascent if the likelihood is
+            # not curved downwards, shortened until the likelihood increases
+            damping = 0.0
+            scale = np.abs(np.diag(hessian)).max() + 1
+            step = None
+            for _ in range(30):
+                try:
+                    step = np.linalg.solve(
+                        -hessian + damping * scale * np.eye(2), gradient
+                    )
+                except np.linalg.LinAlgError:
+                    step = None
+                if step is not None and np.all(np.isfinite(step)):
+                    new_parameters = np.clip(parameters + step, lower, upper)
+                    if log_likelihood(new_parameters) >= value:
+                        break
+                damping = max(2 * damping, 1e-6)
+            else:
+                break
+
+            step = new_parameters - parameters
+            parameters = new_parameters
+            if np.all(np.abs(step) < tolerance):
+                break
+
+        self.parameters = parameters
+        log_tau, logit_b = parameters
+        self.lifetime = float(np.exp(log_tau))
+        self.background = float(1 / (1 + np.exp(-logit_b)))
+
+        # covariance of the parameters from the curvature of the likelihood
+        _, _, hessian = numerical_derivatives(log_likelihood, parameters)
+        try:
+            covariance = np.linalg.inv(-hessian)
+            variances = np.maximum(np.diag(covariance), 0)
+        except np.linalg.LinAlgError:
+            variances = np.full(2, np.inf)
+        self.lifetime_error = float(self.lifetime * np.sqrt(variances[0]))
+        self.background_error = float(
+            self.background * (1 - self.background) * np.sqrt(variances[1])
+        )
+
+        return True
+
+    @property
+    def relative_error(self):
+        """
+        Relative uncertainty of the fitted lifetime, None until the first fit.
+
+        """
+
+        if self.lifetime is None:
+            return None
+
+        return self.lifetime_error / self.lifetime
+
+    def expected_counts(self, edges):
+        """
+        Returns the number of events the fit expects in bins with the given
+        edges, e.g. to draw the fit on a histogram. Bins outside the fit range
+        expect no events.
+
+        """
+
+        if self.lifetime is None:
+            return np.zeros(len(edges) - 1)
+
+        low = self.low
+        high = low + self.fit_range
+        positions = np.clip(edges, low, high) - low
+        decay = -np.diff(np.exp(-positions / self.lifetime))
+        decay /= -np.expm1(-self.fit_range / self.lifetime)
+        background = np.diff(positions) / self.fit_range
+        probabilities = (1 - self.background) * decay + self.background * background
+
+        return self.events * probabilities
+
+    def __str__(self):
+        if self.lifetime is None:
+            return "no fit"
+
+        return "{:.0f} ± {:.0f} ns (background {:.1f} %)".format(
+            self.lifetime, self.lifetime_error, 100 * self.background
+        )
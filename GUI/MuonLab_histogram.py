@@ -0,0 +1,102 @@
+"""
+Histograms of measured events that are updated as events arrive.
+
+"""
+
+import numpy as np
+
+
+class MuonLab_histogram:
+    """
+    Histogram with one base bin for every value the MuonLab III can measure,
+    e.g. every 10 ns step of a lifetime. Adding events only costs time for the
+    new events, and histograms with any number of bins and range are made
+    from the base bins without going over the events again, so their cost
+    does not grow with the number of events measured.
+
+    Arguments:
+        step: difference between two measurable values
+        minimum: lowest measurable value
+        maximum: highest measurable value
+
+    """
+
+    def __init__(self, step, minimum, maximum):
+        self.step = step
+        self.minimum = minimum
+        n_values = int(round((maximum - minimum) / step)) + 1
+        # value of every base bin
+        self.values = minimum + step * np.arange(n_values)
+        self.counts = np.zeros(n_values, dtype=np.int64)
+        self.clear()
+
+    def clear(self):
+        """
+        Removes all events.
+
+        """
+
+        self.counts[:] = 0
+        self.count = 0
+        self.lowest = None
+        self.highest = None
+
+    def add(self, events):
+        """
+        Adds events to the histogram.
+
+        """
+
+        if len(events) == 0:
+            return
+
+        indices = np.rint((np.asarray(events) - self.minimum) / self.step)
+        indices = np.clip(indices, 0, len(self.counts) - 1).astype(np.intp)
+        np.add.at(self.counts, indices, 1)
+        self.count += len(indices)
+
+        # keep track of the range of values measured
+        lowest = self.values[indices.min()]
+        highest = self.values[indices.max()]
+        if self.lowest is None or lowest < self.lowest:
+            self.lowest = lowest
+        if self.highest is None or highest > self.highest:
+            self.highest = highest
+
+    def value_range(self):
+        """
+        Returns the lowest and highest value measured, (0, 1) if nothing was
+        measured yet, like numpy.histogram.
+
+        """
+
+        if self.count == 0:
+            return 0, 1
+        if self.lowest == self.highest:
+            return self.lowest - 0.5, self.highest + 0.5
+
+        return self.lowest, self.highest
+
+    def rebin(self, bins, low=None, high=None):
+        """
+        Returns the histogram with bins equal bins from low to high. Bins
+        include their left edge, the last bin also its right edge, like
+        numpy.histogram. low and high default to the range of values measured.
+
+        Returns:
+            counts: number of events in each bin
+            edges: bins + 1 bin edges
+
+        """
+
+        if low is None or high is None:
+            low, high = self.value_range()
+        edges = np.linspace(low, high, bins + 1)
+
+        # number of events below each edge
+        cumulative = np.concatenate(([0], np.cumsum(self.counts)))
+        first = np.searchsorted(self.values, edges[:-1], side="left")
+        last = np.searchsorted(self.values, edges[-1], side="right")
+        below = cumulative[np.append(first, last)]
+
+        return np.diff(below), edges
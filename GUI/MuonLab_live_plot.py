@@ -0,0 +1,291 @@
+"""
+Live plots for the GUI. Axes, labels and artists are created once, each
+update only changes the data of the artists and redraws them on top of a
+saved background (blitting). The full figure is only drawn again when the
+layout changes, e.g. when the number of bins or the range is changed, or
+when the figure is resized or shown again.
+
+"""
+
+import numpy as np
+
+
+class MuonLab_live_plot:
+    """
+    Base class handling the blitting of the animated artists of a single axes.
+
+    """
+
+    def __init__(self, figure, canvas):
+        self.figure = figure
+        self.canvas = canvas
+
+        self.figure.clear()
+        self.ax = self.figure.add_subplot(111)
+        self.artists = []
+        self.background = None
+
+        # every full draw (layout change, resize, tab shown) saves a new background
+        self.canvas.mpl_connect("draw_event", self.on_draw)
+
+    def add_artist(self, artist):
+        """
+        Marks an artist as animated, so it is left out of the background.
+
+        """
+
+        artist.set_animated(True)
+        self.artists.append(artist)
+
+        return artist
+
+    def on_draw(self, event):
+        """
+        Saves the background after a full draw and draws the artists on top.
+
+        """
+
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+
+    def relayout(self):
+        """
+        Draws the full figure, including axes, ticks and labels.
+
+        """
+
+        self.canvas.draw()
+
+    def blit(self):
+        """
+        Redraws only the artists on top of the saved background.
+
+        """
+
+        if self.background is None:
+            self.relayout()
+            return
+
+        self.canvas.restore_region(self.background)
+        self.draw_artists()
+        self.canvas.blit(self.ax.bbox)
+
+
+class MuonLab_live_histogram(MuonLab_live_plot):
+    """
+    Histogram drawn as a single filled step patch, so updating it costs the
+    same for any number of bins, with an optional line of a fit to it.
+
+    Arguments:
+        figure: matplotlib figure to draw in
+        canvas: canvas displaying the figure
+        xlabel: label of horizontal axis
+        color: fill color of histogram
+        left: lowest value on horizontal axis of empty histogram
+
+    """
+
+    def __init__(self, figure, canvas, xlabel, color, left=None):
+        super().__init__(figure, canvas)
+
+        self.xlabel = xlabel
+        self.left = left
+        self.patch = self.add_artist(
+            self.ax.stairs(
+                [], [0], fill=True, facecolor=color, edgecolor="black", linewidth=0.5
+            )
+        )
+        (self.fit_line,) = self.ax.plot([], [], color="black", linewidth=1.5)
+        self.add_artist(self.fit_line)
+        self.ax.set_xlabel(xlabel)
+        self.ax.set_ylabel("Counts")
+        self.ax.grid()
+        self.clear()
+
+    def clear(self):
+        """
+        Shows an empty histogram.
+
+        """
+
+        self.edges = None
+        self.xlim = None
+        self.top = 1
+        self.patch.set_data([], [0])
+        self.fit_line.set_data([], [])
+        if self.left is not None:
+            self.ax.set_xlim(left=self.left)
+        self.ax.set_ylim(0, self.top)
+        self.relayout()
+
+    def update(self, counts, edges, xlim=None, fit=None):
+        """
+        Shows new bin counts. The axes are only drawn again if the bins,
+        horizontal range, or the counts no longer fit.
+
+        Arguments:
+            counts: number of events in each bin
+            edges: bin edges
+            xlim: horizontal range, defaults to the range of the bins
+            fit: number of events a fit expects in each bin, drawn as a line
+                through the bin centers. None hides the line
+
+        """
+
+        if xlim is None:
+            xlim = (edges[0], edges[-1])
+        highest = counts.max() if len(counts) > 0 else 0
+
+        layout_changed = (
+            self.edges is None
+            or len(edges) != len(self.edges)
+            or not np.array_equal(edges, self.edges)
+            or tuple(xlim) != self.xlim
+        )
+        # leave room above the highest bin, so the axes are not drawn every update
+        if layout_changed or highest > self.top:
+            self.top = max(1, highest * 1.25)
+            layout_changed = True
+
+        self.patch.set_data(counts, edges)
+        if fit is None:
+            self.fit_line.set_data([], [])
+        else:
+            self.fit_line.set_data((edges[:-1] + edges[1:]) / 2, fit)
+
+        if layout_changed:
+            self.edges = edges
+            self.xlim = tuple(xlim)
+            self.ax.set_xlim(*xlim)
+            self.ax.set_ylim(0, self.top)
+            self.relayout()
+        else:
+            self.blit()
+
+
+def update_lifetime_plot(live_plot, histogram, fit, lifetimes, bins, x_max):
+    """
+    Adds lifetimes to a histogram, fits it and shows it, as done by the
+    lifetime tab of the GUI on every update. Only the histogram is rebinned,
+    no need to go over all lifetimes.
+
+    Arguments:
+        live_plot: MuonLab_live_histogram to show the histogram in
+        histogram: MuonLab_histogram of all lifetimes shown
+        fit: MuonLab_lifetime_fit of the histogram, None shows no fit
+        lifetimes: lifetimes measured since the previous update
+        bins: number of bins shown
+        x_max: highest lifetime shown in ns
+
+    """
+
+    histogram.add(lifetimes)
+    counts, edges = histogram.rebin(bins, 0, x_max)
+
+    # fit starts from the previous fit, only a few steps are needed
+    expected = None
+    if fit is not None and fit.update(histogram):
+        expected = fit.expected_counts(edges)
+
+    live_plot.update(counts, edges, xlim=(0, x_max), fit=expected)
+
+
+class MuonLab_live_waveform(MuonLab_live_plot):
+    """
+    Digitised input signal with threshold line, drawn on top of the
+    persistence image of all signals and their mean, like the persistence
+    display of an oscilloscope.
+
+    Arguments:
+        figure: matplotlib figure to draw in
+        canvas: canvas displaying the figure
+        color: color of signal
+        threshold_color: color of threshold line
+        mean_color: color of mean signal
+        cmap: colormap of persistence image
+
+    """
+
+    def __init__(
+        self, figure, canvas, color, threshold_color, mean_color="white", cmap="inferno"
+    ):
+        super().__init__(figure, canvas)
+
+        self.ax.set_facecolor((0, 0, 0))
+        # limits are set by update, not by the image
+        self.ax.set_autoscale_on(False)
+        self.persistence_image = self.ax.imshow(
+            np.zeros((1, 1)),
+            cmap=cmap,
+            aspect="auto",
+            interpolation="nearest",
+            origin="upper",
+            visible=False,
+        )
+        (self.mean_line,) = self.ax.plot([], [], color=mean_color, linewidth=0.8)
+        (self.signal_line,) = self.ax.plot([0], [0], color=color)
+        (self.threshold_line,) = self.ax.plot([], [], color=threshold_color)
+        self.add_artist(self.persistence_image)
+        self.add_artist(self.mean_line)
+        self.add_artist(self.signal_line)
+        self.add_artist(self.threshold_line)
+        self.ax.set_xlabel("Time (ns)")
+        self.ax.set_ylabel("Amplitude (mV)")
+        self.ax.grid()
+        self.clear()
+
+    def clear(self):
+        """
+        Shows an empty plot.
+
+        """
+
+        self.x_max = None
+        self.signal_line.set_data([0], [0])
+        self.threshold_line.set_data([], [])
+        self.mean_line.set_data([], [])
+        self.persistence_image.set_visible(False)
+        self.ax.set_xlim(left=0)
+        self.ax.set_ylim(300, 0)
+        self.relayout()
+
+    def update(self, x_data, signal_data, threshold_value, occupancy=None, mean=None):
+        """
+        Shows a new signal. The axes are only drawn again if the time range
+        changes.
+
+        Arguments:
+            x_data: time of every sample in ns
+            signal_data: amplitude of every sample
+            threshold_value: threshold drawn as horizontal line
+            occupancy: persistence image of the samples shown, (amplitudes,
+                samples) array of counts, see MuonLab_waveform_accumulator
+            mean: mean of the samples shown
+
+        """
+
+        self.signal_line.set_data(x_data, signal_data)
+        self.threshold_line.set_data(
+            [0, x_data[-1]], [threshold_value, threshold_value]
+        )
+
+        if occupancy is not None:
+            # counts of rare amplitudes stay visible on a logarithmic scale
+            image = np.log1p(occupancy)
+            self.persistence_image.set_data(image)
+            self.persistence_image.set_extent((0, x_data[-1], len(occupancy), 0))
+            self.persistence_image.set_clim(0, max(image.max(), 1))
+            self.persistence_image.set_visible(True)
+        if mean is not None:
+            self.mean_line.set_data(x_data, mean)
+
+        if x_data[-1] != self.x_max:
+            self.x_max = x_data[-1]
+            self.ax.set_xlim(0, self.x_max)
+            self.relayout()
+        else:
+            self.blit()
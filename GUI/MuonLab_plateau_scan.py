@@ -0,0 +1,566 @@
+"""
+High voltage plateau scan of the MuonLab III. The high voltage of both PMTs
+is stepped over a range, and the hit rates of both channels (0x35 messages)
+and the coincidence rate (0x55 messages) are measured at every step. The
+coincidence rate rises with the voltage until both PMTs detect nearly every
+muon and then stays flat: the plateau. The PMTs are best operated a little
+above the start of the plateau, where the rate does not depend on small
+changes of the voltage and noise is still low.
+
+Time is spent where it is needed:
+    - every voltage is measured until its rates reach a target Poisson
+      uncertainty, relative to the highest rates measured, so voltages with
+      few hits finish quickly
+    - the scan starts on a coarse grid from high to low voltage and then adds
+      voltages halfway between neighbours where the rates change most, until
+      the curve is resolved
+
+Run a scan with:
+
+    python ./GUI/MuonLab_plateau_scan.py /dev/ttyUSB0 --low 900 --high 1700
+
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from MuonLab_decoder import MuonLab_frame_decoder
+from MuonLab_reader import READ_TIMEOUT
+from MuonLab_statistics import poisson_rate_error
+
+# HV = 300+((nBit/255)*1400)
+MINIMUM_VOLTAGE = 300
+MAXIMUM_VOLTAGE = 1700
+
+# rates measured at every voltage
+RATES = ["ch1", "ch2", "coincidences"]
+
+
+def voltage_to_bits(voltage):
+    """
+    Returns the setting in bits closest to a high voltage in V.
+
+    """
+
+    voltage_range = MAXIMUM_VOLTAGE - MINIMUM_VOLTAGE
+    fraction = (voltage - MINIMUM_VOLTAGE) / voltage_range
+    bits = round(fraction * 255)
+
+    return int(np.clip(bits, 0, 255))
+
+
+def bits_to_voltage(bits):
+    """
+    Returns the high voltage in V of a setting in bits.
+
+    """
+
+    return MINIMUM_VOLTAGE + bits / 255 * (MAXIMUM_VOLTAGE - MINIMUM_VOLTAGE)
+
+
+class MuonLab_plateau_point:
+    """
+    Counts measured at one high voltage setting.
+
+    Attributes:
+        bits: high voltage setting of both PMTs
+        voltage: high voltage in V
+        seconds: time measured
+        hit_seconds: number of hit rate messages, one per second
+        hits: total hits of each channel, {"ch1": ..., "ch2": ...}
+        coincidences: number of coincidences
+
+    """
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.voltage = bits_to_voltage(bits)
+        self.seconds = 0.0
+        self.hit_seconds = 0
+        self.hits = {"ch1": 0, "ch2": 0}
+        self.coincidences = 0
+
+    def add(self, batch, seconds):
+        """
+        Adds the data of a batch, measured up to seconds after the start.
+
+        """
+
+        self.seconds = seconds
+        self.hit_seconds += len(batch.hits_ch1)
+        self.hits["ch1"] += int(batch.hits_ch1.sum())
+        self.hits["ch2"] += int(batch.hits_ch2.sum())
+        self.coincidences += batch.coincidences
+
+    def count(self, name):
+        """
+        Returns the number of events and the seconds they were counted in.
+
+        """
+
+        if name == "coincidences":
+            return self.coincidences, self.seconds
+
+        return self.hits[name], self.hit_seconds
+
+    def rate(self, name):
+        """
+        Rate per second of "ch1", "ch2" or "coincidences", 0 before anything
+        was measured.
+
+        """
+
+        count, duration = self.count(name)
+        if duration == 0:
+            return 0.0
+
+        return count / duration
+
+    def rate_error(self, name):
+        """
+        Poisson uncertainty of a rate, infinite before anything was measured.
+
+        """
+
+        count, duration = self.count(name)
+        if duration == 0:
+            return np.inf
+
+        return poisson_rate_error(count, duration)
+
+    def precise(self, precision, reference):
+        """
+        Returns True if the uncertainty of every rate is at most precision
+        times the rate, or times the reference rate if that is higher.
+
+        Arguments:
+            precision: target relative uncertainty
+            reference: dictionary of the highest rate measured of each rate
+
+        """
+
+        return all(
+            self.rate_error(name)
+            <= precision * max(self.rate(name), reference.get(name, 0))
+            for name in RATES
+        )
+
+    def __str__(self):
+        rates = [
+            "{} {:.3f} ± {:.3f} /s".format(
+                name, self.rate(name), self.rate_error(name)
+            )
+            for name in RATES
+        ]
+
+        return "{:6.0f} V: {} ({:.0f} s)".format(
+            self.voltage, ", ".join(rates), self.seconds
+        )
+
+
+class MuonLab_plateau_scan:
+    """
+    Scans the high voltage of both PMTs and measures the plateau curve.
+
+    Arguments:
+        device: opened serial port of the MuonLab III, or an emulated one
+        low: lowest voltage in V
+        high: highest voltage in V
+        steps: number of voltages of the first, coarse, pass
+        precision: target uncertainty of every rate, relative to the rate or
+            to the highest rate measured
+        min_dwell: seconds every voltage is measured at least
+        max_dwell: seconds every voltage is measured at most
+        settle: seconds after a voltage change of which data is discarded.
+            hit rates are counted over the previous second, so at least 1
+        resolution: closest two voltages are measured in V
+        change: fraction of the highest rate by which the rates between two
+            neighbouring voltages have to differ to measure halfway between
+            them
+        max_points: number of voltages measured at most
+
+    """
+
+    def __init__(
+        self,
+        device,
+        low=900,
+        high=MAXIMUM_VOLTAGE,
+        steps=9,
+        precision=0.05,
+        min_dwell=5,
+        max_dwell=60,
+        settle=2,
+        resolution=20,
+        change=0.05,
+        max_points=25,
+    ):
+        self.device = device
+        self.low_bits = voltage_to_bits(low)
+        self.high_bits = voltage_to_bits(high)
+        if self.high_bits <= self.low_bits:
+            raise ValueError("Give a highest voltage above the lowest voltage")
+        self.steps = steps
+        self.precision = precision
+        self.min_dwell = min_dwell
+        self.max_dwell = max_dwell
+        self.settle = settle
+        self.resolution_bits = max(
+            1, voltage_to_bits(MINIMUM_VOLTAGE + resolution)
+        )
+        self.change = change
+        self.max_points = max_points
+
+        self.decoder = MuonLab_frame_decoder()
+        # measured points by their setting in bits
+        self.points = {}
+
+    def set_voltage(self, bits):
+        """
+        Sets the high voltage of both PMTs, like set_value_PMT_1 and
+        set_value_PMT_2 of MuonLab_experiment.
+
+        """
+
+        self.device.write(b"\x99\x14" + bytes([bits]) + b"\x66")
+        self.device.write(b"\x99\x15" + bytes([bits]) + b"\x66")
+
+    def read_batch(self):
+        data = self.device.read(max(1, self.device.in_waiting))
+
+        return self.decoder.feed(data)
+
+    @property
+    def reference(self):
+        """
+        Highest rate measured of each rate.
+
+        """
+
+        if not self.points:
+            return {}
+
+        return {
+            name: max(point.rate(name) for point in self.points.values())
+            for name in RATES
+        }
+
+    def measure_point(self, bits):
+        """
+        Measures the rates at one voltage setting until they are precise
+        enough, or for max_dwell seconds.
+
+        """
+
+        self.set_voltage(bits)
+        # data measured while the voltage settles is discarded
+        settled = time.monotonic() + self.settle
+        while time.monotonic() < settled:
+            self.read_batch()
+
+        reference = self.reference
+        point = MuonLab_plateau_point(bits)
+        start = time.monotonic()
+        while True:
+            batch = self.read_batch()
+            point.add(batch, time.monotonic() - start)
+            if point.seconds >= self.max_dwell:
+                break
+            if point.seconds >= self.min_dwell and point.hit_seconds > 0:
+                if point.precise(self.precision, reference):
+                    break
+
+        self.points[bits] = point
+
+        return point
+
+    def next_bits(self):
+        """
+        Returns the setting halfway between the two neighbouring voltages of
+        which the rates differ most, None if no rates differ by more than
+        change times the highest rate or by more than their uncertainties.
+
+        """
+
+        reference = self.reference
+        measured = sorted(self.points)
+        best_change = self.change
+        best_bits = None
+        for low_bits, high_bits in zip(measured[:-1], measured[1:]):
+            if high_bits - low_bits < 2 * self.resolution_bits:
+                continue
+            low_point = self.points[low_bits]
+            high_point = self.points[high_bits]
+            for name in RATES:
+                difference = abs(high_point.rate(name) - low_point.rate(name))
+                error = np.hypot(
+                    low_point.rate_error(name), high_point.rate_error(name)
+                )
+                if difference <= 2 * error or reference[name] == 0:
+                    continue
+                if difference / reference[name] > best_change:
+                    best_change = difference / reference[name]
+                    best_bits = (low_bits + high_bits) // 2
+
+        return best_bits
+
+    def run(self, print_points=True):
+        """
+        Runs the scan: a coarse pass from high to low voltage, then voltages
+        are added where the curve changes most.
+
+        Returns:
+            points: measured MuonLab_plateau_point of every voltage, from low
+                to high voltage
+
+        """
+
+        # measure coincidences, hit rates are always sent. + 8 enables USB
+        self.device.write(b"\x99\x20" + bytes([16 + 8]) + b"\x66")
+
+        coarse = np.linspace(self.low_bits, self.high_bits, self.steps)
+        coarse = np.unique(np.round(coarse).astype(int))
+        # start on the plateau, so the highest rates are known early
+        queue = [int(bits) for bits in coarse[::-1]]
+        while len(self.points) < self.max_points:
+            if queue:
+                bits = queue.pop(0)
+            else:
+                bits = self.next_bits()
+                if bits is None:
+                    break
+            if bits in self.points:
+                continue
+
+            point = self.measure_point(bits)
+            if print_points:
+                print(point)
+
+        return self.curve()
+
+    def curve(self):
+        return [self.points[bits] for bits in sorted(self.points)]
+
+
+def suggest_voltage(points, fraction=0.95, margin=100):
+    """
+    Returns the suggested operating voltage of a plateau curve: margin V above
+    the lowest voltage at which the coincidence rate reaches fraction of the
+    plateau rate within its uncertainty, not above the highest voltage
+    measured. The plateau rate is the mean of all coincidence rates that agree
+    with the highest one within their uncertainties, weighted by their
+    uncertainties.
+
+    Returns:
+        voltage: suggested voltage in V, None if no coincidences were measured
+        knee: voltage at which the plateau starts
+
+    """
+
+    if len(points) == 0:
+        return None, None
+    voltages = np.array([point.voltage for point in points])
+    rates = np.array([point.rate("coincidences") for point in points])
+    errors = np.array([point.rate_error("coincidences") for point in points])
+    if rates.max() == 0:
+        return None, None
+
+    highest = np.argmax(rates)
+    differences = 2 * np.hypot(errors, errors[highest])
+    on_plateau = rates + differences >= rates[highest]
+    plateau = np.average(rates[on_plateau], weights=errors[on_plateau] ** -2.0)
+    # a point fluctuating low on the plateau should not move its start up
+    reached = np.flatnonzero(rates + errors >= fraction * plateau)[0]
+
+    # interpolate between the last voltage below and the first on the plateau
+    knee = voltages[reached]
+    if reached > 0 and rates[reached] > rates[reached - 1]:
+        knee = np.interp(
+            fraction * plateau,
+            rates[reached - 1 : reached + 1],
+            voltages[reached - 1 : reached + 1],
+        )
+
+    return float(min(knee + margin, voltages.max())), float(knee)
+
+
+def save_curve(points, path):
+    """
+    Writes a plateau curve to a .csv file.
+
+    """
+
+    # pandas takes long to import and is only needed here
+    import pandas as pd
+
+    columns = {"Voltage (V)": [point.voltage for point in points]}
+    labels = ["Hits channel 1", "Hits channel 2", "Coincidences"]
+    for name, label in zip(RATES, labels):
+        columns[f"{label} (/s)"] = [point.rate(name) for point in points]
+        columns[f"{label} error (/s)"] = [
+            point.rate_error(name) for point in points
+        ]
+    columns["Time (s)"] = [point.seconds for point in points]
+
+    pd.DataFrame(columns).to_csv(path, index=False)
+
+
+def show_curve(points, suggested=None):
+    """
+    Shows the plateau curve. matplotlib is only imported here.
+
+    """
+
+    import matplotlib.pyplot as plt
+
+    voltages = [point.voltage for point in points]
+    figure, (ax_hits, ax_coincidences) = plt.subplots(2, 1, sharex=True)
+    for name, label in [("ch1", "Channel 1"), ("ch2", "Channel 2")]:
+        ax_hits.errorbar(
+            voltages,
+            [point.rate(name) for point in points],
+            [point.rate_error(name) for point in points],
+            marker="o",
+            label=label,
+        )
+    ax_coincidences.errorbar(
+        voltages,
+        [point.rate("coincidences") for point in points],
+        [point.rate_error("coincidences") for point in points],
+        marker="o",
+        color="black",
+    )
+    if suggested is not None:
+        for ax in (ax_hits, ax_coincidences):
+            ax.axvline(
+                suggested,
+                color=[230 / 255, 25 / 255, 61 / 255],
+                linestyle="--",
+            )
+
+    ax_hits.set_ylabel("Hits (/s)")
+    ax_hits.legend()
+    ax_hits.grid()
+    ax_coincidences.set_xlabel("High voltage (V)")
+    ax_coincidences.set_ylabel("Coincidences (/s)")
+    ax_coincidences.grid()
+    plt.show()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Scan the high voltage of the MuonLab PMTs and suggest "
+        "an operating voltage."
+    )
+    parser.add_argument(
+        "port", type=str, help="port of the MuonLab, e.g. /dev/ttyUSB0"
+    )
+    parser.add_argument(
+        "--low", type=float, default=900, help="lowest voltage in V"
+    )
+    parser.add_argument(
+        "--high",
+        type=float,
+        default=MAXIMUM_VOLTAGE,
+        help="highest voltage in V",
+    )
+    parser.add_argument(
+        "--steps",
+        type=int,
+        default=9,
+        help="number of voltages of the first pass",
+    )
+    parser.add_argument(
+        "--precision",
+        type=float,
+        default=0.05,
+        help="target relative uncertainty of the rates at every voltage",
+    )
+    parser.add_argument(
+        "--min-dwell",
+        type=float,
+        default=5,
+        help="seconds measured at least per voltage",
+    )
+    parser.add_argument(
+        "--max-dwell",
+        type=float,
+        default=60,
+        help="seconds measured at most per voltage",
+    )
+    parser.add_argument(
+        "--max-points",
+        type=int,
+        default=25,
+        help="number of voltages measured at most",
+    )
+    parser.add_argument(
+        "--margin",
+        type=float,
+        default=100,
+        help="V above the start of the plateau of the suggested voltage",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        default=None,
+        help=".csv file to save the curve to",
+    )
+    parser.add_argument(
+        "--no-plot",
+        action="store_true",
+        help="do not show the curve at the end",
+    )
+    args = parser.parse_args()
+
+    import serial
+
+    device = serial.Serial(args.port, timeout=READ_TIMEOUT)
+    scan = MuonLab_plateau_scan(
+        device,
+        low=args.low,
+        high=args.high,
+        steps=args.steps,
+        precision=args.precision,
+        min_dwell=args.min_dwell,
+        max_dwell=args.max_dwell,
+        max_points=args.max_points,
+    )
+
+    try:
+        points = scan.run()
+    except KeyboardInterrupt:
+        print("")
+        print("Scan interrupted.")
+        points = scan.curve()
+    finally:
+        # stop sending coincidences
+        device.write(b"\x99\x20\x08\x66")
+
+    suggested, knee = suggest_voltage(points, margin=args.margin)
+    print("")
+    if suggested is None:
+        print("No coincidences measured, no operating voltage found.")
+    else:
+        print("Plateau starts at {:.0f} V".format(knee))
+        print("Suggested operating voltage: {:.0f} V".format(suggested))
+        # leave the PMTs at the closest voltage that can be set
+        bits = voltage_to_bits(suggested)
+        scan.set_voltage(bits)
+        print(
+            "High voltage of both PMTs set to {:.0f} V".format(
+                bits_to_voltage(bits)
+            )
+        )
+
+    if args.output is not None:
+        save_curve(points, args.output)
+        print("Plateau curve written to {}".format(args.output))
+    device.close()
+
+    if not args.no_plot and points:
+        show_curve(points, suggested)
@@ -0,0 +1,169 @@
+"""
+Reading of the serial port in a thread of its own. The reader only moves raw
+chunks of bytes from the device into a bounded queue, decoding, saving and
+plotting happen elsewhere, so they can never delay reading the port.
+
+"""
+
+import queue
+import threading
+import time
+
+# seconds a read of the port waits for data. without a timeout a read blocks
+# forever when the MuonLab III stops sending, and the reader can not be stopped
+READ_TIMEOUT = 0.1
+
+
+class MuonLab_serial_reader:
+    """
+    Thread reading all bytes available on a device into a queue of at most
+    max_chunks chunks. When the queue is full the reader waits for the
+    consumer (backpressure), and the device buffers the incoming data in the
+    meantime. Statistics of the queue are kept as attributes:
+
+        chunks_read, bytes_read: read from the device so far
+        depth: chunks currently waiting in the queue
+        max_depth: largest number of chunks waiting at once
+        full_count: times the reader had to wait because the queue was full
+        blocked_seconds: total time the reader waited for the consumer
+        error: exception that stopped the reader, None while reading works
+
+    Arguments:
+        device: opened device, e.g. serial.Serial. Can be replaced while running
+        max_chunks: size of the queue
+
+    """
+
+    def __init__(self, device, max_chunks=1024):
+        self.device = device
+        self.queue = queue.Queue(maxsize=max_chunks)
+        self.running = threading.Event()
+        self.thread = None
+
+        self.chunks_read = 0
+        self.bytes_read = 0
+        self.max_depth = 0
+        self.full_count = 0
+        self.blocked_seconds = 0.0
+        self.error = None
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def start(self):
+        self.running.set()
+        self.thread = threading.Thread(target=self.read_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=1):
+        """
+        Stops reading. Waits at most timeout seconds for a read in progress or
+        for space in the full queue, the thread ends by itself once that read
+        returns.
+
+        """
+
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def read_loop(self):
+        """
+        Loop running in the reader thread until stop() is called, or reading
+        the device fails. The error is then raised by get().
+
+        """
+
+        while self.running.is_set():
+            # read all queued bytes at once, wait for at least one byte
+            device = self.device
+            try:
+                data = device.read(max(1, device.in_waiting))
+            except Exception as error:
+                # the device may be closed right after stopping
+                if self.running.is_set():
+                    self.error = error
+                    self.running.clear()
+                break
+            if not data:
+                continue
+
+            # chunks are queued with the time they were read
+            chunk = (time.monotonic_ns(), data)
+            try:
+                self.queue.put_nowait(chunk)
+            except queue.Full:
+                self.full_count += 1
+                start = time.monotonic()
+                # wait in steps, so stop() can end the wait
+                queued = False
+                while not queued and self.running.is_set():
+                    try:
+                        self.queue.put(chunk, timeout=READ_TIMEOUT)
+                        queued = True
+                    except queue.Full:
+                        pass
+                self.blocked_seconds += time.monotonic() - start
+                if not queued:
+                    break
+
+            # counted once queued, so all bytes counted can be taken from the queue
+            self.chunks_read += 1
+            self.bytes_read += len(data)
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def get(self, timeout=None):
+        """
+        Returns all chunks waiting in the queue, after waiting up to timeout
+        seconds for the first one. Every chunk keeps the time it was read, so
+        a backlog of chunks is not all given the same time, see
+        MuonLab_frame_decoder.feed_chunks.
+
+        Returns:
+            chunks: list of (time read in ns of the monotonic clock, bytes),
+                empty if nothing arrived
+
+        Raises the error that stopped the reader once all chunks read before
+        it were returned.
+
+        """
+
+        try:
+            chunks = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            self.raise_error()
+            return []
+
+        while True:
+            try:
+                chunks.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return chunks
+
+    def raise_error(self):
+        """
+        Raises the error that stopped the reader, if any.
+
+        """
+
+        if self.error is not None:
+            raise self.error
+
+    def status(self):
+        """
+        Returns the statistics of the queue as a dictionary.
+
+        """
+
+        return {
+            "chunks_read": self.chunks_read,
+            "bytes_read": self.bytes_read,
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "full_count": self.full_count,
+            "blocked_seconds": self.blocked_seconds,
+            "error": None if self.error is None else repr(self.error),
+        }
@@ -0,0 +1,375 @@
+"""
+Recording and replay of the raw byte stream of the MuonLab III. Every chunk
+of bytes read from the device is written to a gzip compressed log together
+with the time it was read, so a run can be decoded again later, e.g. after a
+fix of the decoder, or used as test data.
+
+Format of a log, after gzip decompression:
+
+    header  b"MUONLAB RAW 1\\n", start of recording as 8 byte float (unix time)
+    chunks  8 byte unsigned int: ns since start of recording (monotonic clock)
+            4 byte unsigned int: number of bytes
+            bytes read from the device
+
+all numbers are big-endian. A log that was not closed properly, e.g. after a
+crash, can be read up to its last complete chunk.
+
+To decode a log into the files written by the GUI, run:
+
+    python ./GUI/MuonLab_recording.py run.raw.gz run.csv
+
+"""
+
+import argparse
+import gzip
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from MuonLab_decoder import MuonLab_frame_decoder
+from MuonLab_storage import TIMESTAMP_SUFFIX, open_run_writer
+
+MAGIC = b"MUONLAB RAW 1\n"
+START_FORMAT = struct.Struct(">d")
+CHUNK_FORMAT = struct.Struct(">QI")
+
+
+def read_recording(path):
+    """
+    Reads a raw log chunk by chunk.
+
+    Yields:
+        timestamp: ns between the start of the recording and reading the chunk
+        data: bytes read
+
+    """
+
+    with gzip.open(path, "rb") as log:
+        if log.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a MuonLab raw log")
+        log.read(START_FORMAT.size)
+
+        try:
+            while True:
+                header = log.read(CHUNK_FORMAT.size)
+                if len(header) < CHUNK_FORMAT.size:
+                    break
+                timestamp, length = CHUNK_FORMAT.unpack(header)
+                data = log.read(length)
+                if len(data) < length:
+                    break
+                yield timestamp, data
+        # log of a run that was not closed properly
+        except (EOFError, zlib.error):
+            return
+
+
+def recording_start(path):
+    """
+    Returns the unix time at which a raw log was started.
+
+    """
+
+    with gzip.open(path, "rb") as log:
+        if log.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a MuonLab raw log")
+        (start,) = START_FORMAT.unpack(log.read(START_FORMAT.size))
+
+    return start
+
+
+class MuonLab_recording_device:
+    """
+    Wraps an opened device, e.g. serial.Serial, and writes every byte read
+    from it to a raw log. All other attributes are those of the device.
+
+    Arguments:
+        device: device to read from
+        path: file to write the log to, usually ending in .raw.gz
+        flush_interval: seconds between flushes of the log to the file, at
+            most this much data is lost when the program crashes
+
+    """
+
+    def __init__(self, device, path, flush_interval=1):
+        self.device = device
+        self.path = path
+        self.flush_interval = flush_interval
+
+        # recording can be stopped from another thread than the one reading
+        self.lock = threading.Lock()
+        self.log = gzip.open(path, "wb", compresslevel=6)
+        self.log.write(MAGIC + START_FORMAT.pack(time.time()))
+        self.start_time = time.monotonic_ns()
+        self.next_flush = time.monotonic() + flush_interval
+        self.bytes_recorded = 0
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    def read(self, size=1):
+        data = self.device.read(size)
+        self.record(data)
+
+        return data
+
+    def readinto(self, buffer):
+        n_bytes = self.device.readinto(buffer)
+        self.record(bytes(buffer[:n_bytes]))
+
+        return n_bytes
+
+    def record(self, data):
+        """
+        Writes one chunk of bytes to the log.
+
+        """
+
+        if not data:
+            return
+
+        timestamp = time.monotonic_ns() - self.start_time
+        with self.lock:
+            if self.log is None:
+                return
+            self.log.write(CHUNK_FORMAT.pack(timestamp, len(data)))
+            self.log.write(data)
+            self.bytes_recorded += len(data)
+
+            if time.monotonic() >= self.next_flush:
+                self.log.flush()
+                self.next_flush = time.monotonic() + self.flush_interval
+
+    def stop(self):
+        """
+        Closes the log, the device stays open.
+
+        """
+
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+
+    def close(self):
+        self.stop()
+        self.device.close()
+
+
+class MuonLab_replay_device:
+    """
+    Sends the bytes of a raw log with the part of the pyserial interface used
+    by MuonLab_experiment and MuonLab_III, so a recorded run can be measured
+    again with the GUI or the command line interface.
+
+    Arguments:
+        path: raw log to replay
+        speed: recorded seconds per second, 1 replays in real time. None sends
+            the data as fast as it is read
+        timeout: seconds read() waits for data, None waits forever
+
+    """
+
+    # bytes made available at once if speed is None, like a full USB buffer
+    FAST_CHUNK_SIZE = 4096
+
+    def __init__(self, path, speed=None, timeout=None):
+        self.path = path
+        self.speed = speed
+        self.timeout = timeout
+
+        self.chunks = read_recording(path)
+        self.next_chunk = next(self.chunks, None)
+        self.buffer = bytearray()
+        self.bytes_sent = 0
+        self.is_open = True
+        self.start_time = time.monotonic()
+
+    @property
+    def finished(self):
+        """
+        True once all chunks of the log have been sent.
+
+        """
+
+        return self.next_chunk is None
+
+    def load(self):
+        """
+        Adds the chunks that are due to the input buffer.
+
+        """
+
+        if self.speed is None:
+            while len(self.buffer) < self.FAST_CHUNK_SIZE and not self.finished:
+                self.add()
+        else:
+            elapsed = (time.monotonic() - self.start_time) * self.speed * 1e9
+            while not self.finished and self.next_chunk[0] <= elapsed:
+                self.add()
+
+    def add(self):
+        _, data = self.next_chunk
+        self.buffer += data
+        self.bytes_sent += len(data)
+        self.next_chunk = next(self.chunks, None)
+
+    @property
+    def in_waiting(self):
+        self.load()
+        return len(self.buffer)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def read(self, size=1):
+        """
+        Reads up to size bytes, waiting up to timeout seconds for data.
+
+        """
+
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+
+        self.load()
+        while len(self.buffer) < size and not self.finished and self.is_open:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            time.sleep(0.001)
+            self.load()
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+
+        return len(data)
+
+    def write(self, data):
+        # settings were recorded with the run, messages to the device are ignored
+        return len(data)
+
+    def reset_input_buffer(self):
+        self.load()
+        self.buffer.clear()
+
+    def flushInput(self):
+        self.reset_input_buffer()
+
+    def close(self):
+        self.is_open = False
+        self.chunks.close()
+
+
+def reprocess(path, filename, block_size=2**20, save_events=100000):
+    """
+    Decodes a raw log as fast as possible and saves the result like the GUI
+    does: "<name>_events.csv", "<name>_summary.json" and filename in the wide
+    .csv layout. A filename ending in .muonlab is saved in the binary run
+    format, see MuonLab_run_format, and exported to "<name>.csv".
+
+    Arguments:
+        path: raw log to decode
+        filename: .csv file to write
+        block_size: bytes decoded at once
+        save_events: events collected before they are appended to the file
+
+    Returns:
+        summary: run totals as saved in the summary file
+
+    """
+
+    decoder = MuonLab_frame_decoder()
+    # the run started when the log was recorded, not when it is decoded
+    writer = open_run_writer(filename, start_time=recording_start(path))
+
+    lifetimes = []
+    delta_times = []
+    lifetime_times = []
+    delta_time_times = []
+    hits_ch1 = 0
+    hits_ch2 = 0
+    coincidences = 0
+
+    def decode(chunks):
+        nonlocal hits_ch1, hits_ch2, coincidences
+        # chunks were recorded with their time since the start of the recording
+        batch = decoder.feed_chunks(chunks)
+        lifetimes.extend(batch.lifetimes.tolist())
+        delta_times.extend(batch.delta_times.tolist())
+        lifetime_times.extend(batch.lifetime_times.tolist())
+        delta_time_times.extend(batch.delta_time_times.tolist())
+        hits_ch1 += int(np.sum(batch.hits_ch1))
+        hits_ch2 += int(np.sum(batch.hits_ch2))
+        coincidences += batch.coincidences
+
+        if len(lifetimes) + len(delta_times) >= save_events:
+            save()
+
+    def save():
+        writer.append(
+            lifetime=lifetimes,
+            delta_time=delta_times,
+            **{
+                "lifetime" + TIMESTAMP_SUFFIX: lifetime_times,
+                "delta_time" + TIMESTAMP_SUFFIX: delta_time_times,
+            },
+        )
+        for events in [lifetimes, delta_times, lifetime_times, delta_time_times]:
+            events.clear()
+
+    # chunks are decoded in larger blocks, the decoder keeps messages that
+    # are split between blocks. events keep the time of their own chunk
+    block = []
+    block_length = 0
+    timestamp = 0
+    for timestamp, data in read_recording(path):
+        block.append((timestamp, data))
+        block_length += len(data)
+        if block_length >= block_size:
+            decode(block)
+            block = []
+            block_length = 0
+    decode(block)
+    runtime = timestamp / 1e9
+
+    save()
+    summary = {
+        "Total runtime (s)": runtime,
+        "Hits channel 1": hits_ch1,
+        "Hits channel 2": hits_ch2,
+        "Total coincidences": coincidences,
+        "Bytes received": decoder.bytes_received,
+        "Bytes lost": decoder.bytes_lost,
+        "Data complete": decoder.data_complete,
+    }
+    writer.write_summary(summary)
+    writer.export_csv()
+
+    return summary
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Decode a raw MuonLab III log into .csv files."
+    )
+    parser.add_argument("log", type=str, help="raw log to decode, e.g. run.raw.gz")
+    parser.add_argument(
+        "filename", type=str, help=".csv file, or .muonlab run, to write"
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    summary = reprocess(args.log, args.filename)
+    for name, value in summary.items():
+        print(f"{name}: {value}")
+    print(f"Decoded in {time.perf_counter() - start:.1f} s")
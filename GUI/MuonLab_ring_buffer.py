@@ -0,0 +1,399 @@
+"""
+Ring buffer of measured events in shared memory, written by one process (the
+acquisition engine) and read by any number of processes at once, e.g. the
+GUI, a monitor in a terminal and a recorder saving the events.
+
+Every event is a record of EVENT_DTYPE: the time it was received, its type
+and its value. The shared memory holds a small header followed by the
+records:
+
+    header  int64 capacity, int64 number of records ever written (cursor),
+            int64 number of records written once the current write is done
+            (write start)
+    records capacity records of EVENT_DTYPE
+
+The writer first moves the write start, then writes new records and then
+moves the cursor, so records before the cursor are complete, and records
+from the write start less capacity on may be changing. Readers keep their
+own cursor and never block the writer: a reader that falls more than
+capacity records behind loses the oldest records. Readers check the write
+start after copying records, like a sequence lock, so records overwritten
+while they were copied are detected and counted too.
+
+To follow the events of a running GUI in a terminal, run:
+
+    python ./GUI/MuonLab_ring_buffer.py
+
+"""
+
+import argparse
+import sys
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from MuonLab_decoder import WAVEFORM_LENGTH, MuonLab_data_batch
+from MuonLab_storage import TIMESTAMP_SUFFIX
+
+# name of the buffer written by the acquisition engine of the GUI
+RING_NAME = "muonlab_events"
+
+# event types
+LIFETIME = 1
+DELTA_TIME = 2
+HITS_CH1 = 3
+HITS_CH2 = 4
+COINCIDENCE = 5
+
+EVENT_NAMES = {
+    LIFETIME: "lifetime",
+    DELTA_TIME: "delta_time",
+    HITS_CH1: "hit_ch1",
+    HITS_CH2: "hit_ch2",
+    COINCIDENCE: "coincidence",
+}
+
+EVENT_DTYPE = np.dtype(
+    [("timestamp", np.int64), ("type", np.uint8), ("value", np.float64)], align=True
+)
+HEADER_DTYPE = np.dtype(np.int64)
+HEADER_LENGTH = 3
+
+
+def attach_shared_memory(name, track=False):
+    """
+    Opens existing shared memory. Before Python 3.13 every process opening
+    shared memory removes it when it exits, unless it is untracked. Processes
+    started by the creator share its tracker and should keep tracking.
+
+    """
+
+    if track:
+        return SharedMemory(name=name)
+
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        memory = SharedMemory(name=name)
+        resource_tracker.unregister(memory._name, "shared_memory")
+        return memory
+
+
+def batch_to_records(batch):
+    """
+    Returns the events of a MuonLab_data_batch as records, with the time each
+    event was received. Digitised signals are not events and left out.
+
+    """
+
+    hits = np.stack((batch.hits_ch1, batch.hits_ch2), axis=1).ravel()
+    # both channels of a hit rate message are received at the same time
+    hit_times = np.repeat(batch.hit_times, 2)
+    parts = [
+        (LIFETIME, batch.lifetimes, batch.lifetime_times),
+        (DELTA_TIME, batch.delta_times, batch.delta_time_times),
+        # one record per channel for every hit rate message, ch1 first
+        (None, hits, hit_times),
+        (COINCIDENCE, np.ones(batch.coincidences), batch.coincidence_times),
+    ]
+
+    records = np.empty(sum(len(values) for _, values, _ in parts), dtype=EVENT_DTYPE)
+    position = 0
+    for event_type, values, times in parts:
+        part = records[position : position + len(values)]
+        if event_type is None:
+            part["type"][0::2] = HITS_CH1
+            part["type"][1::2] = HITS_CH2
+        else:
+            part["type"] = event_type
+        part["value"] = values
+        part["timestamp"] = times
+        position += len(values)
+
+    return records
+
+
+def records_to_batch(records, signals=None):
+    """
+    Returns records as a MuonLab_data_batch, the inverse of batch_to_records.
+
+    """
+
+    types = records["type"]
+    values = records["value"]
+    timestamps = records["timestamp"]
+    if signals is None:
+        signals = np.empty((0, WAVEFORM_LENGTH), dtype=np.uint8)
+
+    return MuonLab_data_batch(
+        lifetimes=values[types == LIFETIME].astype(np.int64),
+        delta_times=values[types == DELTA_TIME],
+        hits_ch1=values[types == HITS_CH1].astype(np.int64),
+        hits_ch2=values[types == HITS_CH2].astype(np.int64),
+        coincidences=int(np.count_nonzero(types == COINCIDENCE)),
+        signals=signals,
+        lifetime_times=timestamps[types == LIFETIME],
+        delta_time_times=timestamps[types == DELTA_TIME],
+        hit_times=timestamps[types == HITS_CH1],
+        coincidence_times=timestamps[types == COINCIDENCE],
+    )
+
+
+class MuonLab_ring_buffer:
+    """
+    Writing end of the ring buffer. Only one writer may exist.
+
+    Arguments:
+        name: name of the shared memory, a new name is chosen if None
+        capacity: number of records kept
+        create: create new shared memory, otherwise open the existing
+            shared memory of that name
+        track: see attach_shared_memory, only used if create is False
+
+    """
+
+    def __init__(self, name=None, capacity=2**20, create=True, track=False):
+        if create:
+            size = HEADER_LENGTH * HEADER_DTYPE.itemsize + capacity * EVENT_DTYPE.itemsize
+            self.memory = SharedMemory(name=name, create=True, size=size)
+        else:
+            self.memory = attach_shared_memory(name, track)
+        self.created = create
+        self.name = self.memory.name
+
+        self.header = np.ndarray(HEADER_LENGTH, dtype=HEADER_DTYPE, buffer=self.memory.buf)
+        if create:
+            self.header[:] = (capacity, 0, 0)
+        self.capacity = int(self.header[0])
+        self.records = np.ndarray(
+            self.capacity,
+            dtype=EVENT_DTYPE,
+            buffer=self.memory.buf,
+            offset=HEADER_LENGTH * HEADER_DTYPE.itemsize,
+        )
+
+    @property
+    def cursor(self):
+        return int(self.header[1])
+
+    def write(self, records):
+        """
+        Adds records, overwriting the oldest ones.
+
+        """
+
+        n_records = len(records)
+        if n_records == 0:
+            return
+
+        # only the last capacity records fit, the others count as overwritten
+        cursor = self.cursor
+        skipped = max(0, n_records - self.capacity)
+        kept = records[skipped:]
+
+        # readers copying the slots about to be overwritten see them change
+        self.header[2] = cursor + n_records
+
+        start = (cursor + skipped) % self.capacity
+        first = min(len(kept), self.capacity - start)
+        self.records[start : start + first] = kept[:first]
+        self.records[: len(kept) - first] = kept[first:]
+
+        # records are complete before readers can see them
+        self.header[1] = cursor + n_records
+
+    def write_batch(self, batch):
+        """
+        Adds all events of a MuonLab_data_batch, with the times they were
+        received (monotonic clock, the same in all processes).
+
+        """
+
+        self.write(batch_to_records(batch))
+
+    def close(self):
+        """
+        Closes the buffer. The creator also removes the shared memory.
+
+        """
+
+        # views on the memory must be gone before it can be closed
+        del self.header, self.records
+        self.memory.close()
+        if self.created:
+            self.memory.unlink()
+
+
+class MuonLab_ring_reader:
+    """
+    Reading end of the ring buffer, keeping its own cursor. Any number of
+    readers can read at the same time, without locks.
+
+    Arguments:
+        name: name of the shared memory of the buffer
+        from_start: also read the records already in the buffer, otherwise
+            only records written from now on
+        track: see attach_shared_memory
+
+    Attributes:
+        lost: number of records that were overwritten before they were read
+
+    """
+
+    def __init__(self, name=RING_NAME, from_start=False, track=False):
+        self.memory = attach_shared_memory(name, track)
+        self.header = np.ndarray(HEADER_LENGTH, dtype=HEADER_DTYPE, buffer=self.memory.buf)
+        self.capacity = int(self.header[0])
+        self.records = np.ndarray(
+            self.capacity,
+            dtype=EVENT_DTYPE,
+            buffer=self.memory.buf,
+            offset=HEADER_LENGTH * HEADER_DTYPE.itemsize,
+        )
+
+        cursor = int(self.header[1])
+        self.cursor = max(0, cursor - self.capacity) if from_start else cursor
+        self.lost = 0
+
+    def snapshot(self):
+        """
+        Returns the records written since the previous snapshot as views on the
+        shared memory, without copying. The records are split in two views
+        where they wrap around the end of the buffer. The writer may overwrite
+        them while they are used, see overwritten().
+
+        Returns:
+            start: number of the first record
+            views: list of record arrays
+
+        """
+
+        cursor = int(self.header[1])
+        start = self.cursor
+        if cursor - start > self.capacity:
+            self.lost += cursor - self.capacity - start
+            start = cursor - self.capacity
+        self.cursor = cursor
+
+        first = start % self.capacity
+        n_records = cursor - start
+        end = first + n_records
+        if end <= self.capacity:
+            views = [self.records[first:end]]
+        else:
+            views = [self.records[first:], self.records[: end - self.capacity]]
+
+        return start, views
+
+    def overwritten(self, start):
+        """
+        Returns how many records from start on have been overwritten since
+        they were written, including records the writer is overwriting now.
+
+        """
+
+        # every slot of the records the writer is writing may already have
+        # been changed
+        oldest = int(self.header[2]) - self.capacity
+
+        return max(0, oldest - start)
+
+    def read(self):
+        """
+        Returns a copy of all records written since the previous read. Records
+        overwritten while copying, also by a write that is not done yet, are
+        left out and counted as lost.
+
+        """
+
+        start, views = self.snapshot()
+        records = np.concatenate(views) if len(views) > 1 else views[0].copy()
+
+        overwritten = self.overwritten(start)
+        if overwritten > 0:
+            self.lost += min(overwritten, len(records))
+            records = records[overwritten:]
+
+        return records
+
+    def close(self):
+        del self.header, self.records
+        self.memory.close()
+
+
+def save_records(writer, records, start_time_ns=0):
+    """
+    Appends records to the events of a writer returned by open_run_writer,
+    with the time of every event in ns since start_time_ns.
+
+    """
+
+    types = records["type"]
+    events = {}
+    for event_type, name in EVENT_NAMES.items():
+        selected = records[types == event_type]
+        # times are added before values, so every value has its time
+        events[name + TIMESTAMP_SUFFIX] = selected["timestamp"] - start_time_ns
+        events[name] = selected["value"].tolist()
+    writer.append(**events)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Follow, and optionally save, the events measured by a running MuonLab GUI."
+    )
+    parser.add_argument(
+        "--name", type=str, default=RING_NAME, help="name of the shared memory"
+    )
+    parser.add_argument(
+        "--interval", type=float, default=1, help="seconds between two lines"
+    )
+    parser.add_argument(
+        "--save",
+        type=str,
+        default=None,
+        help="also save all events to <save>_events.csv, or to the binary run <save> if it ends in .muonlab",
+    )
+    args = parser.parse_args()
+
+    # the monotonic clock the events are timed with is shared by all processes
+    start_time_ns = time.monotonic_ns()
+    try:
+        reader = MuonLab_ring_reader(args.name)
+    except FileNotFoundError:
+        sys.exit(f"No events buffer {args.name} found, is the GUI connected?")
+
+    writer = None
+    if args.save is not None:
+        from MuonLab_storage import open_run_writer
+
+        writer = open_run_writer(args.save)
+    saved = False
+
+    try:
+        while True:
+            time.sleep(args.interval)
+            records = reader.read()
+            if writer is not None and len(records) > 0:
+                if not saved:
+                    # events read by the engine just before the start are only
+                    # in the buffer after it, the run starts with them
+                    start_time_ns = min(start_time_ns, int(records["timestamp"].min()))
+                    saved = True
+                save_records(writer, records, start_time_ns)
+
+            counts = np.bincount(records["type"], minlength=len(EVENT_NAMES) + 1)
+            rates = "  ".join(
+                "{}: {:.1f}/s".format(name, counts[event_type] / args.interval)
+                for event_type, name in EVENT_NAMES.items()
+            )
+            print("{}  {}  lost: {}".format(time.strftime("%H:%M:%S"), rates, reader.lost))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+        if writer is not None:
+            writer.sync()
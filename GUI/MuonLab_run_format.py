@@ -0,0 +1,336 @@
+"""
+Binary run format of MuonLab III measurements. A run is a directory, named
+like "run.muonlab", holding one table per event type and the run metadata:
+
+    lifetime.npy, delta_time.npy, ...   values of all events of one type
+    lifetime_timestamp.npy, ...         time each event was received, in ns
+                                        since the start of the run
+    metadata.json                       start time, settings and run totals
+
+Every table is a one dimensional .npy file with the dtype of its event type,
+see EVENT_DTYPES. Events are appended to the end of the file and the length
+in its header is updated after every append, so a run can be read while it
+is written, and a run that was not closed properly can be read up to its
+last append. Tables are read with np.load, also memory mapped, events of a
+time window are selected with time_window, and the run can be converted to
+the wide .csv layout used by the notebooks:
+
+    python ./GUI/MuonLab_run_format.py run.muonlab run.csv
+
+"""
+
+import argparse
+import ast
+import json
+import os
+import struct
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from MuonLab_buffers import seconds_to_ns, select_time_window
+from MuonLab_storage import CSV_LAYOUT, RUN_SUFFIX, TIMESTAMP_SUFFIX, write_wide_csv
+
+FORMAT_NAME = "MuonLab run 1"
+METADATA_NAME = "metadata.json"
+
+# dtype of the table of each event type, other event types are float64
+EVENT_DTYPES = {
+    # multiples of 10 ns up to 655350 ns
+    "lifetime": np.dtype("<i4"),
+    # multiples of 0.5 ns up to 32767.5 ns, exact as float32
+    "delta_time": np.dtype("<f4"),
+    "hit_ch1": np.dtype("<i4"),
+    "hit_ch2": np.dtype("<i4"),
+}
+DEFAULT_DTYPE = np.dtype("<f8")
+# ns since the start of the run
+TIMESTAMP_DTYPE = np.dtype("<i8")
+
+# .npy headers are padded to a fixed length, so the length of a table can be
+# updated in place
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+HEADER_LENGTH = 128
+
+
+def npy_header(dtype, length):
+    """
+    Returns the HEADER_LENGTH bytes of the .npy header of a one dimensional
+    array of length values.
+
+    """
+
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(
+        np.lib.format.dtype_to_descr(dtype), length
+    )
+    text_length = HEADER_LENGTH - len(NPY_MAGIC) - 2
+    header = header.ljust(text_length - 1) + "\n"
+
+    return NPY_MAGIC + struct.pack("<H", text_length) + header.encode("latin1")
+
+
+class MuonLab_event_table:
+    """
+    Appendable .npy file holding the values of one event type. The file is
+    only opened while appending, like the events file of MuonLab_run_writer.
+
+    """
+
+    def __init__(self, path, dtype):
+        self.path = Path(path)
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+
+        with open(self.path, "wb") as table_file:
+            table_file.write(npy_header(self.dtype, 0))
+
+    def append(self, values):
+        values = np.asarray(values, dtype=self.dtype)
+        if len(values) == 0:
+            return
+
+        # values are written before the header counts them
+        with open(self.path, "r+b") as table_file:
+            table_file.seek(0, os.SEEK_END)
+            table_file.write(values.tobytes())
+            self.length += len(values)
+            table_file.seek(0)
+            table_file.write(npy_header(self.dtype, self.length))
+
+    def sync(self):
+        with open(self.path, "ab") as table_file:
+            os.fsync(table_file.fileno())
+
+
+class MuonLab_binary_run_writer:
+    """
+    Writes a run in the binary run format, with the same methods as
+    MuonLab_run_writer. Each append writes the new events to the end of their
+    tables, so saving costs the same at any point in a run.
+
+    Arguments:
+        filename: run directory to write, usually ending in RUN_SUFFIX
+        settings: dictionary of settings of the MuonLab III, saved in the
+            metadata
+        start_time: unix time the run started, defaults to now, e.g. the
+            start of a raw log that is decoded again
+
+    """
+
+    def __init__(self, filename, settings=None, start_time=None):
+        self.filename = str(filename)
+        self.run_path = Path(self.filename)
+        self.run_path.mkdir(parents=True, exist_ok=True)
+        self.metadata_path = self.run_path / METADATA_NAME
+
+        # start a new run, tables of a previous run are replaced
+        for table_path in self.run_path.glob("*.npy"):
+            table_path.unlink()
+        self.tables = {}
+
+        if start_time is None:
+            start_time = time.time()
+        self.start_time = datetime.fromtimestamp(start_time).isoformat()
+        self.settings = dict(settings or {})
+        self.summary = {}
+        self.write_metadata()
+
+    def table(self, event_type):
+        if event_type not in self.tables:
+            if event_type.endswith(TIMESTAMP_SUFFIX):
+                dtype = TIMESTAMP_DTYPE
+            else:
+                dtype = EVENT_DTYPES.get(event_type, DEFAULT_DTYPE)
+            self.tables[event_type] = MuonLab_event_table(
+                self.run_path / f"{event_type}.npy", dtype
+            )
+
+        return self.tables[event_type]
+
+    def append(self, **events):
+        """
+        Appends events to their tables.
+
+        Arguments:
+            events: values of each event type, e.g. lifetime=[900, 1840]
+
+        """
+
+        for event_type, values in events.items():
+            self.table(event_type).append(values)
+
+    def write_summary(self, summary):
+        """
+        Replaces the run totals in the metadata.
+
+        Arguments:
+            summary: dictionary of run totals, e.g. {"Total coincidences": 10}
+
+        """
+
+        self.summary = dict(summary)
+        self.write_metadata()
+
+    def write_metadata(self):
+        """
+        Writes the metadata file, replaced in one step so it is never left half
+        written.
+
+        """
+
+        metadata = {
+            "Format": FORMAT_NAME,
+            "Start time": self.start_time,
+            "Settings": self.settings,
+            "Summary": self.summary,
+        }
+
+        temporary_path = self.metadata_path.with_suffix(".json.tmp")
+        with open(temporary_path, "w") as metadata_file:
+            json.dump(metadata, metadata_file, indent=4)
+        os.replace(temporary_path, self.metadata_path)
+
+    def sync(self):
+        """
+        Forces all written data onto the disk.
+
+        """
+
+        for table in self.tables.values():
+            table.sync()
+        with open(self.metadata_path, "a") as metadata_file:
+            os.fsync(metadata_file.fileno())
+
+    def export_csv(self, path=None, layout=CSV_LAYOUT, empty_value=None):
+        """
+        Writes all data saved so far in the wide .csv layout.
+
+        Arguments:
+            path: file to write, defaults to the run directory with .csv
+                extension
+            layout: list of (column name, event type) pairs, see CSV_LAYOUT
+            empty_value: value written in event columns without any events
+
+        """
+
+        if path is None:
+            path = self.run_path.with_suffix(".csv")
+
+        export_run_csv(self.run_path, path, layout, empty_value)
+
+
+def read_table(path, mmap=True):
+    """
+    Reads one table, memory mapped unless mmap is False. Only the values
+    counted in its header are read.
+
+    """
+
+    with open(path, "rb") as table_file:
+        version = np.lib.format.read_magic(table_file)
+        header = table_file.read(struct.unpack("<H", table_file.read(2))[0])
+        offset = table_file.tell()
+    if version != (1, 0):
+        raise ValueError(f"{path} is not a MuonLab event table")
+
+    header = ast.literal_eval(header.decode("latin1"))
+    dtype = np.dtype(header["descr"])
+    (length,) = header["shape"]
+
+    # an empty file can not be mapped
+    if not mmap or length == 0:
+        with open(path, "rb") as table_file:
+            table_file.seek(offset)
+            return np.fromfile(table_file, dtype=dtype, count=length)
+
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(length,))
+
+
+def read_run(path, mmap=True):
+    """
+    Reads a run in the binary run format.
+
+    Arguments:
+        path: run directory
+        mmap: map the tables into memory instead of reading them, so only the
+            parts used are read from the disk
+
+    Returns:
+        tables: dictionary of event type to array of values
+        metadata: dictionary with start time, settings and run totals
+
+    """
+
+    path = Path(path)
+    with open(path / METADATA_NAME) as metadata_file:
+        metadata = json.load(metadata_file)
+    if metadata.get("Format") != FORMAT_NAME:
+        raise ValueError(f"{path} is not a MuonLab run")
+
+    tables = {
+        table_path.stem: read_table(table_path, mmap)
+        for table_path in sorted(path.glob("*.npy"))
+    }
+
+    return tables, metadata
+
+
+def time_window(tables, event_type, start=None, stop=None):
+    """
+    Returns the events of a type received in a time window of a run, found by
+    binary search on their timestamps, so a memory mapped run is not read
+    completely.
+
+    Arguments:
+        tables: tables of a run as returned by read_run
+        event_type: type of the events, e.g. "lifetime". Events without a
+            value, like coincidences, are returned as their timestamps
+        start: start of the window, seconds since the start of the run, None
+            for all events received before stop
+        stop: end of the window, None for up to the end of the run
+
+    Returns:
+        values: the events in the window
+        times: the time each event was received, ns since the start of the run
+
+    """
+
+    timestamps = tables[event_type + TIMESTAMP_SUFFIX]
+    values = tables.get(event_type, timestamps)
+    # a run that was not closed properly may have more timestamps than values
+    size = min(len(values), len(timestamps))
+
+    return select_time_window(
+        values[:size], timestamps[:size], seconds_to_ns(start), seconds_to_ns(stop)
+    )
+
+
+def export_run_csv(path, csv_path, layout=CSV_LAYOUT, empty_value=None):
+    """
+    Writes a run in the wide .csv layout of "data/Sample data.csv".
+
+    """
+
+    tables, metadata = read_run(path)
+    write_wide_csv(tables, metadata["Summary"], csv_path, layout, empty_value)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Convert a binary MuonLab run into the .csv layout used by "
+        "the notebooks."
+    )
+    parser.add_argument(
+        "run", type=str, help=f"run directory to convert, e.g. run{RUN_SUFFIX}"
+    )
+    parser.add_argument("filename", type=str, help=".csv file to write")
+    args = parser.parse_args()
+
+    export_run_csv(args.run, args.filename)
+    tables, metadata = read_run(args.run)
+    for event_type, values in tables.items():
+        print(f"{event_type}: {len(values)} events")
+    print(f"Written to {args.filename}")
@@ -0,0 +1,118 @@
+"""
+Statistics of measured events that are updated as events arrive.
+
+"""
+
+import numpy as np
+
+
+class MuonLab_running_statistics:
+    """
+    Count, sum, mean and variance of all values added, e.g. of delta times or
+    hit rates. Values are added in batches with array operations and nothing
+    but the statistics is kept, so the uncertainty of a measurement can be
+    followed for any number of events.
+
+    Attributes:
+        count: number of values added
+        total: sum of all values
+        mean: mean of all values
+
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        # sum of squared differences from the mean
+        self.m2 = 0.0
+
+    def add(self, values):
+        """
+        Adds values to the statistics.
+
+        """
+
+        values = np.asarray(values, dtype=np.float64)
+        n_values = len(values)
+        if n_values == 0:
+            return
+
+        # statistics of the batch are combined with those of all earlier
+        # values, like in MuonLab_waveform_accumulator
+        batch_mean = values.mean()
+        batch_m2 = ((values - batch_mean) ** 2).sum()
+
+        count = self.count + n_values
+        delta = batch_mean - self.mean
+        self.mean += delta * (n_values / count)
+        self.m2 += batch_m2 + delta**2 * (self.count * n_values / count)
+        self.count = count
+        self.total += values.sum()
+
+    @property
+    def variance(self):
+        """
+        Sample variance, zero until two values were added.
+
+        """
+
+        if self.count < 2:
+            return 0.0
+
+        return self.m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def standard_error(self):
+        """
+        Uncertainty of the mean, None until two values were added.
+
+        """
+
+        if self.count < 2:
+            return None
+
+        return self.std / np.sqrt(self.count)
+
+    @property
+    def relative_error(self):
+        """
+        Uncertainty of the mean relative to the mean, None until two values
+        were added or while the mean is zero.
+
+        """
+
+        if self.count < 2 or self.mean == 0:
+            return None
+
+        return self.standard_error / abs(self.mean)
+
+
+def poisson_relative_error(count):
+    """
+    Relative uncertainty of a rate measured by counting events, None if no
+    events were counted.
+
+    """
+
+    if count <= 0:
+        return None
+
+    return 1 / np.sqrt(count)
+
+
+def poisson_rate_error(count, duration):
+    """
+    Uncertainty of a rate of count events in duration seconds. No events
+    counted gives the uncertainty of a single event, not zero.
+
+    """
+
+    return np.sqrt(max(count, 1)) / duration
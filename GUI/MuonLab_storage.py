@@ -0,0 +1,327 @@
+"""
+Incremental storage of MuonLab III measurements. Events are appended to a
+.csv file as they are measured, while run totals are kept in a small .json
+file next to it. The wide .csv layout used by the notebooks (see
+"data/Sample data.csv") is produced from these files on demand.
+
+Runs can also be saved in a binary format, see MuonLab_run_format, by
+choosing a filename ending in RUN_SUFFIX. open_run_writer returns the writer
+of either format.
+
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+# columns of the wide .csv layout written by the GUI, in order. Each column is
+# filled with either all events of a type, or a single value from the summary
+# if no event type is given
+CSV_LAYOUT = [
+    ("Total runtime (s)", None),
+    ("Hits channel 1", None),
+    ("Hits channel 2", None),
+    ("Lifetimes (ns)", "lifetime"),
+    ("Delta times (ns)", "delta_time"),
+    ("Total coincidences", None),
+]
+
+# filenames ending in RUN_SUFFIX are saved in the binary run format
+RUN_SUFFIX = ".muonlab"
+
+# event types ending in TIMESTAMP_SUFFIX hold the time the events of the type
+# before it were received, in ns since the start of the run, e.g.
+# "lifetime_timestamp". only binary runs save them
+TIMESTAMP_SUFFIX = "_timestamp"
+
+
+def open_run_writer(filename, settings=None, start_time=None):
+    """
+    Returns a writer for filename: a MuonLab_binary_run_writer if it ends in
+    RUN_SUFFIX, a MuonLab_run_writer otherwise. Both have the same methods.
+
+    Arguments:
+        filename: file or run directory to write
+        settings: settings of the MuonLab III, saved with binary runs only
+        start_time: unix time the run started, defaults to now, saved with
+            binary runs only
+
+    """
+
+    if Path(str(filename)).suffix == RUN_SUFFIX:
+        from MuonLab_run_format import MuonLab_binary_run_writer
+
+        return MuonLab_binary_run_writer(filename, settings, start_time)
+
+    return MuonLab_run_writer(filename)
+
+
+class MuonLab_run_writer:
+    """
+    Appends measured events to "<name>_events.csv" and keeps the run totals
+    in "<name>_summary.json", where <name> is the filename without .csv
+    extension. Each flush only writes the events recorded since the previous
+    flush, so saving costs the same at any point in a run.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        base = Path(self.filename)
+        if base.suffix == ".csv":
+            base = base.with_suffix("")
+        self.events_path = Path(f"{base}_events.csv")
+        self.summary_path = Path(f"{base}_summary.json")
+
+        # start a new events file with only a header
+        with open(self.events_path, "w") as events_file:
+            events_file.write("Type,Value\n")
+
+        self.summary = {}
+
+    def append(self, **events):
+        """
+        Appends events to the events file.
+
+        Arguments:
+            events: values of each event type, e.g. lifetime=[900, 1840]
+
+        """
+
+        rows = []
+        for event_type, values in events.items():
+            # the events file only holds values
+            if event_type.endswith(TIMESTAMP_SUFFIX):
+                continue
+            rows += [f"{event_type},{value}\n" for value in values]
+        if rows:
+            with open(self.events_path, "a") as events_file:
+                events_file.write("".join(rows))
+
+    def write_summary(self, summary):
+        """
+        Replaces the run totals in the summary file. The file is replaced in one
+        step so it is never left half written.
+
+        Arguments:
+            summary: dictionary of run totals, e.g. {"Total coincidences": 10}
+
+        """
+
+        self.summary = dict(summary)
+
+        temporary_path = self.summary_path.with_suffix(".json.tmp")
+        with open(temporary_path, "w") as summary_file:
+            json.dump(self.summary, summary_file, indent=4)
+        os.replace(temporary_path, self.summary_path)
+
+    def sync(self):
+        """
+        Forces all written data onto the disk.
+
+        """
+
+        for path in [self.events_path, self.summary_path]:
+            if path.exists():
+                with open(path, "a") as file:
+                    os.fsync(file.fileno())
+
+    def export_csv(self, path=None, layout=CSV_LAYOUT, empty_value=None):
+        """
+        Writes all data saved so far in the wide .csv layout.
+
+        Arguments:
+            path: file to write, defaults to the filename of the writer
+            layout: list of (column name, event type) pairs, see CSV_LAYOUT
+            empty_value: value written in event columns without any events
+
+        """
+
+        if path is None:
+            path = self.filename
+
+        export_csv(self.events_path, self.summary_path, path, layout, empty_value)
+
+
+class MuonLab_buffered_writer:
+    """
+    Collects events in memory and hands them to a MuonLab_run_writer from a
+    background thread, so measuring never waits for the disk. Events are
+    written every interval seconds, or as soon as batch_size events are
+    waiting. close() writes everything left and forces it onto the disk.
+
+    """
+
+    def __init__(self, writer, interval=5, batch_size=1000):
+        self.writer = writer
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self.queue = queue.Queue()
+        self.summary = {}
+        self.summary_lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def put(self, event_type, values):
+        """
+        Queues events of one type for writing.
+
+        """
+
+        values = list(values)
+        if values:
+            self.queue.put((event_type, values))
+
+    def update_summary(self, summary):
+        """
+        Updates run totals, written together with the next events.
+
+        """
+
+        with self.summary_lock:
+            self.summary.update(summary)
+
+    def write_loop(self):
+        """
+        Loop running in the background thread until close() is called.
+
+        """
+
+        pending = {}
+        n_pending = 0
+        next_write = time.monotonic() + self.interval
+        running = True
+
+        while running:
+            flushed = None
+            try:
+                item = self.queue.get(timeout=max(0, next_write - time.monotonic()))
+                # None is put on the queue to stop the loop, an event to flush
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    flushed = item
+                else:
+                    event_type, values = item
+                    pending.setdefault(event_type, []).extend(values)
+                    n_pending += len(values)
+            except queue.Empty:
+                pass
+
+            if (
+                not running
+                or flushed is not None
+                or n_pending >= self.batch_size
+                or time.monotonic() >= next_write
+            ):
+                self.write(pending)
+                pending = {}
+                n_pending = 0
+                next_write = time.monotonic() + self.interval
+
+            if flushed is not None:
+                flushed.set()
+
+    def write(self, events):
+        """
+        Writes events and the current run totals.
+
+        """
+
+        self.writer.append(**events)
+        with self.summary_lock:
+            summary = dict(self.summary)
+        self.writer.write_summary(summary)
+
+    def flush(self):
+        """
+        Waits until all events queued so far have been written.
+
+        """
+
+        if self.thread.is_alive():
+            flushed = threading.Event()
+            self.queue.put(flushed)
+            flushed.wait()
+
+    def close(self):
+        """
+        Writes all queued events and forces them onto the disk. Safe to call
+        more than once.
+
+        """
+
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+            self.writer.sync()
+
+
+def read_events(events_path):
+    """
+    Reads an events file.
+
+    Returns:
+        columns: dictionary of event type to series of values
+
+    """
+
+    # pandas takes long to import and is only needed here
+    import pandas as pd
+
+    events = pd.read_csv(events_path, dtype=str)
+    columns = {}
+    for event_type, values in events.groupby("Type", sort=False)["Value"]:
+        # values written as whole numbers are read back as integers
+        columns[event_type] = pd.to_numeric(values).reset_index(drop=True)
+
+    return columns
+
+
+def export_csv(events_path, summary_path, path, layout=CSV_LAYOUT, empty_value=None):
+    """
+    Combines an events file and its summary file into the wide .csv layout, in
+    which every column starts at the first row.
+
+    """
+
+    with open(summary_path) as summary_file:
+        summary = json.load(summary_file)
+
+    write_wide_csv(read_events(events_path), summary, path, layout, empty_value)
+
+
+def write_wide_csv(event_columns, summary, path, layout=CSV_LAYOUT, empty_value=None):
+    """
+    Writes events and run totals in the wide .csv layout.
+
+    Arguments:
+        event_columns: dictionary of event type to values
+        summary: dictionary of run totals
+        path: file to write
+        layout: list of (column name, event type) pairs, see CSV_LAYOUT
+        empty_value: value written in event columns without any events
+
+    """
+
+    import pandas as pd
+
+    dataframes = []
+    for column, event_type in layout:
+        if event_type is None:
+            values = [summary.get(column)]
+        elif event_type in event_columns and len(event_columns[event_type]) > 0:
+            values = event_columns[event_type]
+        elif empty_value is not None:
+            values = [empty_value]
+        else:
+            values = []
+        dataframes.append(pd.DataFrame({column: values}))
+
+    df_total = pd.concat(dataframes, axis=1)
+    df_total.to_csv(f"{path}", index=False)
@@ -0,0 +1,174 @@
+"""
+Digitised input signals (waveforms) of ch1 of the MuonLab III. Every 0xC5
+message holds WAVEFORM_LENGTH samples, 5 ns apart. The most recent waveforms
+are kept in a ring allocated once, and are shown as views on it, without
+copying.
+
+"""
+
+import numpy as np
+
+from MuonLab_decoder import WAVEFORM_LENGTH
+
+
+class MuonLab_waveform_ring:
+    """
+    The last capacity waveforms, in a (capacity, length) array allocated once.
+    Adding waveforms overwrites the oldest ones.
+
+    Waveforms are added by one thread while others read them. A view on a
+    waveform stays valid until capacity more waveforms have been added.
+
+    Arguments:
+        capacity: number of waveforms kept
+        length: samples per waveform
+
+    Attributes:
+        count: number of waveforms added so far
+
+    """
+
+    def __init__(self, capacity=64, length=WAVEFORM_LENGTH):
+        self.data = np.zeros((capacity, length), dtype=np.uint8)
+        self.capacity = capacity
+        self.length = length
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def add(self, waveforms):
+        """
+        Copies waveforms into the ring.
+
+        Arguments:
+            waveforms: (n, length) array, oldest first
+
+        """
+
+        n_waveforms = len(waveforms)
+        if n_waveforms == 0:
+            return
+
+        # only the last capacity waveforms fit
+        kept = waveforms[-self.capacity :]
+        first = self.count + n_waveforms - len(kept)
+        rows = (first + np.arange(len(kept))) % self.capacity
+        self.data[rows] = kept
+
+        # counted last, so readers never see unwritten waveforms
+        self.count += n_waveforms
+
+    def latest(self):
+        """
+        Returns the most recent waveform as a view, an empty array if none was
+        added yet.
+
+        """
+
+        count = self.count
+        if count == 0:
+            return np.empty(0, dtype=np.uint8)
+
+        return self.data[(count - 1) % self.capacity]
+
+    def views(self, n_waveforms=None):
+        """
+        Returns the last n_waveforms waveforms, all kept if None, as views on
+        the ring. They are split in two (n, length) views where they wrap
+        around the end of the ring, oldest first.
+
+        """
+
+        count = self.count
+        kept = min(count, self.capacity)
+        if n_waveforms is None or n_waveforms > kept:
+            n_waveforms = kept
+
+        first = (count - n_waveforms) % self.capacity
+        end = first + n_waveforms
+        if end <= self.capacity:
+            return [self.data[first:end]]
+
+        return [self.data[first:], self.data[: end - self.capacity]]
+
+
+class MuonLab_waveform_accumulator:
+    """
+    Running statistics of all waveforms added: the mean and variance of every
+    sample, and a persistence image counting how often every sample had every
+    amplitude. Waveforms are added in batches with array operations, and the
+    statistics take the same memory, and the same time to show, for any
+    number of waveforms.
+
+    Arguments:
+        length: samples per waveform
+        levels: number of possible amplitudes, 256 for 8 bit samples
+
+    Attributes:
+        count: number of waveforms added
+        mean: mean of every sample
+        occupancy: (levels, length) array, occupancy[a, i] is the number of
+            waveforms of which sample i had amplitude a
+
+    """
+
+    def __init__(self, length=WAVEFORM_LENGTH, levels=256):
+        self.length = length
+        self.levels = levels
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = np.zeros(self.length)
+        # sum of squared differences from the mean of every sample
+        self.m2 = np.zeros(self.length)
+        self.occupancy = np.zeros((self.levels, self.length), dtype=np.int64)
+
+    def add(self, waveforms):
+        """
+        Adds waveforms to the statistics.
+
+        Arguments:
+            waveforms: (n, length) array of 8 bit samples
+
+        """
+
+        n_waveforms = len(waveforms)
+        if n_waveforms == 0:
+            return
+
+        # mean and variance of the batch are combined with those of all
+        # earlier waveforms, see Chan et al., "Updating formulae and a
+        # pairwise algorithm for computing sample variances" (1979)
+        values = waveforms.astype(np.float64)
+        batch_mean = values.mean(axis=0)
+        batch_m2 = ((values - batch_mean) ** 2).sum(axis=0)
+
+        count = self.count + n_waveforms
+        delta = batch_mean - self.mean
+        # new arrays are assigned, so readers never see half updated values
+        self.mean = self.mean + delta * (n_waveforms / count)
+        self.m2 = self.m2 + batch_m2 + delta**2 * (self.count * n_waveforms / count)
+        self.count = count
+
+        # all (amplitude, sample) pairs are counted at once
+        index = waveforms.astype(np.intp) * self.length + np.arange(self.length)
+        counts = np.bincount(index.ravel(), minlength=self.levels * self.length)
+        self.occupancy += counts.reshape(self.levels, self.length)
+
+    @property
+    def variance(self):
+        """
+        Sample variance of every sample, zero until two waveforms were added.
+
+        """
+
+        if self.count < 2:
+            return np.zeros(self.length)
+
+        return self.m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
@@ -0,0 +1,573 @@
+"""
+Throughput benchmarks of acquisition, decoding, saving and plotting, run on
+byte streams of the MuonLab III emulator without any hardware. Results are
+written as JSON, so they can be compared between versions:
+
+    python ./benchmarks/MuonLab_benchmark.py --output results.json
+
+Run with -h for all options.
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT / "GUI"))
+sys.path.append(str(ROOT / "terminal_controllers"))
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from MuonLab_controller import MuonLab_experiment
+from MuonLab_emulator import MuonLab_emulated_serial, MuonLab_emulator
+from MuonLab_fit import MuonLab_lifetime_fit
+from MuonLab_histogram import MuonLab_histogram
+from MuonLab_live_plot import MuonLab_live_histogram, update_lifetime_plot
+
+# rates of a burst far beyond what the detector produces
+BURST_RATES = {
+    "hit_rate": 1000,
+    "coincidence_rate": 20000,
+    "lifetime_rate": 50000,
+    "delta_time_rate": 50000,
+    "waveform_rate": 0,
+}
+
+
+class MuonLab_bytes_device:
+    """
+    Serial port returning a fixed byte stream, at most chunk_size bytes at a
+    time like the input buffer of a real port. Records when the stream was
+    read completely.
+
+    """
+
+    def __init__(self, data, chunk_size=4096):
+        self.data = memoryview(data)
+        self.position = 0
+        self.chunk_size = chunk_size
+        self.timeout = 0
+        self.finished_time = None
+
+    @property
+    def finished(self):
+        return self.position >= len(self.data)
+
+    @property
+    def bytes_sent(self):
+        return self.position
+
+    @property
+    def in_waiting(self):
+        return min(len(self.data) - self.position, self.chunk_size)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def read(self, size=1):
+        data = bytes(self.data[self.position : self.position + size])
+        self.position += len(data)
+        if self.finished and self.finished_time is None:
+            self.finished_time = time.perf_counter()
+
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+
+        return len(data)
+
+    def write(self, data):
+        return len(data)
+
+    def reset_input_buffer(self):
+        pass
+
+    def flushInput(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def burst_stream(duration, seed=0):
+    """
+    Returns duration emulated seconds of burst data of all measurements.
+
+    """
+
+    emulator = MuonLab_emulator(model_settings=False, seed=seed, **BURST_RATES)
+    emulator.settings[0x20] = 1 + 2 + 8 + 16
+
+    return emulator.generate(duration)
+
+
+def run_acquisition(experiment, device):
+    """
+    Runs data_acquisition until the device has no more data.
+
+    Returns:
+        seconds: time taken to read and decode all data
+
+    """
+
+    thread = threading.Thread(target=experiment.data_acquisition)
+    start = time.perf_counter()
+    thread.start()
+    wait_until_decoded(experiment, device)
+    experiment.run_measurements = False
+    thread.join()
+
+    return time.perf_counter() - start
+
+
+def wait_until_decoded(experiment, device, interval=0.001):
+    """
+    Waits until all data sent by the device has been read and taken off the
+    reader queue of data_acquisition. The data taken last is decoded before
+    data_acquisition stops.
+
+    """
+
+    while True:
+        reader = experiment.reader
+        if (
+            reader is not None
+            and device.finished
+            and reader.bytes_read == device.bytes_sent
+            and reader.depth == 0
+        ):
+            return
+        time.sleep(interval)
+
+
+def count_frames(experiment):
+    return (
+        len(experiment.total_lifetimes)
+        + len(experiment.total_delta_times)
+        + experiment.coincidences_total
+        + experiment.hit_byte_counter_total
+    )
+
+
+##### BENCHMARKS #####
+def benchmark_acquisition(duration):
+    """
+    Frames per second decoded by MuonLab_experiment.data_acquisition.
+
+    """
+
+    data = burst_stream(duration)
+    device = MuonLab_bytes_device(data)
+    experiment = MuonLab_experiment("benchmark", device=device)
+
+    seconds = run_acquisition(experiment, device)
+    frames = count_frames(experiment)
+
+    return {
+        "bytes": len(data),
+        "frames": frames,
+        "seconds": seconds,
+        "frames_per_second": frames / seconds,
+        "bytes_per_second": len(data) / seconds,
+        "reader": experiment.reader_status(),
+    }
+
+
+def benchmark_terminal_controller(duration):
+    """
+    Frames per second decoded by the get_* loops of MuonLab_III.
+
+    """
+
+    import MuonLab_terminal_controller
+
+    data = burst_stream(duration)
+    results = {}
+
+    measurements = {
+        "get_lifetimes": lambda ml: len(ml.get_lifetimes(s=1)),
+        "get_delta_time": lambda ml: len(ml.get_delta_time(s=1)),
+        "get_coincidences": lambda ml: ml.get_coincidences(s=1),
+        "get_hit_rates": lambda ml: len(ml.get_hit_rates(s=1)[0]),
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        working_directory = os.getcwd()
+        os.chdir(directory)
+        try:
+            for name, measure in measurements.items():
+                device = MuonLab_bytes_device(data)
+                ml = MuonLab_terminal_controller.MuonLab_III(
+                    "benchmark", device=device
+                )
+                start = time.perf_counter()
+                frames = measure(ml)
+                end = device.finished_time or time.perf_counter()
+                ml.close()
+
+                seconds = end - start
+                results[name] = {
+                    "bytes_read": device.position,
+                    "frames": frames,
+                    "seconds": seconds,
+                    "frames_per_second": frames / seconds,
+                    "bytes_per_second": device.position / seconds,
+                }
+        finally:
+            os.chdir(working_directory)
+
+    return results
+
+
+def benchmark_save(event_counts, new_events=1000):
+    """
+    Time per MuonLab_experiment.save_data call with new_events new events, as a
+    function of the number of events stored, and time to export all events to
+    a single .csv file.
+
+    """
+
+    rng = np.random.default_rng(0)
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for n_events in event_counts:
+            experiment = MuonLab_experiment(
+                "benchmark", device=MuonLab_bytes_device(b"")
+            )
+            experiment.filename = os.path.join(directory, f"save_{n_events}.csv")
+            experiment.start_time_measurements = datetime.now()
+
+            experiment.lifetime_buffer.extend(rng.integers(0, 2000, n_events) * 10)
+            experiment.delta_time_buffer.extend(rng.integers(-40, 40, n_events) * 0.5)
+            experiment.save_data()
+
+            experiment.lifetime_buffer.extend(rng.integers(0, 2000, new_events) * 10)
+            experiment.delta_time_buffer.extend(rng.integers(-40, 40, new_events) * 0.5)
+            start = time.perf_counter()
+            experiment.save_data()
+            save_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            experiment.export_data()
+            export_seconds = time.perf_counter() - start
+
+            results.append(
+                {
+                    "events_stored": 2 * (n_events + new_events),
+                    "new_events": 2 * new_events,
+                    "save_seconds": save_seconds,
+                    "export_seconds": export_seconds,
+                }
+            )
+
+    return results
+
+
+def peak_rss(duration):
+    """
+    Measures peak resident memory of a long run of duration emulated seconds
+    at burst rates. Runs in the current process, see benchmark_rss.
+
+    """
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    emulator = MuonLab_emulator(model_settings=False, seed=0, **BURST_RATES)
+    emulator.settings[0x20] = 1 + 2 + 8 + 16
+    device = MuonLab_emulated_serial(
+        emulator, speed=None, chunk_duration=0.05, duration=duration, timeout=0
+    )
+    # connect the emulator after the experiment has sent its default settings
+    experiment = MuonLab_experiment("benchmark", device=MuonLab_bytes_device(b""))
+    experiment.device = device
+
+    thread = threading.Thread(target=experiment.data_acquisition)
+    thread.start()
+    wait_until_decoded(experiment, device, interval=0.01)
+    experiment.run_measurements = False
+    thread.join()
+
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return {
+        "events_stored": len(experiment.total_lifetimes)
+        + len(experiment.total_delta_times),
+        "baseline_rss_bytes": baseline * scale,
+        "peak_rss_bytes": peak * scale,
+    }
+
+
+def benchmark_rss(durations):
+    """
+    Runs peak_rss in a new process for every duration, so runs do not share
+    their peak memory.
+
+    """
+
+    results = []
+    for duration in durations:
+        output = subprocess.run(
+            [sys.executable, __file__, "--rss-run", str(duration)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results.append(json.loads(output))
+
+    return results
+
+
+def benchmark_gui_update(event_counts, repeats=20):
+    """
+    Time of user_interface.update_lifetime_func with event_counts lifetimes
+    measured. The function is called on a stand-in for the window holding only
+    the attributes it uses, so no display is needed. Without PyQt6
+    update_lifetime_plot, which does the work of update_lifetime_func, is
+    timed directly.
+
+    """
+
+    try:
+        from MuonLab_GUI import user_interface
+
+        update_lifetime_func = user_interface.update_lifetime_func
+        measured = "update_lifetime_func"
+    except ImportError:
+        update_lifetime_func = None
+        measured = "update_lifetime_plot (PyQt6 not available)"
+
+    rng = np.random.default_rng(0)
+    results = []
+
+    for n_events in event_counts:
+        experiment = MuonLab_experiment("benchmark", device=MuonLab_bytes_device(b""))
+        lifetimes = np.round(rng.exponential(2197, n_events) / 10) * 10
+        experiment.lifetime_buffer.extend(lifetimes)
+
+        figure = Figure()
+        window = SimpleNamespace(
+            experiment=experiment,
+            histogram_LFT=MuonLab_histogram(step=10, minimum=0, maximum=655350),
+            events_added_LFT=0,
+            bins_dropper_LFT=SimpleNamespace(currentText=lambda: "512"),
+            slider_LFT=SimpleNamespace(value=lambda: 100),
+            live_plot_LFT=MuonLab_live_histogram(
+                figure, FigureCanvasAgg(figure), "Lifetime (ns)", "red", left=0
+            ),
+            event_display_LFT=SimpleNamespace(setText=lambda text: None),
+            fit_LFT=MuonLab_lifetime_fit(),
+            fit_display_LFT=SimpleNamespace(setText=lambda text: None),
+        )
+
+        def update():
+            if update_lifetime_func is not None:
+                update_lifetime_func(window)
+            else:
+                # the same update as update_lifetime_func, with the bins and
+                # range of the stand-in window
+                total_lifetimes = experiment.total_lifetimes
+                update_lifetime_plot(
+                    window.live_plot_LFT,
+                    window.histogram_LFT,
+                    window.fit_LFT,
+                    total_lifetimes[window.events_added_LFT :],
+                    bins=512,
+                    x_max=10000,
+                )
+                window.events_added_LFT = len(total_lifetimes)
+
+        # the first update adds all events, later ones only redraw
+        start = time.perf_counter()
+        update()
+        first_seconds = time.perf_counter() - start
+
+        # update_lifetime_func ignores all errors, a stand-in missing an
+        # attribute would only time the steps before it
+        if window.live_plot_LFT.edges is None or window.fit_LFT.lifetime is None:
+            raise RuntimeError(
+                "Lifetime plot was not updated, check the stand-in window"
+            )
+
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            update()
+            times.append(time.perf_counter() - start)
+
+        results.append(
+            {
+                "events": n_events,
+                "measured": measured,
+                "first_update_seconds": first_seconds,
+                "update_seconds_median": float(np.median(times)),
+                "update_seconds_max": float(np.max(times)),
+            }
+        )
+
+    return results
+
+
+def benchmark_startup(repeats=5):
+    """
+    Time until the command line interface can start measuring: importing it,
+    and running it with -h, each in a new interpreter. Also lists which of the
+    slow to import packages were imported.
+
+    """
+
+    terminal_directory = ROOT / "terminal_controllers"
+    heavy_modules = ["numpy", "pandas", "matplotlib"]
+    import_code = (
+        "import json, sys, time; start = time.perf_counter(); "
+        f"sys.path.insert(0, {str(terminal_directory)!r}); "
+        "import MuonLab_terminal_controller; "
+        "print(json.dumps([time.perf_counter() - start, "
+        f"[name for name in {heavy_modules!r} if name in sys.modules]]))"
+    )
+
+    import_times = []
+    help_times = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", import_code],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        import_time, imported = json.loads(output)
+        import_times.append(import_time)
+
+        start = time.perf_counter()
+        subprocess.run(
+            [
+                sys.executable,
+                str(terminal_directory / "MuonLab_terminal_controller.py"),
+                "-h",
+            ],
+            check=True,
+            capture_output=True,
+        )
+        help_times.append(time.perf_counter() - start)
+
+    return {
+        "import_seconds_median": float(np.median(import_times)),
+        "help_seconds_median": float(np.median(help_times)),
+        "modules_imported": imported,
+    }
+
+
+def metadata():
+    """
+    Describes the version and machine the benchmarks ran on.
+
+    """
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        commit = None
+
+    return {
+        "commit": commit or None,
+        "date": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+    }
+
+
+BENCHMARKS = [
+    "acquisition",
+    "terminal_controller",
+    "save",
+    "rss",
+    "gui_update",
+    "startup",
+]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the MuonLab software.")
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=BENCHMARKS,
+        default=BENCHMARKS,
+        help="benchmarks to run",
+    )
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="run with fewer events, e.g. to check the benchmarks themselves",
+    )
+    parser.add_argument(
+        "--output", "-o", type=str, default=None, help="write JSON results to file"
+    )
+    parser.add_argument("--rss-run", type=float, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # child process of benchmark_rss
+    if args.rss_run is not None:
+        print(json.dumps(peak_rss(args.rss_run)))
+        sys.exit()
+
+    if args.quick:
+        stream_duration = 2
+        save_counts = [10**3, 10**4, 10**5]
+        event_counts = [10**3, 10**4, 10**5]
+        rss_durations = [1, 10]
+    else:
+        stream_duration = 20
+        save_counts = [10**3, 10**4, 10**5, 10**6]
+        event_counts = [10**3, 10**4, 10**5, 10**6, 10**7]
+        rss_durations = [1, 10, 100]
+
+    results = {"metadata": metadata()}
+    if "acquisition" in args.only:
+        results["acquisition"] = benchmark_acquisition(stream_duration)
+    if "terminal_controller" in args.only:
+        results["terminal_controller"] = benchmark_terminal_controller(
+            stream_duration
+        )
+    if "save" in args.only:
+        results["save"] = benchmark_save(save_counts)
+    if "rss" in args.only:
+        results["rss"] = benchmark_rss(rss_durations)
+    if "gui_update" in args.only:
+        results["gui_update"] = benchmark_gui_update(event_counts)
+    if "startup" in args.only:
+        results["startup"] = benchmark_startup()
+
+    output = json.dumps(results, indent=4)
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    print(output)
@@ -8,22 +8,90 @@ from logging import raiseExceptions
 import serial
 import serial.tools.list_ports
 from datetime import date, datetime, timedelta
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 import argparse
+import sys
+import time
 from pathlib import Path
 
+# decoding of data messages is shared with the GUI controller
+sys.path.append(str(Path(__file__).resolve().parents[1] / "GUI"))
+from MuonLab_decoder import MuonLab_frame_decoder
+from MuonLab_fit import MuonLab_lifetime_fit
+from MuonLab_histogram import MuonLab_histogram
+from MuonLab_reader import READ_TIMEOUT
+from MuonLab_statistics import MuonLab_running_statistics, poisson_relative_error
+from MuonLab_recording import MuonLab_recording_device, MuonLab_replay_device
+from MuonLab_storage import (
+    RUN_SUFFIX,
+    TIMESTAMP_SUFFIX,
+    MuonLab_buffered_writer,
+    open_run_writer,
+)
+
+# experiments that can be run, with the bit enabling their data messages in
+# the selection byte (see MuonLab_experiment.set_measurement). hit rates are
+# always sent
+SELECTION_BITS = {
+    "lifetimes": 1,
+    "coincidences": 16,
+    "hits": 0,
+    "delta_times": 2,
+}
+EXPERIMENTS = list(SELECTION_BITS)
+
+# seconds between updates of the lifetime fit and checks of the targets of a
+# measurement
+CHECK_INTERVAL = 1
+
+# columns of the .csv file written by the terminal controller, see CSV_LAYOUT
+TERMINAL_CSV_LAYOUT = [
+    ("Hits channel 1", "hit_ch1"),
+    ("Hits channel 2", "hit_ch2"),
+    ("Lifetimes", "lifetime"),
+    ("Delta times", "delta_time"),
+    ("Total coincidences", None),
+]
+
+
+def target_reached(count, relative_error, events=None, precision=None):
+    """
+    Returns True if an experiment measured at least events events and the
+    relative uncertainty of its result is at most precision. Targets that are
+    None are always reached.
+
+    """
+
+    if events is not None and count < events:
+        return False
+    if precision is not None and (relative_error is None or relative_error > precision):
+        return False
+
+    return True
+
 
 class MuonLab_III:
     """
     Class to communicate with NIKHEF's MuonLab III, change settings and receive data.
     """
 
-    def __init__(self, filename, port="COM3"):
-        # try to find device or list available devices if device can't be found
+    def __init__(
+        self,
+        filename,
+        port="COM3",
+        save_interval=5,
+        save_batch_size=1000,
+        voltage=1645,
+        threshold=151,
+        device=None,
+        binary=False,
+    ):
+        # try to find device or list available devices if device can't be found.
+        # an already opened device, e.g. an emulator, can be given instead of a port
         try:
-            self.device = serial.Serial(port)
+            if device is None:
+                device = serial.Serial(port, timeout=READ_TIMEOUT)
+            self.device = device
         except:
             self.device = None
             ports = serial.tools.list_ports.comports()
@@ -39,8 +107,8 @@ class MuonLab_III:
 
 
         # make bytes from terminal commands for initial settings. see "Message Protocol MuonLab III.pdf" on wiki 
-        if 300 <= args.voltage <= 1700:
-        	voltage_value = int(((args.voltage-300)/1400)*255) # HV = 300+((nBit/255)*1400); x6A=d106 > 800V; Default = 1673V = 250bit
+        if 300 <= voltage <= 1700:
+        	voltage_value = int(((voltage-300)/1400)*255) # HV = 300+((nBit/255)*1400); x6A=d106 > 800V; Default = 1673V = 250bit
         	if voltage_value > 255: 
         		voltage_value = 255 
         else:
@@ -50,8 +118,8 @@ class MuonLab_III:
         voltage_pmt1 = b"\x99" + b"\x14" + bytes([voltage_value]) + b"\x66"
         voltage_pmt2 = b"\x99" + b"\x15" + bytes([voltage_value]) + b"\x66"
         
-        if args.threshold <= 380:
-        	threshold_value = int((args.threshold/380)*255) # TV = (nBit/255)*380mV; x22=d34 > 50mV; Default = 151mV = 101bit 
+        if threshold <= 380:
+        	threshold_value = int((threshold/380)*255) # TV = (nBit/255)*380mV; x22=d34 > 50mV; Default = 151mV = 101bit 
         else:
         	threshold_value = 0
         	raise OSError(
@@ -77,6 +145,24 @@ class MuonLab_III:
         )  # Set offset ADC CH1 offset = (nBit/255)*380mV x55=d85 = 126 mV
         self.device.write(b"\x99\x20\x08\x66")  # Enable USB for data reception
 
+        # decodes raw bytes read from the device
+        self.decoder = MuonLab_frame_decoder()
+
+        # measured events are saved in the background while measuring
+        Path("./data").mkdir(parents=True, exist_ok=True)
+        # events are saved in the binary run format, see MuonLab_run_format,
+        # or appended to a .csv file
+        extension = RUN_SUFFIX if binary else ".csv"
+        settings = {"Voltage (V)": voltage, "Threshold (mV)": threshold}
+        self.writer = MuonLab_buffered_writer(
+            open_run_writer(f"./data/{filename}{extension}", settings),
+            interval=save_interval,
+            batch_size=save_batch_size,
+        )
+        self.writer.update_summary({"Total coincidences": 0})
+        # events are saved with the time they were received, counted from here
+        self.start_time_ns = time.monotonic_ns()
+
         # create lists to save all measurement data
         self.lifetimes = []
         self.coincidences = 0
@@ -84,203 +170,308 @@ class MuonLab_III:
         self.hit_rate_ch2 = []
         self.delta_times = []
 
-    def get_lifetimes(self, s=0, m=0, h=0, print_lifetime=False):
+        # histogram of all lifetimes and the lifetime fitted to it
+        self.lifetime_histogram = MuonLab_histogram(
+            step=10, minimum=0, maximum=655350
+        )
+        self.lifetime_fit = MuonLab_lifetime_fit()
+
+    def measure(
+        self,
+        experiments,
+        s=0,
+        m=0,
+        h=0,
+        print_values=False,
+        events=None,
+        precision=None,
+    ):
         """
-        Measures lifetimes of muons detected for set time duration.
-        
+        Runs several experiments at once for a set time duration. The device is
+        set to send the data of all chosen experiments, and all of it is
+        decoded from the same stream.
+
+        With a target number of events or precision, the measurement stops as
+        soon as every experiment reached it, and the set duration is the
+        longest it can take. The relative uncertainty of each experiment is
+        that of:
+
+            lifetimes: the fitted lifetime of all lifetimes measured
+            coincidences: the coincidence rate
+            hits: the hit rate of the channel with the fewest hits
+            delta_times: the mean delta time, so only detectors with a vertical
+                distance can reach it
+
+        Targets are checked every CHECK_INTERVAL seconds on running statistics
+        of the measurement.
+
         Arguments:
+            experiments: list of experiments to run, see EXPERIMENTS
             s: seconds
             m: minutes
             h: hours
-            print_lifetime: print lifetime to screen each time one is measured
-        
+            print_values: print values to screen each time one is measured
+            events: number of events each experiment measures before stopping,
+                hit rate messages for hits
+            precision: relative uncertainty each experiment reaches before
+                stopping, e.g. 0.01
+
         Returns:
-            lifetimes: list of measured lifetimes in ns
+            results: dictionary with the result of each experiment run:
+                lifetimes: list of measured lifetimes in ns
+                coincidences: number of coincidences measured
+                hits: lists of hits registered on ch1 and ch2 in each second
+                delta_times: list of all measured delta times
 
         """
-        # set device to measure lifetime
-        self.device.write(b"\x99\x20\x09\x66")
 
+        for experiment in experiments:
+            if experiment not in EXPERIMENTS:
+                raise ValueError("Unknown experiment: {}".format(experiment))
+
+        # set device to measure all chosen experiments. + 8 is to always enable USB
+        selection_byte_value_decimal = (
+            sum(SELECTION_BITS[experiment] for experiment in set(experiments)) + 8
+        )
+        self.device.write(
+            b"\x99" + b"\x20" + bytes([selection_byte_value_decimal]) + b"\x66"
+        )
+
+        has_targets = events is not None or precision is not None
         if h == 0 and m == 0 and s == 0:
+            # a target that is never reached should not run forever
+            if has_targets:
+                raise ValueError("Give a maximum duration to measure until a target")
             s = 5
-        start_time = datetime.now()
         dT_max = timedelta(seconds=s, minutes=m, hours=h)
-        dT = timedelta(seconds=0.001)
+        # monotonic, so changes of the system clock do not affect the duration
+        start = time.monotonic()
+        deadline = start + dT_max.total_seconds()
+        next_check = start + CHECK_INTERVAL
         lifetimes = []
+        coincidences = 0
+        hits_ch1 = []
+        hits_ch2 = []
+        delta_times = []
+
+        # running statistics to check the targets with
+        total_hits_ch1 = 0
+        total_hits_ch2 = 0
+        delta_time_statistics = MuonLab_running_statistics()
+        target_time = None
 
+        names = ", ".join(experiment.replace("_", " ") for experiment in experiments)
         print("")
         print(
-            "Started lifetime measurement at {}. Set duration: {}".format(
-                datetime.now(), dT_max
+            "Started {} measurement at {}. Set duration: {}".format(
+                names, datetime.now(), dT_max
             )
         )
 
-        # loop running while time difference < dT
-        while dT < dT_max:
-            # flush input buffer if  more than 65000 bytes are queued
-            if self.device.inWaiting() > 65000:
-                self.device.flushInput()
-            else:
-                dT = datetime.now() - start_time
-
-                # check for beginning of a data message
-                byte_1 = self.device.read(1)
-                if byte_1 == b"\x99":
-                    # check for life-time data message
-                    byte_2 = self.device.read(1)
-                    if byte_2 == b"\xA5":
-
-                        # read and convert next 2 bytes corresponding to time
-                        bytes_value = self.device.read(2)
-                        int_value = int.from_bytes(bytes_value, byteorder="big")
-                        # step size = 10 ns
-                        time_value = int_value * 10
-                        lifetimes.append(time_value)
-
-                        self.save_data(self.filename)
-
-                        if print_lifetime:
-                            print("     measured lifetime: {} ns".format(time_value))
+        # loop running until the deadline, checked once per read. a read
+        # returns empty after READ_TIMEOUT if the device sends nothing
+        while time.monotonic() < deadline:
+            # read all queued bytes at once and decode all data messages
+            data = self.device.read(max(1, self.device.in_waiting))
+            batch = self.decoder.feed(data)
+
+            # LIFETIME
+            if "lifetimes" in experiments:
+                new_lifetimes = batch.lifetimes.tolist()
+                lifetimes.extend(new_lifetimes)
+                self.save_events("lifetime", new_lifetimes, batch.lifetime_times)
+
+                for time_value in new_lifetimes:
+                    if print_values:
+                        print("     measured lifetime: {} ns".format(time_value))
+
+                # the fit only goes over the histogram, not over all lifetimes
+                self.lifetime_histogram.add(new_lifetimes)
+
+            # COINCIDENT HITS
+            if "coincidences" in experiments:
+                for _ in range(batch.coincidences):
+
+                    coincidences += 1
+                    if print_values:
+
+                        print(
+                            "     measured coincidence. total: {}".format(
+                                coincidences
+                            )
+                        )
+
+                if batch.coincidences > 0:
+                    self.save_events("coincidence", None, batch.coincidence_times)
+                    self.writer.update_summary(
+                        {"Total coincidences": self.coincidences + coincidences}
+                    )
+
+            # HIT RATES
+            if "hits" in experiments:
+                new_hits_ch1 = batch.hits_ch1.tolist()
+                new_hits_ch2 = batch.hits_ch2.tolist()
+                hits_ch1.extend(new_hits_ch1)
+                hits_ch2.extend(new_hits_ch2)
+                total_hits_ch1 += sum(new_hits_ch1)
+                total_hits_ch2 += sum(new_hits_ch2)
+                self.save_events("hit_ch1", new_hits_ch1, batch.hit_times)
+                self.save_events("hit_ch2", new_hits_ch2, batch.hit_times)
+
+                for hit_ch1, hit_ch2 in zip(new_hits_ch1, new_hits_ch2):
+                    if print_values:
+                        print("     ch1: {} ch2: {}".format(hit_ch1, hit_ch2))
+
+            # DELTA TIME
+            # times are negative if detector 2 was hit first
+            if "delta_times" in experiments:
+                new_delta_times = batch.delta_times.tolist()
+                delta_times.extend(new_delta_times)
+                delta_time_statistics.add(new_delta_times)
+                self.save_events("delta_time", new_delta_times, batch.delta_time_times)
+
+                for value_time in new_delta_times:
+                    if print_values:
+                        print("     measured delta time: {}".format(value_time))
+
+            if time.monotonic() < next_check:
+                continue
+            next_check = time.monotonic() + CHECK_INTERVAL
+
+            if "lifetimes" in experiments:
+                fitted = self.lifetime_fit.update(self.lifetime_histogram)
+                if fitted and print_values:
+                    print("     fitted lifetime: {}".format(self.lifetime_fit))
+
+            # count and relative uncertainty of each experiment
+            progress = {
+                "lifetimes": (len(lifetimes), self.lifetime_fit.relative_error),
+                "coincidences": (coincidences, poisson_relative_error(coincidences)),
+                "hits": (
+                    len(hits_ch1),
+                    poisson_relative_error(min(total_hits_ch1, total_hits_ch2)),
+                ),
+                "delta_times": (len(delta_times), delta_time_statistics.relative_error),
+            }
+            if has_targets and all(
+                target_reached(*progress[experiment], events, precision)
+                for experiment in experiments
+            ):
+                target_time = timedelta(seconds=round(time.monotonic() - start))
+                break
+
+        if "lifetimes" in experiments:
+            self.lifetime_fit.update(self.lifetime_histogram)
 
         # add to total
         self.lifetimes.extend(lifetimes)
-        print("Finished lifetime measurement.")
+        self.coincidences += coincidences
+        self.hit_rate_ch1.extend(hits_ch1)
+        self.hit_rate_ch2.extend(hits_ch2)
+        self.delta_times.extend(delta_times)
+        if target_time is not None:
+            print(
+                "Reached target of {} measurement after {}.".format(names, target_time)
+            )
+        print("Finished {} measurement.".format(names))
         print("")
 
-        return lifetimes
+        results = {
+            "lifetimes": lifetimes,
+            "coincidences": coincidences,
+            "hits": (hits_ch1, hits_ch2),
+            "delta_times": delta_times,
+        }
+
+        return {experiment: results[experiment] for experiment in experiments}
 
-    def get_coincidences(self, s=0, m=0, h=0, print_coincidence=False):
+    def save_events(self, event_type, values, times):
         """
-        Measures total amount of coincident hits in set time duration.
+        Queues events of one type for saving, with the time they were received.
 
+        Arguments:
+            event_type: type of the events, e.g. "lifetime"
+            values: values of the events, None for events without a value
+            times: time each event was received, in ns of the monotonic clock
+
+        """
+
+        if values is not None:
+            self.writer.put(event_type, values)
+        self.writer.put(
+            event_type + TIMESTAMP_SUFFIX, (times - self.start_time_ns).tolist()
+        )
+
+    def get_lifetimes(
+        self, s=0, m=0, h=0, print_lifetime=False, events=None, precision=None
+    ):
+        """
+        Measures lifetimes of muons detected for set time duration.
+        
         Arguments:
             s: seconds
             m: minutes
             h: hours
             print_lifetime: print lifetime to screen each time one is measured
+            events: stop after this many events, see measure
+            precision: stop at this relative uncertainty, see measure
         
         Returns:
             lifetimes: list of measured lifetimes in ns
 
         """
-        # set device to measure coincidences
-        self.device.write(b"\x99\x20\x09\x66")
 
-        if h == 0 and m == 0 and s == 0:
-            s = 5
-        start_time = datetime.now()
-        dT_max = timedelta(seconds=s, minutes=m, hours=h)
-        dT = timedelta(seconds=0.001)
-        coincidences = 0
+        return self.measure(
+            ["lifetimes"], s, m, h, print_lifetime, events, precision
+        )["lifetimes"]
 
-        print("")
-        print(
-            "Started coincidence measurement at {}. Set duration: {}".format(
-                datetime.now(), dT_max
-            )
-        )
+    def get_coincidences(
+        self, s=0, m=0, h=0, print_coincidence=False, events=None, precision=None
+    ):
+        """
+        Measures total amount of coincident hits in set time duration.
 
-        # loop running while time difference < dT
-        while dT < dT_max:
-            # flush input buffer if  more than 65000 bytes are queued
-            if self.device.inWaiting() > 65000:
-                self.device.flushInput()
-            else:
-                dT = datetime.now() - start_time
-
-                # check for beginning of a data message
-                byte_1 = self.device.read(1)
-                if byte_1 == b"\x99":
-                    # check for coincidence data message
-                    byte_2 = self.device.read(1)
-                    if byte_2 == b"\x55":
-
-                        coincidences += 1
-                        if print_coincidence:
-
-                            self.save_data(self.filename)
-
-                            print(
-                                "     measured coincidence. total: {}".format(
-                                    coincidences
-                                )
-                            )
+        Arguments:
+            s: seconds
+            m: minutes
+            h: hours
+            print_coincidence: print total each time a coincidence is measured
+            events: stop after this many events, see measure
+            precision: stop at this relative uncertainty, see measure
+        
+        Returns:
+            coincidences: number of coincidences measured
 
-        # add to total
-        self.coincidences += coincidences
-        print("Finished coincidence measurement.")
-        print("")
+        """
 
-        return coincidences
+        return self.measure(
+            ["coincidences"], s, m, h, print_coincidence, events, precision
+        )["coincidences"]
 
-    def get_hit_rates(self, s=0, m=0, h=0, print_hits=False):
+    def get_hit_rates(
+        self, s=0, m=0, h=0, print_hits=False, events=None, precision=None
+    ):
         """
-        Measures total amount of coincident hits for a set time duration.
+        Measures hits on both channels for a set time duration.
 
         Arguments:
             s: seconds
             m: minutes
             h: hours
-            print_lifetime: print lifetime to screen each time one is measured
+            print_hits: print hits to screen each second
+            events: stop after this many events, see measure
+            precision: stop at this relative uncertainty, see measure
         
         Returns:
-            hits_ch1: hits registered on ch1 in the last second
-            hits_ch2: hits registered on ch2 in the last second
+            hits_ch1: hits registered on ch1 in each second
+            hits_ch2: hits registered on ch2 in each second
         """
-        # note: no need to change device settings, hit rates always returned
-
-        if h == 0 and m == 0 and s == 0:
-            s = 5
-        start_time = datetime.now()
-        dT_max = timedelta(seconds=s, minutes=m, hours=h)
-        dT = timedelta(seconds=0.001)
-        hits_ch1 = []
-        hits_ch2 = []
-        self.a = "xFA" 
-
-        print("")
-        print(
-            "Started hit rate collection at {}. Set duration: {}".format(
-                datetime.now(), dT_max
-            )
-        )
-
-        # loop running while time difference < dT
-        while dT < dT_max:
-            # flush input buffer if  more than 65000 bytes are queued
-            if self.device.inWaiting() > 65000:
-                self.device.flushInput()
-            else:
-                dT = datetime.now() - start_time
-
-                # check for beginning of a data message
-                byte_1 = self.device.read(1)
-                if byte_1 == b"\x99":
-                    # check for coincidence data message
-                    byte_2 = self.device.read(1)
-                    if byte_2 == b"\x35":
-
-                        bytes_ch2 = self.device.read(2)
-                        hit_ch2 = int.from_bytes(bytes_ch2, byteorder="big")
-                        bytes_ch1 = self.device.read(2)
-                        hit_ch1 = int.from_bytes(bytes_ch1, byteorder="big")
-                        hits_ch1.append(hit_ch1)
-                        hits_ch2.append(hit_ch2)
-
-                        self.save_data(self.filename)
-
-                        if print_hits:
-                            print("     ch1: {} ch2: {}".format(hit_ch1, hit_ch2))
 
-        # add to total
-        self.hit_rate_ch1.extend(hits_ch1)
-        self.hit_rate_ch2.extend(hits_ch2)
-        print("Finished hit rate collection.")
-        print("")
-
-        return hits_ch1, hits_ch2
+        return self.measure(["hits"], s, m, h, print_hits, events, precision)["hits"]
 
-    def get_delta_time(self, s=0, m=0, h=0, print_time=False):
+    def get_delta_time(
+        self, s=0, m=0, h=0, print_time=False, events=None, precision=None
+    ):
         """ 
         Measures time between hits on detectors for a set time duration.
         The detectors shoul be set up with a vertical distance, otherwise
@@ -290,113 +481,119 @@ class MuonLab_III:
             s: seconds
             m: minutes
             h: hours
-            print_lifetime: print lifetime to screen each time one is measured
+            print_time: print delta time to screen each time one is measured
+            events: stop after this many events, see measure
+            precision: stop at this relative uncertainty, see measure
         
         Returns:
             delta_times: list of all measured delta times
 
         """
 
-        # set device to measure coincidences
-        self.device.write(b"\x99\x20\x0A\x66")
+        return self.measure(
+            ["delta_times"], s, m, h, print_time, events, precision
+        )["delta_times"]
 
-        if h == 0 and m == 0 and s == 0:
-            s = 5
-        start_time = datetime.now()
-        dT_max = timedelta(seconds=s, minutes=m, hours=h)
-        dT = timedelta(seconds=0.001)
-        delta_times = []
+    def get_signal(self, timeout=5):
+        """
+        Get the analog input signal of channel 1 as digitised values. Other
+        data received while waiting for it is not saved.
 
-        print("")
-        print(
-            "Started delta time measurement at {}. Set duration: {}".format(
-                datetime.now(), dT_max
-            )
-        )
+        Arguments:
+            timeout: seconds to wait for the MuonLab III to send a signal
 
-        while dT < dT_max:
+        Returns:
+            signal: list of digitised values, 5 ns apart. empty if no signal
+                was received
 
-            # flush input buffer if  more than 65000 bytes are queued
-            if self.device.inWaiting() > 65000:
-                self.device.flushInput()
-            else:
-                dT = datetime.now() - start_time
+        """
 
-                # check for beginning of a data message
-                value = self.device.read(1)
-                if value == b"\x99":
-                    # check for delta time message
-                    byte_2 = self.device.read(1)
-                    if byte_2 == b"\xB5" or byte_2 == b"\xB7":
+        # set device to send digitised signals. + 8 is to always enable USB
+        self.device.write(b"\x99\x20\x0C\x66")
 
-                        bytes_time = self.device.read(2)
-                        value_time = int.from_bytes(bytes_time, byteorder="big") * 0.5
-                        # if identifier == b\'xB7' detector 2 was hit first so time should be reversed
-                        if byte_2 == b"\xB7":
-                            value_time *= -1
-                        delta_times.append(value_time)
+        # signals are decoded from complete messages, like all other data
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            data = self.device.read(max(1, self.device.in_waiting))
+            batch = self.decoder.feed(data)
+            if len(batch.signals) > 0:
+                return batch.signals[-1].tolist()
 
-                        self.save_data(self.filename)
+        return []
 
-                        if print_time:
-                            print("     measured delta time: {}".format(value_time))
+    def save_data(self, name="unnamed"):
+        """
+        Saves measured lifetimes, coincidences, hit rates and delta
+        times in a .csv file. Events are saved in the background during
+        measurements, this writes all of them to a single table.
 
-        # add to total
-        self.delta_times.extend(delta_times)
-        print("Finished delta time measurement")
-        print("")
+        """
 
-        return delta_times
+        # bytes that could not be decoded, e.g. after an overflow of the device
+        self.writer.update_summary(
+            {
+                "Bytes received": self.decoder.bytes_received,
+                "Bytes lost": self.decoder.bytes_lost,
+                "Data complete": self.decoder.data_complete,
+            }
+        )
+        if not self.decoder.data_complete:
+            print(
+                "Warning: {} of {} bytes received could not be decoded, data is incomplete.".format(
+                    self.decoder.bytes_lost, self.decoder.bytes_received
+                )
+            )
+        self.writer.flush()
 
-    def get_signal(self):
+        path = f"./data/{name}.csv"
+        self.writer.writer.export_csv(
+            path, layout=TERMINAL_CSV_LAYOUT, empty_value="None measured"
+        )
+
+    def start_recording(self, path):
         """
-        Get the analog input signal of channel 1 as digitised values.
-        
-        Returns:
-            signal: list of digitised values
+        Writes all bytes read from the device to a raw log from now on, see
+        MuonLab_recording.
 
-        """        
-        #### TODO: make signal list and plot available from terminal ####
-        #set device to measure coincidences
-        self.device.write(b"\x99\x20\x0A\x66")
-        
-        data_bytes = self.device.read(100) # get first 100 signals from photomultiplier 1
-        input_signal = list(data_bytes) # signal values are seperated by 5 ns; total signal time = 2 microseconds
-        
-        return input_signal
-	
-    def save_data(self, name="unnamed"):
         """
-        Saves measured lifetimes, coincidences, hit rates and delta 
-        times in a .csv file.
 
+        self.stop_recording()
+        self.device = MuonLab_recording_device(self.device, path)
+
+    def stop_recording(self):
         """
+        Closes the raw log, if one is being written.
 
-        if len(self.lifetimes) == 0:
-            self.lifetimes.append("None measured")
-        if len(self.hit_rate_ch1) == 0:
-            self.hit_rate_ch1.append("None measured")
-        if len(self.hit_rate_ch2) == 0:
-            self.hit_rate_ch2.append("None measured")
-        if len(self.delta_times) == 0:
-            self.delta_times.append("None measured")
-
-        # make dataframes of all data
-        df_coincidence = pd.DataFrame({"Total coincidences": [self.coincidences]})
-        df_lifetime = pd.DataFrame({"Lifetimes": self.lifetimes})
-        df_hits_ch1 = pd.DataFrame({"Hits channel 1": self.hit_rate_ch1})
-        df_hits_ch2 = pd.DataFrame({"Hits channel 2": self.hit_rate_ch2})
-        df_delta_time = pd.DataFrame({"Delta times": self.delta_times})
-
-        df_total = pd.concat(
-            [df_hits_ch1, df_hits_ch2, df_lifetime, df_delta_time, df_coincidence],
-            axis=1,
-        )
+        """
 
-        Path("./data").mkdir(parents=True, exist_ok=True)
-        path = f"./data/{name}.csv"
+        if isinstance(self.device, MuonLab_recording_device):
+            self.device.stop()
+            self.device = self.device.device
+
+    def close(self):
+        """
+        Writes all remaining data to disk. Called at the end of a measurement,
+        also when it is interrupted.
+
+        """
+
+        self.writer.close()
+        self.stop_recording()
+
+def show_histogram(values, xlabel):
+    """
+    Shows a histogram of measured values. matplotlib is only imported here,
+    it takes long to import and is not needed for measuring.
+
+    """
+
+    import matplotlib.pyplot as plt
+
+    plt.hist(values, edgecolor="black")
+    plt.grid()
+    plt.xlabel(xlabel)
+    plt.show()
 
-        df_total.to_csv(f"{path}", index=False)
 
 if __name__ == "__main__":
 
@@ -410,29 +607,43 @@ if __name__ == "__main__":
     parser.add_argument(
         "experiment",
         type=str,
+        nargs="+",
         default=None,
-        help="choose which experiment to run. options: lifetimes, coincidences, hits, delta_times",
+        help="choose which experiments to run, all at once. options: lifetimes, coincidences, hits, delta_times, all",
     )
     parser.add_argument(
         "--seconds",
         "-s",
         type=int,
         default=0,
-        help="number of seconds to run experiment for",
+        help="number of seconds to run experiment for, at most with --events or --precision",
     )
     parser.add_argument(
         "--minutes",
         "-m",
         type=int,
         default=0,
-        help="number of minutes to run experiment for",
+        help="number of minutes to run experiment for, at most with --events or --precision",
     )
     parser.add_argument(
         "--hours",
         "-hrs",
         type=int,
         default=0,
-        help="number of hours to run experiment for",
+        help="number of hours to run experiment for, at most with --events or --precision",
+    )
+    parser.add_argument(
+        "--events",
+        "-n",
+        type=int,
+        default=None,
+        help="stop once every experiment measured this many events, within the set duration",
+    )
+    parser.add_argument(
+        "--precision",
+        type=float,
+        default=None,
+        help="stop once the relative uncertainty of every experiment is below this, e.g. 0.01, within the set duration: of the fitted lifetime, the coincidence rate, the hit rates or the mean delta time",
     )
     parser.add_argument(
         "--filename",
@@ -462,74 +673,125 @@ if __name__ == "__main__":
     	default=151,
     	help="set threshold value of Channel 1 and 2",
     )
+    parser.add_argument(
+        "--save-interval",
+        type=float,
+        default=5,
+        help="maximum number of seconds between saving measured data",
+    )
+    parser.add_argument(
+        "--save-batch",
+        type=int,
+        default=1000,
+        help="save measured data as soon as this many events are waiting",
+    )
+    parser.add_argument(
+        "--record",
+        type=str,
+        default=None,
+        help="also write all raw bytes read from the device to this file, e.g. run.raw.gz",
+    )
+    parser.add_argument(
+        "--replay",
+        type=str,
+        default=None,
+        help="measure the bytes of a raw log written with --record instead of a device",
+    )
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=1,
+        help="recorded seconds replayed per second",
+    )
+    parser.add_argument(
+        "--no-plot",
+        action="store_true",
+        help="do not show histograms at the end of a measurement, matplotlib is not needed",
+    )
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="save events in the binary run format, ./data/<filename>.muonlab, instead of a .csv file",
+    )
     args = parser.parse_args()
-    experiments = ["lifetimes", "coincidences", "hits", "delta_times"]
+    if (args.events is not None or args.precision is not None) and not (
+        args.seconds or args.minutes or args.hours
+    ):
+        parser.error("--events and --precision need a maximum duration")
+    if all(experiment in EXPERIMENTS + ["all"] for experiment in args.experiment):
+        # experiments run in a fixed order, all of them with "all"
+        if "all" in args.experiment:
+            experiments = EXPERIMENTS
+        else:
+            experiments = [e for e in EXPERIMENTS if e in args.experiment]
 
-    if args.experiment in experiments:
-        ml = MuonLab_III(port=args.port, filename=args.filename)
-        lifetimes = False
-        coincidences = False
-        hits = False
-        delta_times = False
-        signal = False
+        device = None
+        if args.replay is not None:
+            device = MuonLab_replay_device(
+                args.replay, speed=args.replay_speed, timeout=READ_TIMEOUT
+            )
+        ml = MuonLab_III(
+            port=args.port,
+            filename=args.filename,
+            save_interval=args.save_interval,
+            save_batch_size=args.save_batch,
+            voltage=args.voltage,
+            threshold=args.threshold,
+            device=device,
+            binary=args.binary,
+        )
+        if args.record is not None:
+            ml.start_recording(args.record)
 
         print("")
         print("Saving data at: ./data/{}".format(args.filename))
 
-        if args.experiment == "lifetimes":
-            lifetimes = True
-        if args.experiment == "coincidences":
-            coincidences = True
-        if args.experiment == "hits":
-            hits = True
-        if args.experiment == "delta_times":
-            delta_times = True
-
-        if lifetimes:
-            lifetimes = ml.get_lifetimes(
-                s=args.seconds, m=args.minutes, h=args.hours, print_lifetime=args.print,
-            )
-            if len(lifetimes) != 0:
-                print("average lifetime: {} ns".format(np.mean(lifetimes)))
-                plt.hist(lifetimes, edgecolor="black")
-                plt.grid()
-                plt.xlabel("lifetime (ns)")
-                plt.show()
-            else:
-                print("No decays measured")
-
-        if coincidences:
-            coin = ml.get_coincidences(
+        try:
+            results = ml.measure(
+                experiments,
                 s=args.seconds,
                 m=args.minutes,
                 h=args.hours,
-                print_coincidence=args.print,
+                print_values=args.print,
+                events=args.events,
+                precision=args.precision,
             )
-            print("Total found coincidences: {}".format(coin))
 
-        if hits:
-            hits_ch1, hits_ch2 = ml.get_hit_rates(
-                s=args.seconds, m=args.minutes, h=args.hours, print_hits=args.print,
-            )
-            print(
-                "avg hits/s ch1: {} avg hits/s ch2: {}".format(
-                    round(np.mean(hits_ch1), 2), round(np.mean(hits_ch2))
-                )
-            )
-
-        if delta_times:
-            times = ml.get_delta_time(
-                s=args.seconds, m=args.minutes, h=args.hours, print_time=args.print,
-            )
-            # plot should be normally distributed around 0 if detectors
-            # are not spaced vertically
-            if len(times) != 0:
-                plt.hist(times, edgecolor="black")
-                plt.grid()
-                plt.xlabel("Delta time (ns)")
-                plt.show()
-                
-        ml.save_data(args.filename)
+            if "lifetimes" in results:
+                lifetimes = results["lifetimes"]
+                if len(lifetimes) != 0:
+                    print("average lifetime: {} ns".format(np.mean(lifetimes)))
+                    print("fitted lifetime: {}".format(ml.lifetime_fit))
+                    if not args.no_plot:
+                        show_histogram(lifetimes, "lifetime (ns)")
+                else:
+                    print("No decays measured")
+
+            if "coincidences" in results:
+                print("Total found coincidences: {}".format(results["coincidences"]))
+
+            if "hits" in results:
+                hits_ch1, hits_ch2 = results["hits"]
+                if len(hits_ch1) != 0:
+                    print(
+                        "avg hits/s ch1: {} avg hits/s ch2: {}".format(
+                            round(np.mean(hits_ch1), 2), round(np.mean(hits_ch2))
+                        )
+                    )
+
+            if "delta_times" in results:
+                times = results["delta_times"]
+                # plot should be normally distributed around 0 if detectors
+                # are not spaced vertically
+                if len(times) != 0 and not args.no_plot:
+                    show_histogram(times, "Delta time (ns)")
+        except KeyboardInterrupt:
+            print("")
+            print("Measurement interrupted.")
+        finally:
+            # write all remaining data, also when interrupted
+            ml.save_data(args.filename)
+            ml.close()
         print("")
 
     else:
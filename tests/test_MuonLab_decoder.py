@@ -0,0 +1,55 @@
+"""
+Regression tests of the byte loss counting of MuonLab_frame_decoder.
+
+Run from the root of the repository with:
+
+    python -m pytest tests
+
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "GUI"))
+
+from MuonLab_decoder import MuonLab_frame_decoder
+
+# lifetime of 160 ns, coincidence, lifetime of 320 ns
+STREAM = bytes.fromhex("99 A5 00 10 66 99 55 66 99 A5 00 20 66")
+
+
+def feed_split(data, split):
+    decoder = MuonLab_frame_decoder()
+    batches = [decoder.feed(data[:split]), decoder.feed(data[split:])]
+
+    return decoder, batches
+
+
+def test_complete_stream():
+    for split in range(len(STREAM) + 1):
+        decoder, batches = feed_split(STREAM, split)
+        assert [int(v) for b in batches for v in b.lifetimes] == [160, 320]
+        assert sum(b.coincidences for b in batches) == 1
+        assert decoder.bytes_lost == 0
+        assert decoder.data_complete
+
+
+def test_message_without_end_byte_is_lost():
+    # "10 66" dropped: the first lifetime is filled up with "99 55" of the
+    # coincidence and ends in 0x55 instead of 0x66
+    data = STREAM.replace(bytes.fromhex("10 66"), b"")
+    for split in range(len(data) + 1):
+        decoder, batches = feed_split(data, split)
+        assert [int(v) for b in batches for v in b.lifetimes] == [1530, 320]
+        assert decoder.bytes_lost == 6
+        assert not decoder.data_complete
+
+
+def test_drop_that_leaves_valid_messages():
+    # "10 66 99" dropped: "99 A5 00 55 66" is a complete lifetime message, no
+    # byte of the stream shows that anything was lost
+    data = STREAM.replace(bytes.fromhex("10 66 99"), b"")
+    decoder, batches = feed_split(data, len(data))
+    assert [int(v) for b in batches for v in b.lifetimes] == [850, 320]
+    assert sum(b.coincidences for b in batches) == 0
+    assert decoder.bytes_lost == 0